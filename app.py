@@ -1,12 +1,13 @@
 from pathlib import Path
-import random
-from urllib.parse import quote
-from flask import Flask, render_template, request, redirect, send_file, url_for
+from flask import Flask, Response, g, request
+from werkzeug.wsgi import wrap_file
 
-from pycaster.lib.image import ImageComponent, generate_app_image
-from pycaster.lib.meroku import get_apps, rate_app
+from pycaster.lib import carousel, cdn, routes
+from pycaster.lib.frames import render_digest, render_view, render_view_svg
+from pycaster.lib.meroku import get_app, get_app_ids, rate_app
 from pycaster.lib.middleware import check_trusted_data
-from pycaster.lib.utils import app_url, setup_logger
+from pycaster.lib.shared_store import get_asset_store, render_key
+from pycaster.lib.utils import setup_logger
 
 __current_file_path__ = Path(__file__).resolve()
 __current_dir__ = __current_file_path__.parent
@@ -19,192 +20,61 @@ def before_request():
   if not check_trusted_data():
     return "Request Unauthorized", 403
 
-@app.route('/')
-def index():
-  apps = get_apps()
-  app_img_url = url_for('frame_image', app_id=apps[0]['dappId'])
-  image_url = f"https://{ app_url }{ app_img_url }"
-  post_url = f"https://{ app_url }{ url_for('action', app_id=apps[0]['dappId']) }"
-  return render_template('index.html', image_url=image_url, post_url=post_url)
-
-@app.route('/action/<app_id>', methods=['POST'])
-def action(app_id: str):
-  data = request.get_json(silent=True)
-  untrusted_data = data['untrustedData']
-  buttonIndex = untrusted_data['buttonIndex']
-  if buttonIndex == 1:
-    apps = get_apps()
-    idx = random.randint(0, len(apps) - 1)
-    app_img_url = url_for('frame_image', app_id=apps[idx]['dappId'])
-    image_url = f"https://{ app_url }{ app_img_url }"
-    post_url = f"https://{ app_url }{ url_for('action', app_id=apps[idx]['dappId']) }"
-    return render_template('index.html', image_url=image_url, post_url=post_url)
-  elif buttonIndex == 2:
-    user_id = f"fc_user:{ untrusted_data['fid'] }"
-    redirect_url = f"https://api.meroku.store/api/v1/o/view/{ app_id }?userId={ user_id }"
-    return redirect(redirect_url, 302)
-  elif buttonIndex == 3:
-    image_url = f"https://{ app_url }{ url_for('image', view_type='pre_rate', app_id=app_id) }"
-    post_url = f"https://{ app_url }{ url_for('rate', app_id=app_id) }"
-    return render_template('rate.html', image_url=image_url, post_url=post_url)
-  elif buttonIndex == 4:
-    redirect_url = f"https://{ app_url }{ url_for('redirect_url', app_id=app_id) }"
-    return redirect(redirect_url, 302)
-
-@app.route('/rate/<app_id>', methods=['POST'])
-def rate(app_id: str):
-  data = request.get_json(silent=True)
-  untrusted_data = data['untrustedData']
-  buttonIndex = untrusted_data['buttonIndex']
-  if buttonIndex == 1:
-    rating = 1
-  elif buttonIndex == 2:
-    rating = 3
-  elif buttonIndex == 3:
-    rating = 5
-  else:
-    rating = 3
-  rate_app(app_id, rating, untrusted_data['fid'])
-  img_url = f"https://{ app_url }{ url_for('image', view_type='post_rate', app_id=app_id) }"
-  next_url = f"https://{ app_url }{ url_for('thanks', app_id=app_id) }"
-  return render_template('thanks.html', image_url=img_url, post_url=next_url)
-
-@app.route('/thanks/<app_id>', methods=['POST'])
-def thanks(app_id: str):
-  data = request.get_json(silent=True)
-  untrusted_data = data['untrustedData']
-  buttonIndex = untrusted_data['buttonIndex']
-  app.logger.info(f"Button Index: { buttonIndex }")
-  try:
-    if buttonIndex == 1:
-      apps = get_apps()
-      idx = random.randint(0, len(apps) - 1)
-      app_img_url = url_for('frame_image', app_id=apps[idx]['dappId'])
-      image_url = f"https://{ app_url }{ app_img_url }"
-      post_url = f"https://{ app_url }{ url_for('action', app_id=apps[idx]['dappId']) }"
-      return render_template('index.html', image_url=image_url, post_url=post_url)
-    else:
-      return redirect("https://dappstore.app", 302)
-  except Exception as e:
-    app.logger.error(e)
-    return redirect("https://dappstore.app", 302)
-
-@app.route('/frame/image/<app_id>')
-def frame_image(app_id):
-  apps = get_apps()
-  apps = filter(lambda x: x['dappId'] == app_id, apps)
-  _app = next(apps, None)
-
-  app.logger.info(_app['images'])
-
-  image_stack = []
-
-  app_logo = ImageComponent(
-    ImageComponent.EXTERNAL_IMAGE,
-    position=(100, 100),
-    external_img_url=_app['images']['logo'],
-    display_type=ImageComponent.DISPLAY_TYPE_CIRCLE,
-    circle_radius=60
-  )
-  image_stack.append(app_logo)
-
-  app_images = _app['images']
-  screenshot_urls = app_images.get('screenshots', [])
-  if len(screenshot_urls) == 0:
-    screenshot_urls = app_images.get('mobileScreenshots', [])
-
-  # if len(screenshot_urls) > 0:
-  #   screenshot_url = screenshot_urls[0]
-  #   screenshot = ImageComponent(
-  #     ImageComponent.EXTERNAL_IMAGE,
-  #     position=(600, 0),
-  #     external_img_url=screenshot_url,
-  #     display_type=ImageComponent.DISPLAY_TYPE_RECTANGLE,
-  #     rect_size=(300, 800)
-  #   )
-  #   image_stack.append(screenshot)
-
-  app_name = ImageComponent(
-    ImageComponent.TEXT,
-    position=(120, 80),
-    text=_app['name'],
-    font_size=42,
-    font_color=(140, 82, 255)
-  )
-  image_stack.append(app_name)
-
-  _text = f"{_app['description']}"
-  description = ImageComponent(
-    ImageComponent.TEXT,
-    position=(0, 150),
-    text=_text,
-    font_size=30,
-    font_color=(0, 0, 0)
-  )
-  image_stack.append(description)
-
-  img = generate_app_image(image_stack)
-
-  img.seek(0)
-  return send_file(img, mimetype='image/png')
-
-@app.route('/image/<view_type>/<app_id>')
-def image(view_type: str, app_id: str):
-  if view_type not in ['pre_rate', 'post_rate']:
-    return "Invalid view type", 400
-
-  apps = get_apps()
-  apps = filter(lambda x: x['dappId'] == app_id, apps)
-  _app = next(apps, None)
-
-  app.logger.info(_app['images'])
-
-  image_stack = []
-
-  if view_type == 'pre_rate':
-    app_logo = ImageComponent(
-      ImageComponent.EXTERNAL_IMAGE,
-      position=(140, 120),
-      external_img_url=_app['images']['logo'],
-      display_type=ImageComponent.DISPLAY_TYPE_CIRCLE,
-      circle_radius=60
-    )
-    image_stack.append(app_logo)
-    app_name = ImageComponent(
-      ImageComponent.TEXT,
-      position=(80, 80),
-      text=f"Rate {_app['name']}",
-      font_size=54,
-      font_color=(0, 0, 0)
-    )
-    image_stack.append(app_name)
-    base_image_path = __current_dir__ / "Pre_Rating.png"
-  else:
-    app_name = ImageComponent(
-      ImageComponent.TEXT,
-      position=(100, 80),
-      text=f"Thanks for rating {_app['name']}",
-      font_size=50,
-      font_color=(0, 0, 0)
-    )
-    image_stack.append(app_name)
-
-    base_image_path = __current_dir__ / "Ratings_Thanks.png"
-
-  img = generate_app_image(image_stack, base_image_path)
-
-  img.seek(0)
-  return send_file(img, mimetype='image/png')
-
-
-@app.route('/redirect/<app_id>')
-def redirect_url(app_id: str):
-  apps = get_apps()
-  apps = filter(lambda x: x['dappId'] == app_id, apps)
-  _app = next(apps, None)
-
-  link_url = f"https://explorer.meroku.org/dapp?id={ app_id }"
-  cast_text = f"Check out {_app['name']} on Meroku!"
-  cast_text = quote(cast_text)
-  cast_intent_url = f"https://warpcast.com/~/compose?text={cast_text}&embeds[]={link_url}"
-  return redirect(cast_intent_url, 302)
+def send_prerendered(request, view_type: str, _app, page: int = None):
+  """
+  Serves a prerendered PNG from the shared asset store if it is current for
+  `_app`, or returns None.
+  """
+  store = get_asset_store()
+  mapped = store.current() if store is not None else None
+  if mapped is None:
+    return None
+  key = render_key(view_type, _app['dappId'], page)
+  meta = mapped.meta(key)
+  if meta is None or meta.get('digest') != render_digest(_app):
+    return None
+  asset = mapped.open(key)
+  if asset is None:
+    return None
+  rv = Response(wrap_file(request.environ, asset), mimetype='image/png',
+                direct_passthrough=True)
+  rv.content_length = asset.length
+  return rv
+
+class SyncServices:
+  """The I/O of the routes (see routes.py), with blocking calls."""
+
+  async def get_app(self, app_id: str):
+    return get_app(app_id)
+
+  async def get_app_ids(self):
+    return get_app_ids()
+
+  async def rate_app(self, app_id: str, rating: int, fid: int):
+    return rate_app(app_id, rating, fid)
+
+  async def published_url(self, view_type: str, _app, page: int = None):
+    return cdn.published_url(view_type, _app, page)
+
+  async def render_svg(self, view_type: str, _app, page: int = None):
+    return render_view_svg(view_type, _app, page)
+
+  async def render_png(self, view_type: str, _app) -> bytes:
+    return render_view(view_type, _app).getvalue()
+
+  async def carousel_page(self, _app, page: int) -> bytes:
+    return carousel.get_page(_app, page)
+
+  def prerendered(self, request, view_type: str, _app, page: int = None):
+    return send_prerendered(request, view_type, _app, page)
+
+services = SyncServices()
+
+def _view(handler):
+  def view(**values):
+    return routes.call_sync(handler, services, request, g.get('frame'), **values)
+  return view
+
+for rule in routes.url_map.iter_rules():
+  app.add_url_rule(rule.rule, rule.endpoint, _view(routes.handlers[rule.endpoint]),
+                   methods=sorted(rule.methods - {'HEAD'}))
@@ -0,0 +1,162 @@
+"""
+Async serving mode: the routes of app.py as an ASGI application.
+
+  uvicorn asgi:app --workers 4
+  gunicorn asgi:app -k uvicorn.workers.UvicornWorker -w 4 --preload
+
+Hub validation, catalog reads, external images, Meroku ratings and the
+background Neynar fetches are awaited, and Pillow renders run on a thread
+pool, so a worker holds as many frame sessions as it has sockets instead of
+one (sync) or one per thread (gthread). The handlers are the ones of
+app.py (see routes.py), run on AsyncServices, so URLs, templates, ETags and
+Cache-Control are the same. gunicorn populates the shared asset store
+before the workers start (see gunicorn.conf.py).
+"""
+from io import BytesIO
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request, Response
+
+from pycaster.lib import carousel, cdn, routes
+from pycaster.lib.frames import render_digest, render_view_async, render_view_svg
+from pycaster.lib.io import close_async_clients, run_sync
+from pycaster.lib.meroku import get_app_async, get_app_ids_async, rate_app_async
+from pycaster.lib.middleware import FrameContext, check_trusted_data_async
+from pycaster.lib.shared_store import get_asset_store, render_key
+from pycaster.lib.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def prerendered_png(view_type: str, _app, page: int = None):
+  """The view's PNG from the shared asset store if it is current, or None."""
+  store = get_asset_store()
+  mapped = store.current() if store is not None else None
+  if mapped is None:
+    return None
+  key = render_key(view_type, _app['dappId'], page)
+  if (mapped.meta(key) or {}).get('digest') != render_digest(_app):
+    return None
+  png = mapped.get(key)
+  return bytes(png) if png is not None else None
+
+
+class AsyncServices:
+  """The I/O of the routes (see routes.py), on the event loop."""
+
+  async def get_app(self, app_id: str):
+    return await get_app_async(app_id)
+
+  async def get_app_ids(self):
+    return await get_app_ids_async()
+
+  async def rate_app(self, app_id: str, rating: int, fid: int):
+    return await rate_app_async(app_id, rating, fid)
+
+  async def published_url(self, view_type: str, _app, page: int = None):
+    return await run_sync(cdn.published_url, view_type, _app, page)
+
+  async def render_svg(self, view_type: str, _app, page: int = None):
+    # Embeds fitted images, fetched with the sync client.
+    return await run_sync(render_view_svg, view_type, _app, page)
+
+  async def render_png(self, view_type: str, _app) -> bytes:
+    return await render_view_async(view_type, _app)
+
+  async def carousel_page(self, _app, page: int) -> bytes:
+    return await carousel.get_page_async(_app, page)
+
+  def prerendered(self, request, view_type: str, _app, page: int = None):
+    png = prerendered_png(view_type, _app, page)
+    return Response(png, mimetype='image/png') if png is not None else None
+
+
+services = AsyncServices()
+
+
+async def dispatch(request: Request) -> Response:
+  adapter = routes.url_map.bind_to_environ(request.environ)
+  try:
+    endpoint, values = adapter.match()
+    # The FrameContext of a POST, as flask.g.frame is in app.py.
+    frame = FrameContext.parse(request.get_data(), request.is_json) \
+      if request.method == 'POST' else None
+    if not await check_trusted_data_async(request.method, frame):
+      return Response("Request Unauthorized", 403)
+    return await routes.handlers[endpoint](services, request, frame, **values)
+  except HTTPException as e:
+    return e.get_response(request.environ)
+  except Exception:
+    logger.exception("Error handling %s %s", request.method, request.path)
+    return Response("Internal Server Error", 500)
+
+
+def _environ(scope, body: bytes) -> dict:
+  """WSGI environ of an ASGI HTTP scope, for werkzeug's Request."""
+  server = scope.get("server") or ("localhost", 80)
+  environ = {
+    "REQUEST_METHOD": scope["method"],
+    "SCRIPT_NAME": scope.get("root_path", ""),
+    "PATH_INFO": scope["path"],
+    "QUERY_STRING": scope["query_string"].decode("latin-1"),
+    "SERVER_NAME": server[0],
+    "SERVER_PORT": str(server[1]),
+    "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+    "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+    "wsgi.url_scheme": scope.get("scheme", "http"),
+    "wsgi.input": BytesIO(body),
+    "wsgi.errors": BytesIO(),
+    "wsgi.multithread": False,
+    "wsgi.multiprocess": True,
+    "wsgi.run_once": False,
+  }
+  for name, value in scope["headers"]:
+    name = name.decode("latin-1").upper().replace("-", "_")
+    value = value.decode("latin-1")
+    if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+      name = f"HTTP_{name}"
+    environ[name] = f"{environ[name]},{value}" if name in environ else value
+  return environ
+
+
+async def _read_body(receive) -> bytes:
+  body = b""
+  while True:
+    message = await receive()
+    body += message.get("body", b"")
+    if not message.get("more_body"):
+      return body
+
+
+async def _lifespan(receive, send) -> None:
+  while True:
+    message = await receive()
+    if message["type"] == "lifespan.startup":
+      await send({"type": "lifespan.startup.complete"})
+    elif message["type"] == "lifespan.shutdown":
+      await close_async_clients()
+      await send({"type": "lifespan.shutdown.complete"})
+      return
+
+
+async def app(scope, receive, send):
+  if scope["type"] == "lifespan":
+    return await _lifespan(receive, send)
+  if scope["type"] == "websocket":
+    # No websocket routes: closing before accepting rejects the handshake.
+    await receive()
+    await send({"type": "websocket.close"})
+    return
+  if scope["type"] != "http":
+    return
+
+  request = Request(_environ(scope, await _read_body(receive)))
+  response = await dispatch(request)
+  body = b"" if request.method == "HEAD" else response.get_data()
+  await send({
+    "type": "http.response.start",
+    "status": response.status_code,
+    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in response.headers.items()],
+  })
+  await send({"type": "http.response.body", "body": body})
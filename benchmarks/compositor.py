@@ -0,0 +1,85 @@
+"""
+Pillow vs NumPy compositor.
+
+Composes every view of a synthetic app (frame, pre_rate, post_rate and a
+mobile screenshots page) with both backends from the same fetched images,
+reports the median compose and compose + PNG encode times, and compares
+the pixels. Fails if any channel differs by more than --tolerance.
+
+Needs numpy. No network or Redis: external images are generated.
+
+  python benchmarks/compositor.py --runs 50
+"""
+import argparse
+import pathlib
+import statistics
+import sys
+import time
+from io import BytesIO
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from pycaster.lib.frames import (VIEW_FRAME, VIEW_POST_RATE, VIEW_PRE_RATE,  # noqa: E402
+                                 VIEW_SCREENSHOTS, view_components)
+from pycaster.lib.image import compose_app_image  # noqa: E402
+from synthetic_app import APP, fetched_images  # noqa: E402
+
+def timed(fn, runs: int) -> float:
+  samples = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    fn()
+    samples.append((time.perf_counter() - start) * 1000)
+  return statistics.median(samples)
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--runs", type=int, default=30)
+  parser.add_argument("--tolerance", type=int, default=1,
+                      help="Largest per-channel difference allowed between backends.")
+  args = parser.parse_args()
+
+  failed = False
+  print(f"{'view':<14} {'pillow ms':>10} {'numpy ms':>9} {'+png pillow':>12} {'+png numpy':>11}"
+        f" {'max diff':>9} {'px differ':>10}")
+  for view_type, page in ((VIEW_FRAME, None), (VIEW_PRE_RATE, None), (VIEW_POST_RATE, None),
+                          (VIEW_SCREENSHOTS, 0)):
+    components, base_path = view_components(view_type, APP, page)
+    base = Image.open(base_path)
+    base.load()
+    images = fetched_images(components)
+
+    outputs = {}
+    times = {}
+    for backend in ("pillow", "numpy"):
+      def compose():
+        return compose_app_image(base.copy(), components, images, backend=backend,
+                                 template_key=str(base_path))
+
+      def compose_encode():
+        compose().save(BytesIO(), format="PNG")
+
+      outputs[backend] = compose()
+      times[backend] = (timed(compose, args.runs), timed(compose_encode, max(args.runs // 5, 3)))
+
+    diff = np.abs(np.asarray(outputs["pillow"], dtype=np.int16) -
+                  np.asarray(outputs["numpy"], dtype=np.int16))
+    max_diff = int(diff.max())
+    failed |= max_diff > args.tolerance
+    label = view_type if page is None else f"{view_type}/{page}"
+    print(f"{label:<14} {times['pillow'][0]:>10.2f} {times['numpy'][0]:>9.2f}"
+          f" {times['pillow'][1]:>12.2f} {times['numpy'][1]:>11.2f}"
+          f" {max_diff:>9} {int((diff.max(axis=2) > 0).sum()):>10}")
+
+  if failed:
+    print(f"Backends differ by more than {args.tolerance}", file=sys.stderr)
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
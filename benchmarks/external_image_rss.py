@@ -0,0 +1,130 @@
+"""
+Peak RSS of rendering a large external image into a frame.
+
+Serves synthetic JPEG and PNG images from a local HTTP server and, for each,
+runs one logo render in a fresh interpreter with the bounded loader
+(`load_external_image`) and with the previous unbounded approach (read the
+whole body, decode at full size, then resize). Prints each run's peak RSS
+over that of an interpreter that imports the same modules and renders
+nothing. Peak RSS is read from VmHWM, as ru_maxrss survives exec and would
+report this script's own peak. Linux only.
+
+  python benchmarks/external_image_rss.py
+"""
+import argparse
+import http.server
+import json
+import pathlib
+import subprocess
+import sys
+import threading
+from io import BytesIO
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+CASES = {
+  "jpeg_6000x4000": ("JPEG", (6000, 4000)),
+  "png_6000x5000": ("PNG", (6000, 5000)),
+  "png_4000x4000": ("PNG", (4000, 4000)),
+  "jpeg_1200x1200": ("JPEG", (1200, 1200)),
+}
+
+CHILD = """
+import json, sys
+sys.path.insert(0, {root!r})
+from io import BytesIO
+import requests
+from PIL import Image
+from pycaster.lib.image import insert_picture_circle
+from pycaster.lib.io import load_external_image
+
+base = Image.new("RGBA", (955, 500))
+img = None
+if {mode!r} == "bounded":
+  img = load_external_image({url!r})
+elif {mode!r} == "unbounded":
+  img = Image.open(BytesIO(requests.get({url!r}).content)).convert("RGBA")
+if img is not None:
+  insert_picture_circle(base, img, (100, 100), 60)
+with open("/proc/self/status") as f:
+  hwm = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+print(json.dumps({{
+  "peak_rss_kb": hwm,
+  "decoded": list(img.size) if img is not None else None,
+}}))
+"""
+
+
+def make_image(fmt: str, size) -> bytes:
+  from PIL import Image, ImageDraw
+  img = Image.new("RGB", size, (40, 90, 200))
+  draw = ImageDraw.Draw(img)
+  for x in range(0, size[0], 50):
+    draw.line((x, 0, size[0] - x, size[1]), fill=(x % 255, 120, 30), width=7)
+  out = BytesIO()
+  img.save(out, format=fmt, quality=90)
+  return out.getvalue()
+
+
+def serve(images):
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      body = images.get(self.path.strip("/"))
+      if body is None:
+        self.send_error(404)
+        return
+      self.send_response(200)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+  args = parser.parse_args()
+
+  images = {name: make_image(fmt, size) for name, (fmt, size) in CASES.items()}
+  server = serve(images)
+  base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+  def run(mode: str, url: str = "") -> dict:
+    code = CHILD.format(root=str(ROOT), mode=mode, url=url)
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if proc.returncode != 0:
+      return {"error": proc.stderr.strip().splitlines()[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+  baseline = min(run("none")["peak_rss_kb"] for _ in range(3))
+  results = {}
+  for name in CASES:
+    for mode in ("unbounded", "bounded"):
+      result = run(mode, f"{base_url}/{name}")
+      if "peak_rss_kb" in result:
+        result["peak_rss_delta_kb"] = result["peak_rss_kb"] - baseline
+      results[f"{name}/{mode}"] = result
+  server.shutdown()
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+    return 0
+  print(f"{'case':<28} {'body KB':>8} {'peak RSS +MB':>13}  decoded")
+  for key, result in results.items():
+    body_kb = len(images[key.split("/")[0]]) // 1024
+    if "error" in result:
+      print(f"{key:<28} {body_kb:>8} {'error':>13}  {result['error']}")
+      continue
+    print(f"{key:<28} {body_kb:>8} {result['peak_rss_delta_kb'] / 1024:>13.1f}  "
+          f"{result['decoded'][0]}x{result['decoded'][1]}")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Import-time report for the frame app.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter, prints
+the slowest modules by cumulative time and fails if a module that should be
+lazily imported (openai, boto3, ...) was pulled in at startup, or if the
+total import time exceeds the budget.
+
+  python benchmarks/import_time.py --top 20 --max-ms 400
+"""
+import argparse
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+LAZY_MODULES = ["openai", "boto3", "botocore", "redis", "numpy", "cairosvg"]
+
+
+def collect(target: str):
+  """
+  Returns a list of (module, self_us, cumulative_us, depth) tuples in the
+  order the interpreter reported them.
+  """
+  proc = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+    cwd=ROOT, capture_output=True, text=True, check=True
+  )
+  rows = []
+  for line in proc.stderr.splitlines():
+    if not line.startswith("import time:") or "self [us]" in line:
+      continue
+    parts = line[len("import time:"):].split("|")
+    self_us, cumulative_us, name = int(parts[0]), int(parts[1]), parts[2]
+    depth = (len(name) - len(name.lstrip())) // 2
+    rows.append((name.strip(), self_us, cumulative_us, depth))
+  return rows
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--target", default="app")
+  parser.add_argument("--top", type=int, default=15)
+  parser.add_argument("--max-ms", type=float, default=None,
+                      help="Fail if importing the target takes longer than this.")
+  parser.add_argument("--forbid", nargs="*", default=LAZY_MODULES,
+                      help="Top-level packages that must not be imported eagerly.")
+  args = parser.parse_args()
+
+  rows = collect(args.target)
+  total_us = next(c for name, _, c, _ in reversed(rows) if name == args.target)
+
+  print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+  for name, self_us, cumulative_us, depth in sorted(rows, key=lambda x: -x[2])[:args.top]:
+    print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {'  ' * depth}{name}")
+  print(f"\nimport {args.target}: {total_us / 1000:.1f} ms, {len(rows)} modules")
+
+  failed = False
+  loaded = {name.split(".")[0] for name, *_ in rows}
+  eager = sorted(set(args.forbid) & loaded)
+  if eager:
+    print(f"FAIL: imported eagerly: {', '.join(eager)}")
+    failed = True
+  if args.max_ms is not None and total_us / 1000 > args.max_ms:
+    print(f"FAIL: import took longer than {args.max_ms} ms")
+    failed = True
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+json vs orjson on what the app stores in Redis.
+
+Encodes and decodes, with both, the objects the app keeps in Redis and the
+frame bodies it parses:
+
+  catalog/app       one app record, as in the catalog hash (get_app)
+  catalog/apps      every app record, one by one (fetch_apps)
+  catalog/index     the list of app ids
+  user_data         a Neynar user
+  followers         a page of 150 followers, as get_followers caches it
+  frame_payload     a frame POST body
+
+and reports the median time of each, then checks that values written by
+either codec read back the same with the other (existing keys were written
+with json).
+
+The catalog is the real one when there is one: a Meroku response or list
+of apps saved to a file (--catalog), or the catalog in Redis (--redis).
+Otherwise a seeded fake_services catalog of --apps apps is used. Needs
+orjson.
+
+  python benchmarks/json_codec.py --catalog apps.json --runs 200
+"""
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import orjson  # noqa: E402
+
+from fake_services import Fixtures  # noqa: E402
+
+CODECS = {
+  "json": (lambda obj: json.dumps(obj).encode(), json.loads),
+  "orjson": (lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads),
+}
+
+
+def load_catalog(args) -> list:
+  if args.catalog:
+    data = json.loads(args.catalog.read_text())
+    return data["data"] if isinstance(data, dict) else data
+  if args.redis:
+    from pycaster.lib.meroku import fetch_apps
+    apps = fetch_apps()
+    if not apps:
+      sys.exit("No catalog in Redis")
+    return apps
+  return Fixtures("http://localhost", seed=0, apps=args.apps).apps()
+
+
+def objects(apps: list) -> dict:
+  fixtures = Fixtures("http://localhost", seed=0)
+  return {
+    "catalog/app": [apps[len(apps) // 2]],
+    "catalog/apps": apps,
+    "catalog/index": [[a["dappId"] for a in apps]],
+    "user_data": [fixtures.user_v2(1234)],
+    "followers": [[fixtures.user_v1(fid) for fid in range(1000, 1150)]],
+    "frame_payload": [{
+      "untrustedData": {"fid": 1234, "url": "https://example.com/action/app", "messageHash":
+                        "0x" + os.urandom(20).hex(), "timestamp": int(time.time() * 1000),
+                        "network": 1, "buttonIndex": 2,
+                        "castId": {"fid": 5678, "hash": "0x" + os.urandom(20).hex()}},
+      "trustedData": {"messageBytes": os.urandom(170).hex()},
+    }],
+  }
+
+
+def median_us(fn, items: list, runs: int) -> float:
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    for item in items:
+      fn(item)
+    times.append(time.perf_counter() - start)
+  return statistics.median(times) * 1e6
+
+
+def check_compatible(cases: dict) -> list:
+  """Names of the cases whose values do not read back the same across codecs."""
+  broken = []
+  for name, items in cases.items():
+    for item in items:
+      expected = json.loads(json.dumps(item))
+      if any(loads(dumps(item)) != expected for dumps, _ in CODECS.values()
+             for _, loads in CODECS.values()):
+        broken.append(name)
+        break
+  return broken
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--catalog", type=pathlib.Path,
+                      help="A Meroku response or a JSON list of apps.")
+  parser.add_argument("--redis", action="store_true", help="Use the catalog stored in Redis.")
+  parser.add_argument("--apps", type=int, default=200, help="Size of the fake catalog.")
+  parser.add_argument("--runs", type=int, default=100)
+  args = parser.parse_args()
+
+  apps = load_catalog(args)
+  cases = objects(apps)
+  print(f"{len(apps)} apps, {len(json.dumps(apps)) // 1024} KB as JSON")
+  print(f"  {'case':<16} {'bytes':>9} {'op':<7} {'json us':>9} {'orjson us':>10} {'speedup':>8}")
+  for name, items in cases.items():
+    size = sum(len(json.dumps(item)) for item in items)
+    encoded = {codec: [dumps(item) for item in items] for codec, (dumps, _) in CODECS.items()}
+    for op in ("dumps", "loads"):
+      timings = {}
+      for codec, (dumps, loads) in CODECS.items():
+        if op == "dumps":
+          timings[codec] = median_us(dumps, items, args.runs)
+        else:
+          # Both decode what json wrote, as in keys written before the switch.
+          timings[codec] = median_us(loads, encoded["json"], args.runs)
+      print(f"  {name:<16} {size:>9} {op:<7} {timings['json']:>9.1f} {timings['orjson']:>10.1f}"
+            f" {timings['json'] / timings['orjson']:>7.1f}x")
+
+  broken = check_compatible(cases)
+  if broken:
+    print(f"Values that do not read back the same: {', '.join(broken)}", file=sys.stderr)
+    return 1
+  print("Values read back the same with either codec")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Load test of the frame flow under gunicorn.
+
+Starts fake_services, then for every worker model (sync, gthread, gevent,
+and uvicorn, which serves the async mode of asgi.py), worker count and concurrency starts gunicorn on the app and replays the
+frame flow from `--concurrency` simulated users for `--duration` seconds:
+
+  GET /, the frame image, POST /action with buttonIndex 1-4 (and the
+  images they lead to), POST /rate and POST /thanks
+
+Requests carry frame payloads shaped like the ones Warpcast sends. Reports
+throughput and p50 / p95 / p99 per route:
+
+  python benchmarks/load_test.py --models sync gthread gevent --workers 2 4 \\
+    --concurrency 8 32 --duration 20 --json load.json
+
+Needs Redis. The catalog version keys are dropped first, so the app loads
+the catalog from the fake Meroku; use a Redis that holds nothing else of
+value. The gevent model needs `pip install gevent`.
+"""
+import argparse
+import json
+import os
+import pathlib
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+META = re.compile(rb'<meta property="(fc:frame:[a-z_]+)" content="([^"]*)"')
+CATALOG_KEYS = ("farcaster:apps:version", "farcaster:apps:fresh", "farcaster:apps:lock")
+
+
+def wait_until_up(url: str, timeout: float = 30) -> None:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      requests.get(url, timeout=2)
+      return
+    except requests.RequestException:
+      time.sleep(0.2)
+  raise RuntimeError(f"{url} did not come up")
+
+
+def frame_payload(fid: int, button_index: int, url: str) -> dict:
+  """
+  A frame action as Warpcast posts it. messageBytes has the length of a
+  real signed message; the fake hub accepts anything.
+  """
+  return {
+    "untrustedData": {
+      "fid": fid,
+      "url": url,
+      "messageHash": "0x" + os.urandom(20).hex(),
+      "timestamp": int(time.time() * 1000),
+      "network": 1,
+      "buttonIndex": button_index,
+      "castId": {"fid": random.randint(1, 500_000), "hash": "0x" + os.urandom(20).hex()},
+    },
+    "trustedData": {"messageBytes": os.urandom(random.randint(140, 200)).hex()},
+  }
+
+
+class Recorder:
+  def __init__(self) -> None:
+    self.samples = defaultdict(list)
+    self.errors = defaultdict(int)
+    self._lock = threading.Lock()
+
+  def add(self, route: str, ms: float, ok: bool) -> None:
+    with self._lock:
+      self.samples[route].append(ms)
+      if not ok:
+        self.errors[route] += 1
+
+
+def _percentile(samples, fraction: float) -> float:
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class User:
+  """One simulated user walking through the frame flow."""
+
+  def __init__(self, base_url: str, recorder: Recorder, fid: int) -> None:
+    self.base_url = base_url
+    self.recorder = recorder
+    self.fid = fid
+    self.session = requests.Session()
+
+  def _request(self, route: str, method: str, path: str, **kwargs):
+    start = time.perf_counter()
+    try:
+      response = self.session.request(method, self.base_url + path, allow_redirects=False,
+                                      timeout=30, **kwargs)
+      ok = response.status_code < 400
+    except requests.RequestException:
+      response, ok = None, False
+    self.recorder.add(route, (time.perf_counter() - start) * 1000, ok)
+    return response
+
+  def _frame(self, route: str, path: str, button_index: int):
+    """Posts a button and fetches the image of the frame that comes back."""
+    response = self._request(route, "POST", path,
+                             json=frame_payload(self.fid, button_index, self.base_url + path))
+    return self._follow(response)
+
+  def _follow(self, response):
+    if response is None or response.status_code != 200:
+      return None
+    meta = {k.decode(): v.decode() for k, v in META.findall(response.content)}
+    image = meta.get("fc:frame:image")
+    if image:
+      path = re.sub(r"^https?://[^/]+", "", image)
+      if path.startswith(("/frame/image", "/image", "/screenshots/image")):
+        # Grouped by kind of image, not by app.
+        self._request(f"GET {'/'.join(path.split('/')[:3])}", "GET", path)
+      # Anything else is published to the CDN and not served by the app.
+    return meta
+
+  def run_flow(self) -> None:
+    meta = self._follow(self._request("GET /", "GET", "/"))
+    if not meta or "fc:frame:post_url" not in meta:
+      return
+    app_id = meta["fc:frame:post_url"].rstrip("/").split("/")[-1]
+
+    meta = self._frame("POST /action 1", f"/action/{app_id}", 1) or {}
+    if "fc:frame:post_url" in meta:
+      app_id = meta["fc:frame:post_url"].rstrip("/").split("/")[-1]
+    self._request("POST /action 2", "POST", f"/action/{app_id}",
+                  json=frame_payload(self.fid, 2, f"{self.base_url}/action/{app_id}"))
+    self._frame("POST /action 3", f"/action/{app_id}", 3)
+    self._frame("POST /rate", f"/rate/{app_id}", random.randint(1, 3))
+    self._frame("POST /thanks", f"/thanks/{app_id}", 1)
+    self._frame("POST /action 4", f"/action/{app_id}", 4)
+
+
+def run_load(base_url: str, concurrency: int, duration: float) -> Recorder:
+  recorder = Recorder()
+  deadline = time.monotonic() + duration
+
+  def loop(idx: int) -> None:
+    user = User(base_url, recorder, fid=10_000 + idx)
+    while time.monotonic() < deadline:
+      user.run_flow()
+
+  threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return recorder
+
+
+def summarize(recorder: Recorder, duration: float) -> dict:
+  routes = {}
+  everything = []
+  for route, samples in sorted(recorder.samples.items()):
+    samples = sorted(samples)
+    everything += samples
+    routes[route] = {
+      "count": len(samples),
+      "errors": recorder.errors[route],
+      "rps": len(samples) / duration,
+      "p50_ms": statistics.median(samples),
+      "p95_ms": _percentile(samples, 0.95),
+      "p99_ms": _percentile(samples, 0.99),
+    }
+  everything.sort()
+  total = {
+    "count": len(everything),
+    "errors": sum(recorder.errors.values()),
+    "rps": len(everything) / duration,
+    "p50_ms": statistics.median(everything) if everything else None,
+    "p95_ms": _percentile(everything, 0.95) if everything else None,
+    "p99_ms": _percentile(everything, 0.99) if everything else None,
+  }
+  return {"routes": routes, "total": total}
+
+
+def print_summary(label: str, summary: dict) -> None:
+  print(f"\n{label}")
+  print(f"  {'route':<28} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}"
+        f" {'p99 ms':>8}")
+  for route, s in list(summary["routes"].items()) + [("total", summary["total"])]:
+    if not s["count"]:
+      continue
+    print(f"  {route:<28} {s['count']:>7} {s['errors']:>7} {s['rps']:>8.1f} {s['p50_ms']:>8.1f}"
+          f" {s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f}")
+
+
+def gunicorn_command(model: str, workers: int, threads: int, connections: int, port: int) -> list:
+  entry = "asgi:app" if model == "uvicorn" else "app:app"
+  command = [sys.executable, "-m", "gunicorn", entry, "-w", str(workers),
+             "-b", f"127.0.0.1:{port}", "--log-level", "warning"]
+  if model != "gevent":
+    # As in the Dockerfile. gevent workers must import the app after they
+    # monkey patch, or locks built at import block the whole worker.
+    command.append("--preload")
+  if model == "gthread":
+    command += ["-k", "gthread", "--threads", str(threads)]
+  elif model == "gevent":
+    command += ["-k", "gevent", "--worker-connections", str(connections)]
+  elif model == "uvicorn":
+    command += ["-k", "uvicorn.workers.UvicornWorker"]
+  return command
+
+
+def reset_catalog() -> None:
+  import redis
+  client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"),
+                       port=int(os.getenv("REDIS_PORT", 6379)),
+                       username=os.getenv("REDIS_USERNAME"), password=os.getenv("REDIS_PASSWORD"))
+  client.delete(*CATALOG_KEYS)
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--models", nargs="+", default=["sync", "gthread", "gevent", "uvicorn"],
+                      choices=["sync", "gthread", "gevent", "uvicorn"])
+  parser.add_argument("--workers", nargs="+", type=int, default=[2])
+  parser.add_argument("--threads", type=int, default=8, help="Threads per gthread worker.")
+  parser.add_argument("--worker-connections", type=int, default=100,
+                      help="Connections per gevent worker.")
+  parser.add_argument("--concurrency", nargs="+", type=int, default=[8])
+  parser.add_argument("--duration", type=float, default=20, help="Seconds per run.")
+  parser.add_argument("--warmup", type=float, default=5,
+                      help="Seconds of load before each measured run.")
+  parser.add_argument("--port", type=int, default=9391)
+  parser.add_argument("--fake-port", type=int, default=8901)
+  parser.add_argument("--fake-latency", default="default=lognormal:40:0.5,images=lognormal:60:0.6",
+                      help="Latency rules of the stand-ins, see fake_services/faults.py.")
+  parser.add_argument("--fake-errors", default="")
+  parser.add_argument("--apps", type=int, default=50)
+  parser.add_argument("--json", type=pathlib.Path, help="Write all results here.")
+  args = parser.parse_args()
+
+  fake_url = f"http://127.0.0.1:{args.fake_port}"
+  fake = subprocess.Popen([sys.executable, "-m", "fake_services", "--port", str(args.fake_port),
+                           "--apps", str(args.apps), "--latency", args.fake_latency,
+                           "--errors", args.fake_errors],
+                          cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  env = dict(os.environ, MEROKU_API_URL=fake_url, NEYNAR_API_URL=fake_url,
+             NEYNAR_HUB_URL=fake_url, MEROKU_API_KEY=os.getenv("MEROKU_API_KEY", "load-test"),
+             NEYNAR_API_KEY=os.getenv("NEYNAR_API_KEY", "load-test"), LOG_LEVEL="WARNING")
+  base_url = f"http://127.0.0.1:{args.port}"
+  results = []
+  try:
+    wait_until_up(f"{fake_url}/_fake/config")
+    reset_catalog()
+    for model in args.models:
+      if model in ("gevent", "uvicorn"):
+        try:
+          __import__(model)
+        except ImportError:
+          print(f"{model} is not installed, skipping the {model} model", file=sys.stderr)
+          continue
+      for workers in args.workers:
+        server = subprocess.Popen(gunicorn_command(model, workers, args.threads,
+                                                   args.worker_connections, args.port),
+                                  cwd=ROOT, env=env)
+        try:
+          wait_until_up(base_url)
+          if args.warmup:
+            run_load(base_url, max(args.concurrency), args.warmup)
+          for concurrency in args.concurrency:
+            summary = summarize(run_load(base_url, concurrency, args.duration), args.duration)
+            label = f"{model} workers={workers}" + \
+              (f" threads={args.threads}" if model == "gthread" else "") + \
+              f" concurrency={concurrency}"
+            print_summary(label, summary)
+            results.append({"model": model, "workers": workers, "threads": args.threads,
+                            "concurrency": concurrency, "duration": args.duration, **summary})
+        finally:
+          server.send_signal(signal.SIGTERM)
+          server.wait(timeout=30)
+  finally:
+    fake.terminate()
+    fake.wait(timeout=10)
+
+  if args.json:
+    args.json.write_text(json.dumps(results, indent=2))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
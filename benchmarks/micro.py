@@ -0,0 +1,204 @@
+"""
+Micro-benchmarks of the render and data hot paths.
+
+  generate_app_image/{frame,pre_rate,post_rate}   full render + PNG, warm caches
+  write_multiline_text/{short,long}               warm text layer cache
+  write_multiline_text/long_cold                  text layer cache cleared
+  get_external_image/{hit,miss}                   miss = download, decode, cache
+  catalog/get_app_ids, catalog/get_app            catalog reads, as the routes make them
+  validate_request                                one hub round trip
+
+Fixtures are fixed: a seeded fake_services catalog, served (with its images
+and the hub) from a local thread with no injected latency. Needs Redis
+(REDIS_HOST / REDIS_PORT); the catalog and image keys it writes are the
+app's own.
+
+Results are written as JSON. With a baseline, any case slower than it by
+more than --tolerance (and --min-delta-ms) fails the run. Cases are compared
+on their fastest run by default, which is far less noisy than the median on
+a busy machine (--metric median_ms compares medians):
+
+  python benchmarks/micro.py --save-baseline      # on a known good tree
+  python benchmarks/micro.py                      # compares, exit 1 on regression
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from fake_services import Faults, Fixtures, create_app  # noqa: E402
+
+DEFAULT_BASELINE = ROOT / "benchmarks" / "baseline.json"
+
+
+def start_fake_services(apps: int) -> str:
+  logging.getLogger("werkzeug").setLevel(logging.WARNING)
+  server = make_server("127.0.0.1", 0, None, threaded=True)
+  base_url = f"http://127.0.0.1:{server.server_port}"
+  server.app = create_app(Fixtures(base_url, seed=0, apps=apps), Faults(seed=0))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return base_url
+
+
+def measure(fn, min_runs: int, budget: float, setup=None) -> dict:
+  """
+  Calls `fn` at least `min_runs` times and until `budget` seconds are
+  spent. `setup` runs untimed before each call.
+  """
+  if setup:
+    setup()
+  fn()  # warm up
+  samples = []
+  started = time.perf_counter()
+  while len(samples) < min_runs or time.perf_counter() - started < budget:
+    if setup:
+      setup()
+    start = time.perf_counter()
+    fn()
+    samples.append((time.perf_counter() - start) * 1000)
+    if len(samples) >= 10_000:
+      break
+  samples.sort()
+  return {
+    "median_ms": statistics.median(samples),
+    "p90_ms": samples[int(len(samples) * 0.9)],
+    "min_ms": samples[0],
+    "runs": len(samples),
+  }
+
+
+def cases():
+  """Yields (name, fn, setup) for every benchmark."""
+  from PIL import Image
+
+  from pycaster.lib.frames import VIEW_FRAME, VIEW_POST_RATE, VIEW_PRE_RATE, view_components
+  from pycaster.lib.image import generate_app_image, write_multiline_text_to_image
+  from pycaster.lib.io import get_external_image, r_cache
+  from pycaster.lib.meroku import fetch_catalog, get_app, get_app_ids, store_catalog
+  from pycaster.lib.middleware import validate_request
+  from pycaster.lib.text_layers import text_layer_cache
+
+  apps = fetch_catalog()
+  store_catalog(apps)
+  _app = apps[1]
+
+  for view_type in (VIEW_FRAME, VIEW_PRE_RATE, VIEW_POST_RATE):
+    components, base_path = view_components(view_type, _app)
+    yield (f"generate_app_image/{view_type}",
+           lambda c=components, p=base_path: generate_app_image(c, p), None)
+
+  font_path = ROOT / "pycaster" / "lib" / "Inter-Medium.ttf"
+  canvas = Image.open(ROOT / "pycaster" / "lib" / "background.png").convert("RGBA")
+  texts = {"short": _app["name"], "long": " ".join(a["description"] for a in apps[:4])}
+  for label, text in texts.items():
+    yield (f"write_multiline_text/{label}",
+           lambda t=text: write_multiline_text_to_image(canvas.copy(), t, (0, 150), font_path, 30),
+           None)
+  yield ("write_multiline_text/long_cold",
+         lambda: write_multiline_text_to_image(canvas.copy(), texts["long"], (0, 150), font_path, 30),
+         text_layer_cache.clear)
+
+  logo = _app["images"]["logo"]
+  yield "get_external_image/hit", lambda: get_external_image(logo), None
+  yield ("get_external_image/miss", lambda: get_external_image(logo),
+         lambda: r_cache.delete(f"pfp:test1:{logo}"))
+
+  yield "catalog/get_app_ids", get_app_ids, None
+  app_ids = [a["dappId"] for a in apps]
+  yield "catalog/get_app", lambda: get_app(app_ids[len(app_ids) // 2]), None
+
+  payload = {"untrustedData": {"fid": 1234}, "trustedData": {"messageBytes": b"1234".hex()}}
+  yield "validate_request", lambda: validate_request(payload), None
+
+
+def compare(results: dict, baseline: dict, metric: str, tolerance: float,
+            min_delta_ms: float) -> list:
+  regressions = []
+  for name, result in results.items():
+    before = baseline.get(name)
+    if before is None:
+      continue
+    delta = result[metric] - before[metric]
+    if delta > min_delta_ms and result[metric] > before[metric] * (1 + tolerance):
+      regressions.append((name, before[metric], result[metric]))
+  return regressions
+
+
+def environment() -> dict:
+  from PIL import __version__ as pillow_version
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                            capture_output=True, text=True).stdout.strip()
+  except OSError:
+    commit = None
+  return {"python": platform.python_version(), "pillow": pillow_version,
+          "machine": platform.machine(), "commit": commit}
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--only", help="Run the cases whose name contains this.")
+  parser.add_argument("--budget", type=float, default=0.5, help="Seconds per case.")
+  parser.add_argument("--min-runs", type=int, default=10)
+  parser.add_argument("--apps", type=int, default=200, help="Apps in the catalog fixture.")
+  parser.add_argument("--output", type=pathlib.Path, help="Write the results JSON here.")
+  parser.add_argument("--baseline", type=pathlib.Path, default=DEFAULT_BASELINE)
+  parser.add_argument("--save-baseline", action="store_true",
+                      help="Store the results as the baseline instead of comparing.")
+  parser.add_argument("--metric", choices=("min_ms", "median_ms", "p90_ms"), default="min_ms")
+  parser.add_argument("--tolerance", type=float, default=0.25,
+                      help="Allowed slowdown, as a fraction.")
+  parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                      help="Ignore slowdowns smaller than this, which are noise.")
+  args = parser.parse_args()
+
+  # The app reads its upstream URLs at import.
+  fixtures_url = start_fake_services(args.apps)
+  for name in ("MEROKU_API_URL", "NEYNAR_API_URL", "NEYNAR_HUB_URL"):
+    os.environ[name] = fixtures_url
+  os.environ.setdefault("MEROKU_API_KEY", "benchmark")
+  os.environ.setdefault("NEYNAR_API_KEY", "benchmark")
+  # setup_logger sets each pycaster logger's level from this at import.
+  os.environ["LOG_LEVEL"] = "WARNING"
+
+  results = {}
+  print(f"{'case':<36} {'min ms':>9} {'median ms':>10} {'p90 ms':>9} {'runs':>6}")
+  for name, fn, setup in cases():
+    if args.only and args.only not in name:
+      continue
+    results[name] = measure(fn, args.min_runs, args.budget, setup)
+    r = results[name]
+    print(f"{name:<36} {r['min_ms']:>9.3f} {r['median_ms']:>10.3f} {r['p90_ms']:>9.3f} {r['runs']:>6}")
+
+  report = {"environment": environment(), "results": results}
+  if args.output:
+    args.output.write_text(json.dumps(report, indent=2))
+  if args.save_baseline:
+    args.baseline.write_text(json.dumps(report, indent=2))
+    print(f"Saved baseline to {args.baseline}")
+    return 0
+  if not args.baseline.exists():
+    print(f"No baseline at {args.baseline}, run with --save-baseline first", file=sys.stderr)
+    return 0
+
+  regressions = compare(results, json.loads(args.baseline.read_text())["results"],
+                        args.metric, args.tolerance, args.min_delta_ms)
+  for name, before, after in regressions:
+    print(f"REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms", file=sys.stderr)
+  return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
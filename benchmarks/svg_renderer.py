@@ -0,0 +1,102 @@
+"""
+SVG renderer vs Pillow renderer.
+
+For every view of the synthetic app from benchmarks/synthetic_app.py, times:
+
+  pillow      compose + PNG encode (what a cache miss costs today)
+  svg         filling the SVG templates (what ?format=svg costs)
+  hash        hashing the SVG, the cost of a rasterization cache hit
+  cairo       rasterizing the SVG to PNG, if cairosvg and libcairo are
+              installed
+
+No network or Redis: external images are generated and embedded.
+
+  python benchmarks/svg_renderer.py --runs 50
+"""
+import argparse
+import base64
+import pathlib
+import statistics
+import sys
+import time
+from io import BytesIO
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from pycaster.lib.frames import (VIEW_FRAME, VIEW_POST_RATE, VIEW_PRE_RATE,  # noqa: E402
+                                 VIEW_SCREENSHOTS, view_components)
+from pycaster.lib.image import compose_app_image, create_text_svg  # noqa: E402
+from pycaster.lib.svg import build_svg, cairo_available, svg_hash  # noqa: E402
+from synthetic_app import APP, fetched_images  # noqa: E402
+
+
+def timed(fn, runs: int) -> float:
+  samples = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    fn()
+    samples.append((time.perf_counter() - start) * 1000)
+  return statistics.median(samples)
+
+
+def data_uri(img, box) -> str:
+  # What the fitted image cache holds.
+  if img.size != tuple(box):
+    img = img.convert("RGBA").resize(box)
+  out = BytesIO()
+  img.save(out, format="PNG")
+  return "data:image/png;base64," + base64.b64encode(out.getvalue()).decode()
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--runs", type=int, default=30)
+  args = parser.parse_args()
+
+  from PIL import Image
+  cairo = cairo_available()
+  if cairo:
+    import cairosvg
+
+  print(f"{'view':<14} {'pillow ms':>10} {'svg ms':>7} {'hash ms':>8} {'cairo ms':>9}"
+        f" {'png KB':>7} {'svg KB':>7}")
+  for view_type, page in ((VIEW_FRAME, None), (VIEW_PRE_RATE, None), (VIEW_POST_RATE, None),
+                          (VIEW_SCREENSHOTS, 0)):
+    components, base_path = view_components(view_type, APP, page)
+    base = Image.open(base_path)
+    base.load()
+    images = fetched_images(components)
+    hrefs = [None if img is None else
+             data_uri(img, (c.circle_radius * 2,) * 2 if c.display_type == "circle" else c.rect_size)
+             for c, img in zip(components, images)]
+
+    def pillow():
+      out = BytesIO()
+      compose_app_image(base.copy(), components, images).save(out, format="PNG")
+      return out
+
+    def svg():
+      return build_svg(components, base_path, hrefs)
+
+    document = svg()
+    pillow_ms = timed(pillow, max(args.runs // 5, 3))
+    svg_ms = timed(svg, args.runs)
+    hash_ms = timed(lambda: svg_hash(document), args.runs)
+    cairo_ms = "n/a"
+    if cairo:
+      cairo_ms = f"{timed(lambda: cairosvg.svg2png(bytestring=document.encode()), max(args.runs // 5, 3)):.2f}"
+
+    label = view_type if page is None else f"{view_type}/{page}"
+    print(f"{label:<14} {pillow_ms:>10.2f} {svg_ms:>7.2f} {hash_ms:>8.2f} {cairo_ms:>9}"
+          f" {len(pillow().getvalue()) // 1024:>7} {len(document) // 1024:>7}")
+
+  text = "Hello World\nSecond Line\nThird Line"
+  print(f"\ncreate_text_svg: {timed(lambda: create_text_svg(text), args.runs * 10) * 1000:.0f}us")
+  if not cairo:
+    print("cairo not available, rasterization not measured", file=sys.stderr)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
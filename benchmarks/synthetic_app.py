@@ -0,0 +1,42 @@
+"""
+The synthetic app the renderer benchmarks draw, and the images they draw it
+with: generated, so no network or Redis is needed.
+"""
+from PIL import Image, ImageDraw
+
+from pycaster.lib.image import ImageComponent
+from pycaster.lib.io import fit_size
+
+APP = {
+  "dappId": "bench",
+  "name": "Uniswap",
+  "description": "Swap, earn, and build on the leading decentralized crypto trading protocol. "
+                 "Millions of users trust it every day.",
+  "images": {
+    "logo": "https://example.invalid/logo.png",
+    "mobileScreenshots": [f"https://example.invalid/m{i}.png" for i in range(3)],
+  },
+}
+
+
+def synthetic(size, seed: int) -> Image.Image:
+  img = Image.new("RGB", size, (20 + seed * 40, 90, 200))
+  draw = ImageDraw.Draw(img)
+  for x in range(0, size[0], 24):
+    draw.line((x, 0, size[0] - x, size[1]), fill=(240, 120 + seed * 30, 30), width=5)
+  return img
+
+
+def fetched_images(components):
+  # What get_external_images returns: logos as cached (<= 800px) and
+  # rectangles already fitted to their box.
+  images = []
+  for i, c in enumerate(components):
+    if c.component_type != ImageComponent.EXTERNAL_IMAGE:
+      images.append(None)
+    elif c.display_type == ImageComponent.DISPLAY_TYPE_RECTANGLE:
+      original = synthetic((1080, 1920), i)
+      images.append(original.convert("RGBA").resize(fit_size(original.size, c.rect_size)))
+    else:
+      images.append(synthetic((800, 800), i))
+  return images
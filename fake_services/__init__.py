@@ -0,0 +1,24 @@
+"""
+Local stand-ins for Meroku, Neynar and the hosts serving logos and
+screenshots, for benchmarks and load tests that must not hit the real
+services.
+
+  python -m fake_services --port 8900 --latency "default=lognormal:40:0.6"
+
+and run the app against it with
+
+  MEROKU_API_URL=http://localhost:8900
+  NEYNAR_API_URL=http://localhost:8900
+  NEYNAR_HUB_URL=http://localhost:8900
+
+Catalog logos and screenshots point at the same server. See faults.py for
+the latency and error rules, which can also be changed while running:
+
+  curl -X POST localhost:8900/_fake/config -H 'Content-Type: application/json' \
+    -d '{"errors": "validate_message=0.05:503"}'
+"""
+from .faults import Faults
+from .fixtures import Fixtures
+from .server import create_app
+
+__all__ = ["Faults", "Fixtures", "create_app"]
@@ -0,0 +1,38 @@
+import argparse
+import os
+
+from . import Faults, Fixtures, create_app
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(prog="python -m fake_services",
+                                   description="Serve fake Meroku, Neynar and image hosts.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8900)
+  parser.add_argument("--public-url",
+                      help="Base URL catalog images point at (default http://HOST:PORT).")
+  parser.add_argument("--latency", default=os.getenv("FAKE_LATENCY", ""),
+                      help='Latency rules, ex: "default=lognormal:40:0.6,images=const:10".')
+  parser.add_argument("--errors", default=os.getenv("FAKE_ERRORS", ""),
+                      help='Error rules, ex: "default=0.01,followers=0.05:429".')
+  parser.add_argument("--page-size", type=int,
+                      help="Cap every paginated route at this many items per page.")
+  parser.add_argument("--apps", type=int, default=20, help="Apps in the catalog.")
+  parser.add_argument("--followers", type=int, default=300, help="Followers (and following) per fid.")
+  parser.add_argument("--channel-followers", type=int, default=3000)
+  parser.add_argument("--casts", type=int, default=50, help="Casts per fid.")
+  parser.add_argument("--recorded", help="Directory of recorded <route>.json responses.")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  fixtures = Fixtures(args.public_url or f"http://{args.host}:{args.port}", seed=args.seed,
+                      apps=args.apps, followers=args.followers,
+                      channel_followers=args.channel_followers, casts=args.casts,
+                      recorded_dir=args.recorded)
+  faults = Faults(args.latency, args.errors, seed=args.seed)
+  app = create_app(fixtures, faults, page_size=args.page_size)
+  app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+  main()
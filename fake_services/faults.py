@@ -0,0 +1,104 @@
+"""
+Latency and error injection, configured per route.
+
+Rules are written like LOG_SAMPLE_RATES, `route=spec,route=spec`, with a
+`default` rule for routes that have none:
+
+  latency  "default=lognormal:40:0.6,images=uniform:5:30,validate_message=const:80"
+  errors   "default=0,followers=0.02:429"
+
+Latencies are in milliseconds:
+
+  const:MS             always MS
+  uniform:LOW:HIGH     uniformly between LOW and HIGH
+  normal:MEAN:SD       normal, clipped at 0
+  lognormal:MEDIAN:SIGMA
+                       long tailed, the usual shape of API latency
+  exp:MEAN             exponential
+
+An error rule is a probability, optionally with the status to fail with
+(500 by default).
+"""
+import random
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+
+def _distribution(spec: str) -> Callable[[random.Random], float]:
+  kind, *args = spec.split(":")
+  values = [float(x) for x in args]
+  if kind == "const":
+    ms, = values
+    return lambda rng: ms
+  if kind == "uniform":
+    low, high = values
+    return lambda rng: rng.uniform(low, high)
+  if kind == "normal":
+    mean, sd = values
+    return lambda rng: max(0.0, rng.gauss(mean, sd))
+  if kind == "lognormal":
+    median, sigma = values
+    return lambda rng: median * rng.lognormvariate(0, sigma)
+  if kind == "exp":
+    mean, = values
+    return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+  raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def _error(spec: str) -> Tuple[float, int]:
+  rate, _, status = spec.partition(":")
+  return float(rate), int(status or 500)
+
+
+def _parse_rules(value: str, parse) -> Dict[str, object]:
+  rules = {}
+  for item in (value or "").split(","):
+    if not item.strip():
+      continue
+    name, _, spec = item.partition("=")
+    rules[name.strip()] = parse(spec.strip())
+  return rules
+
+
+class Faults:
+  def __init__(self, latency: str = "", errors: str = "", seed: int = None) -> None:
+    self._rng = random.Random(seed)
+    self._lock = threading.Lock()
+    self.update(latency, errors)
+
+  def update(self, latency: str = None, errors: str = None) -> None:
+    """Replaces the latency and/or error rules. Raises ValueError on a bad spec."""
+    if latency is not None:
+      self._latency = _parse_rules(latency, _distribution)
+      self.latency_spec = latency
+    if errors is not None:
+      self._errors = _parse_rules(errors, _error)
+      self.errors_spec = errors
+
+  def _rule(self, rules: dict, route: str):
+    return rules.get(route, rules.get("default"))
+
+  def delay(self, route: str) -> float:
+    """Seconds to wait before answering `route`."""
+    distribution = self._rule(self._latency, route)
+    if distribution is None:
+      return 0.0
+    with self._lock:
+      return distribution(self._rng) / 1000
+
+  def error(self, route: str):
+    """Status to fail `route` with, or None."""
+    rule = self._rule(self._errors, route)
+    if rule is None:
+      return None
+    rate, status = rule
+    with self._lock:
+      return status if self._rng.random() < rate else None
+
+  def apply(self, route: str):
+    """Sleeps for the route's latency and returns the status to fail with, if any."""
+    delay = self.delay(route)
+    if delay:
+      time.sleep(delay)
+    return self.error(route)
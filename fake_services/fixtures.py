@@ -0,0 +1,171 @@
+"""
+Synthetic Meroku and Neynar data, the same for a given seed.
+
+A directory of recorded responses can replace any of it: `<route>.json`
+(ex: `dapp_search.json` saved from the real API) is served as is.
+"""
+import hashlib
+import json
+import pathlib
+import random
+from functools import lru_cache
+from io import BytesIO
+from typing import List, Union
+
+from PIL import Image, ImageDraw
+
+# Sizes real logos and screenshots commonly come in, so image decoding and
+# resizing cost what they do in production.
+IMAGE_SIZES = {
+  "logo": (512, 512),
+  "screenshot": (1920, 1080),
+  "mobile": (1080, 1920),
+  "pfp": (400, 400),
+}
+
+WORDS = ("swap earn build trade mint bridge stake lend vote chat play collect "
+         "onchain wallet protocol community rewards secure fast open").split()
+
+
+class Fixtures:
+  def __init__(self, base_url: str, seed: int = 0, apps: int = 20, followers: int = 300,
+               channel_followers: int = 3000, casts: int = 50,
+               recorded_dir: Union[str, None] = None) -> None:
+    self.base_url = base_url.rstrip("/")
+    self.seed = seed
+    self.app_count = apps
+    self.follower_count = followers
+    self.channel_follower_count = channel_followers
+    self.cast_count = casts
+    self.recorded_dir = pathlib.Path(recorded_dir) if recorded_dir else None
+
+  def _rng(self, *key) -> random.Random:
+    return random.Random(f"{self.seed}:" + ":".join(str(k) for k in key))
+
+  def _sentence(self, rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+  def recorded(self, route: str):
+    """The recorded response for `route`, or None."""
+    if self.recorded_dir is None:
+      return None
+    path = self.recorded_dir / f"{route}.json"
+    return json.loads(path.read_text()) if path.exists() else None
+
+  def image_url(self, kind: str, name: str, ext: str = "png") -> str:
+    return f"{self.base_url}/images/{kind}/{name}.{ext}"
+
+  # Meroku
+
+  def app(self, idx: int) -> dict:
+    rng = self._rng("app", idx)
+    images = {"logo": self.image_url("logo", f"app{idx}")}
+    # A mix of desktop, mobile and no screenshots, like the real catalog.
+    if idx % 3 == 0:
+      images["screenshots"] = [self.image_url("screenshot", f"app{idx}-{i}", "jpg")
+                               for i in range(rng.randint(1, 4))]
+    elif idx % 3 == 1:
+      images["mobileScreenshots"] = [self.image_url("mobile", f"app{idx}-{i}", "jpg")
+                                     for i in range(rng.randint(2, 7))]
+    name = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 3)))
+    return {
+      "dappId": f"fake.app{idx}",
+      "name": name,
+      "description": " ".join(self._sentence(rng, rng.randint(6, 14))
+                              for _ in range(rng.randint(1, 4))),
+      "images": images,
+      "appUrl": f"https://app{idx}.example",
+      "category": rng.choice(["defi", "social", "games", "nft"]),
+      "metrics": {"rating": round(rng.uniform(1, 5), 2), "ratingsCount": rng.randint(0, 500)},
+    }
+
+  def apps(self) -> List[dict]:
+    return [self.app(i) for i in range(self.app_count)]
+
+  # Neynar
+
+  def _user_fields(self, fid: int) -> dict:
+    rng = self._rng("user", fid)
+    return {
+      "username": f"user{fid}",
+      "display_name": f"User {fid}",
+      "pfp_url": self.image_url("pfp", f"{fid}"),
+      "bio": self._sentence(rng, rng.randint(3, 10)),
+      "follower_count": rng.randint(0, 20000),
+      "following_count": rng.randint(0, 2000),
+    }
+
+  def user_v2(self, fid: int) -> dict:
+    user = self._user_fields(fid)
+    return {
+      "object": "user",
+      "fid": fid,
+      "custody_address": "0x" + hashlib.sha1(f"custody:{fid}".encode()).hexdigest(),
+      "username": user["username"],
+      "display_name": user["display_name"],
+      "pfp_url": user["pfp_url"],
+      "profile": {"bio": {"text": user["bio"]}},
+      "follower_count": user["follower_count"],
+      "following_count": user["following_count"],
+      "verifications": [],
+      "active_status": "active",
+      "viewer_context": {"following": False, "followed_by": False},
+    }
+
+  def user_v1(self, fid: int) -> dict:
+    user = self._user_fields(fid)
+    return {
+      "fid": fid,
+      "custodyAddress": "0x" + hashlib.sha1(f"custody:{fid}".encode()).hexdigest(),
+      "username": user["username"],
+      "displayName": user["display_name"],
+      "pfp": {"url": user["pfp_url"]},
+      "profile": {"bio": {"text": user["bio"], "mentionedProfiles": []}},
+      "followerCount": user["follower_count"],
+      "followingCount": user["following_count"],
+      "verifications": [],
+      "activeStatus": "active",
+      "viewerContext": {"following": False, "followedBy": False},
+    }
+
+  def _fids(self, count: int, *key) -> List[int]:
+    rng = self._rng(*key)
+    return rng.sample(range(1, 1_000_000), count)
+
+  def followers(self, fid: int) -> List[int]:
+    return self._fids(self.follower_count, "followers", fid)
+
+  def following(self, fid: int) -> List[int]:
+    return self._fids(self.follower_count, "following", fid)
+
+  def channel_followers(self, channel: str) -> List[int]:
+    return self._fids(self.channel_follower_count, "channel", channel)
+
+  def casts(self, fid: int) -> List[dict]:
+    rng = self._rng("casts", fid)
+    return [{
+      "hash": "0x" + hashlib.sha1(f"cast:{fid}:{i}".encode()).hexdigest(),
+      "author": {"fid": fid, "username": f"user{fid}"},
+      "text": self._sentence(rng, rng.randint(3, 25)),
+      "timestamp": f"2024-02-{1 + i % 28:02d}T12:00:00.000Z",
+    } for i in range(self.cast_count)]
+
+
+@lru_cache(maxsize=512)
+def render_image(kind: str, name: str, ext: str, size=None) -> bytes:
+  """A deterministic picture, so identical URLs get identical bytes."""
+  width, height = size or IMAGE_SIZES.get(kind, (512, 512))
+  rng = random.Random(f"{kind}:{name}")
+  img = Image.new("RGB", (width, height), tuple(rng.randint(0, 255) for _ in range(3)))
+  draw = ImageDraw.Draw(img)
+  for _ in range(12):
+    x0, y0 = rng.randint(0, width), rng.randint(0, height)
+    x1, y1 = rng.randint(x0, width), rng.randint(y0, height)
+    draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+  draw.text((width // 20, height // 20), name, fill=(255, 255, 255))
+  out = BytesIO()
+  if ext in ("jpg", "jpeg"):
+    img.save(out, format="JPEG", quality=85)
+  else:
+    img.save(out, format="PNG")
+  return out.getvalue()
@@ -0,0 +1,172 @@
+"""
+One Flask app serving every stand-in, at the paths the real services use.
+"""
+import threading
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+
+from .faults import Faults
+from .fixtures import Fixtures, render_image
+
+# Largest page each paginated route returns, like the real API.
+DEFAULT_PAGE_SIZES = {
+  "followers": 150,
+  "following": 150,
+  "channel_followers": 1000,
+  "casts": 150,
+}
+
+
+def _page(items: list, limit: int, max_page_size: int):
+  """
+  The page of `items` after request's cursor, and the cursor of the next
+  one (None on the last page). Cursors are plain offsets.
+  """
+  offset = int(request.args.get("cursor") or 0)
+  size = max(1, min(limit, max_page_size))
+  page = items[offset:offset + size]
+  next_offset = offset + size
+  return page, (str(next_offset) if next_offset < len(items) else None)
+
+
+def create_app(fixtures: Fixtures, faults: Faults = None, page_size: int = None) -> Flask:
+  """
+  `page_size`, when set, caps every paginated route instead of
+  DEFAULT_PAGE_SIZES.
+  """
+  app = Flask(__name__)
+  faults = faults or Faults()
+  stats = Counter()
+  stats_lock = threading.Lock()
+
+  def max_page_size(route: str) -> int:
+    return page_size or DEFAULT_PAGE_SIZES[route]
+
+  @app.before_request
+  def inject_faults():
+    route = request.endpoint
+    if route is None or route.startswith("fake_"):
+      return None
+    status = faults.apply(route)
+    with stats_lock:
+      stats[route] += 1
+      if status is not None:
+        stats[f"{route}:{status}"] += 1
+    if status is not None:
+      return jsonify({"message": "Injected failure", "status": status}), status
+    recorded = fixtures.recorded(route)
+    if recorded is not None:
+      return jsonify(recorded)
+    return None
+
+  # Meroku
+
+  @app.route("/api/v1/dapp/search", endpoint="dapp_search")
+  def dapp_search():
+    apps = fixtures.apps()
+    return jsonify({"data": apps, "page": 1, "pageCount": 1, "limit": len(apps)})
+
+  @app.route("/api/v1/dapp/rate", methods=["POST"], endpoint="dapp_rate")
+  def dapp_rate():
+    payload = request.get_json(silent=True) or {}
+    return jsonify({"success": True, "dappId": payload.get("dappId"),
+                    "rating": payload.get("rating")})
+
+  # Neynar hub
+
+  @app.route("/v1/validateMessage", methods=["POST"], endpoint="validate_message")
+  def validate_message():
+    # Real message bytes are protobuf. A body of "<fid>" or
+    # "<fid>:<button>" is taken as the fid (and button pressed), anything
+    # else gets a fid derived from it and button 1.
+    body = request.get_data()
+    try:
+      fid, _, button = body.decode().partition(":")
+      fid, button = int(fid), int(button or 1)
+    except (UnicodeDecodeError, ValueError):
+      fid = int.from_bytes(body[:3].ljust(3, b"\0"), "big") % 1_000_000 + 1
+      button = 1
+    return jsonify({
+      "valid": True,
+      "message": {
+        "data": {
+          "type": "MESSAGE_TYPE_FRAME_ACTION",
+          "fid": fid,
+          "network": "FARCASTER_NETWORK_MAINNET",
+          "frameActionBody": {"buttonIndex": button},
+        },
+      },
+    })
+
+  # Neynar API
+
+  @app.route("/v2/farcaster/user/bulk", endpoint="user_bulk")
+  def user_bulk():
+    fids = [int(x) for x in request.args.get("fids", "").split(",") if x.strip()]
+    return jsonify({"users": [fixtures.user_v2(fid) for fid in fids]})
+
+  @app.route("/v2/farcaster/user/search", endpoint="user_search")
+  def user_search():
+    query = request.args.get("q", "")
+    fid = int(query[4:]) if query.startswith("user") and query[4:].isdigit() else None
+    users = [fixtures.user_v2(fid)] if fid else []
+    return jsonify({"result": {"users": users}})
+
+  @app.route("/v1/farcaster/followers", endpoint="followers")
+  def followers():
+    fid = int(request.args["fid"])
+    fids, cursor = _page(fixtures.followers(fid), int(request.args.get("limit", 25)),
+                         max_page_size("followers"))
+    return jsonify({"result": {"users": [fixtures.user_v1(f) for f in fids],
+                               "next": {"cursor": cursor}}})
+
+  @app.route("/v1/farcaster/following", endpoint="following")
+  def following():
+    fid = int(request.args["fid"])
+    fids, cursor = _page(fixtures.following(fid), int(request.args.get("limit", 25)),
+                         max_page_size("following"))
+    return jsonify({"result": {"users": [fixtures.user_v1(f) for f in fids],
+                               "next": {"cursor": cursor}}})
+
+  @app.route("/v2/farcaster/channel/followers", endpoint="channel_followers")
+  def channel_followers():
+    fids, cursor = _page(fixtures.channel_followers(request.args["id"]),
+                         int(request.args.get("limit", 25)), max_page_size("channel_followers"))
+    return jsonify({"users": [fixtures.user_v2(f) for f in fids], "next": {"cursor": cursor}})
+
+  @app.route("/v1/farcaster/casts", endpoint="casts")
+  def casts():
+    items, cursor = _page(fixtures.casts(int(request.args["fid"])),
+                          int(request.args.get("limit", 25)), max_page_size("casts"))
+    return jsonify({"result": {"casts": items, "next": {"cursor": cursor}}})
+
+  # Logo and screenshot hosts
+
+  @app.route("/images/<kind>/<name>.<ext>", endpoint="images")
+  def images(kind: str, name: str, ext: str):
+    size = None
+    if "w" in request.args and "h" in request.args:
+      size = (int(request.args["w"]), int(request.args["h"]))
+    mimetype = "image/jpeg" if ext in ("jpg", "jpeg") else "image/png"
+    return Response(render_image(kind, name, ext, size), mimetype=mimetype)
+
+  # Control
+
+  @app.route("/_fake/config", methods=["GET", "POST"], endpoint="fake_config")
+  def fake_config():
+    if request.method == "POST":
+      update = request.get_json(silent=True) or {}
+      try:
+        faults.update(update.get("latency"), update.get("errors"))
+      except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"latency": faults.latency_spec, "errors": faults.errors_spec,
+                    "page_size": page_size})
+
+  @app.route("/_fake/stats", endpoint="fake_stats")
+  def fake_stats():
+    with stats_lock:
+      return jsonify(dict(stats))
+
+  return app
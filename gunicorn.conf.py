@@ -0,0 +1,15 @@
+"""
+gunicorn settings read from the working directory, for app:app and
+asgi:app alike.
+"""
+import os
+import subprocess
+import sys
+
+
+def on_starting(server):
+  # Once, before any worker starts, so that every worker maps the same store
+  # instead of decoding templates and the catalog itself. In a child process:
+  # the master stays free of app imports, which gevent workers need.
+  if os.getenv("ASSET_STORE_DIR"):
+    subprocess.run([sys.executable, "-m", "pycaster.lib.shared_store"], check=False)
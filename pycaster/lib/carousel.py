@@ -0,0 +1,134 @@
+"""
+Screenshot carousel pages.
+
+Rendered pages are cached in Redis under the app's render digest, so they
+are shared by all workers and never outlive a visual change to the app.
+Serving a page renders its neighbours in the background, which turns ◀ / ▶
+into a cache lookup (usually in the worker's client side cache). A page
+missing a screenshot that could not be fetched is served but not cached.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Tuple
+
+from .frames import (VIEW_SCREENSHOTS, render_digest, render_view_complete,
+                     render_view_complete_async, screenshot_pages)
+from .io import cache_get_async, get_async_redis, r_cache
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+CAROUSEL_CACHE_TTL = get_numeric_env_var("CAROUSEL_CACHE_TTL", 6*60*60)
+CAROUSEL_PREFETCH_WORKERS = get_numeric_env_var("CAROUSEL_PREFETCH_WORKERS", 2)
+
+_executor = None
+_inflight: Dict[str, Future] = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+  global _executor, _lock
+  _executor = None
+  _inflight.clear()
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def page_count(_app) -> int:
+  return len(screenshot_pages(_app))
+
+
+def page_cache_key(_app, page: int) -> str:
+  return f"farcaster:screenshots:{_app['dappId']}:{render_digest(_app)[:16]}:{page}"
+
+
+def _render_page(key: str, _app, page: int) -> Tuple[bytes, bool]:
+  png = r_cache.get(key)
+  if png is not None:
+    return png, True
+  png, complete = render_view_complete(VIEW_SCREENSHOTS, _app, page)
+  if complete:
+    r_cache.set(key, png, ex=CAROUSEL_CACHE_TTL)
+  return png, complete
+
+
+def get_page_complete(_app, page: int) -> Tuple[bytes, bool]:
+  """
+  Returns the PNG of carousel `page`, from the cache, from a prefetch that
+  is already rendering it, or rendered inline, and whether it has all its
+  screenshots.
+  """
+  key = page_cache_key(_app, page)
+  png = r_cache.get(key)
+  if png is not None:
+    return png, True
+  future = _inflight.get(key)
+  if future is not None:
+    try:
+      return future.result()
+    except Exception:
+      # Logged by _log_failure; rendered inline below.
+      pass
+  logger.debug("Rendering screenshot page %s of %s inline", page, _app['dappId'])
+  return _render_page(key, _app, page)
+
+
+def get_page(_app, page: int) -> bytes:
+  return get_page_complete(_app, page)[0]
+
+
+async def get_page_async(_app, page: int) -> bytes:
+  """Awaitable get_page."""
+  key = page_cache_key(_app, page)
+  png = await cache_get_async(key)
+  if png is not None:
+    return png
+  future = _inflight.get(key)
+  if future is not None:
+    import asyncio
+    try:
+      return (await asyncio.wrap_future(future))[0]
+    except Exception:
+      pass
+  png, complete = await render_view_complete_async(VIEW_SCREENSHOTS, _app, page)
+  if complete:
+    await get_async_redis().set(key, png, ex=CAROUSEL_CACHE_TTL)
+  return png
+
+
+def _forget(key: str) -> None:
+  with _lock:
+    _inflight.pop(key, None)
+
+
+def _log_failure(future: Future) -> None:
+  if future.exception() is not None:
+    logger.warning("Screenshot page prefetch failed: %s", future.exception())
+
+
+def prefetch(_app, pages: Iterable[int]) -> None:
+  """
+  Renders `pages` (wrapping around) into the cache in the background.
+  """
+  global _executor
+  count = page_count(_app)
+  if count == 0:
+    return
+  submitted = []
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=CAROUSEL_PREFETCH_WORKERS,
+                                     thread_name_prefix="carousel-prefetch")
+    for page in {p % count for p in pages}:
+      key = page_cache_key(_app, page)
+      if key not in _inflight:
+        _inflight[key] = _executor.submit(_render_page, key, _app, page)
+        submitted.append((key, _inflight[key]))
+  # Callbacks may run right away, so they are added without holding _lock.
+  for key, future in submitted:
+    future.add_done_callback(lambda _, key=key: _forget(key))
+    future.add_done_callback(_log_failure)
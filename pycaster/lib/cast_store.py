@@ -0,0 +1,311 @@
+"""
+Recent casts of each fid, kept up to date with deltas, for cast checks.
+
+The newest CAST_STORE_WINDOW casts of a fid are kept in Redis (shared by the
+workers) and in each worker's memory. Bringing a window up to date fetches
+CAST_STORE_DELTA_PAGE casts at a time, newest first, and stops at the first
+cast already stored, so a user who has not casted since costs one small
+page instead of their last N casts. A window found in Redis is reused
+without asking Neynar at all when another worker synced it in the last
+CAST_STORE_FRESHNESS seconds.
+
+has_casted() answers from the window. A match stays good for
+CAST_STORE_MAX_AGE seconds; no match only for CAST_STORE_FRESHNESS, since
+the user may be casting right now. Answers are memoized per window, so a
+campaign checking the same text for a user again does not rescan it.
+Deleted casts stay in a window until they fall out of it.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Union
+
+from . import codec, neynar
+from .io import NEYNAR_API_URL, get_async_redis, neynar_headers, r
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+CAST_STORE_WINDOW = get_numeric_env_var("CAST_STORE_WINDOW", 50)
+CAST_STORE_DELTA_PAGE = get_numeric_env_var("CAST_STORE_DELTA_PAGE", 10)
+CAST_STORE_FRESHNESS = get_numeric_env_var("CAST_STORE_FRESHNESS", 10)
+CAST_STORE_MAX_AGE = get_numeric_env_var("CAST_STORE_MAX_AGE", 300)
+CAST_STORE_LOCAL_FIDS = get_numeric_env_var("CAST_STORE_LOCAL_FIDS", 2048)
+# Windows of fids nobody checks any more leave Redis after this.
+CAST_STORE_TTL = 24*60*60
+# Memoized answers kept per window.
+MAX_MATCHES = 64
+
+
+class Window:
+  """The newest casts of a fid, newest first."""
+  __slots__ = ("hashes", "texts", "synced_at", "complete", "_matches")
+
+  def __init__(self, casts: List[Tuple[str, str]], synced_at: float, complete: bool) -> None:
+    self.hashes = [h for h, _ in casts]
+    self.texts = [t for _, t in casts]
+    self.synced_at = synced_at
+    # Whether these are all the casts of the fid.
+    self.complete = complete
+    self._matches = {}
+
+  def covers(self, count: int) -> bool:
+    return self.complete or len(self.texts) >= count
+
+  def contains(self, cast_text: str, count: int) -> bool:
+    """Whether one of the newest `count` casts contains `cast_text`."""
+    key = (cast_text, count)
+    found = self._matches.get(key)
+    if found is None:
+      found = any(cast_text in text for text in self.texts[:count])
+      if len(self._matches) >= MAX_MATCHES:
+        self._matches.clear()
+      self._matches[key] = found
+    return found
+
+  def age(self) -> float:
+    return time.time() - self.synced_at
+
+  def encode(self) -> bytes:
+    return codec.dumps({"casts": list(zip(self.hashes, self.texts)),
+                       "synced_at": self.synced_at, "complete": self.complete})
+
+  @classmethod
+  def decode(cls, encoded) -> "Window":
+    data = codec.loads(encoded)
+    return cls([tuple(c) for c in data["casts"]], data["synced_at"], data["complete"])
+
+
+_local: "OrderedDict[int, Window]" = OrderedDict()
+_inflight: Dict[int, Future] = {}
+_inflight_async = {}  # (loop id, fid) -> asyncio.Task
+_lock = threading.Lock()
+_stats = {"checks": 0, "local_answers": 0, "shared_windows": 0, "syncs": 0, "full_syncs": 0,
+          "pages": 0, "new_casts": 0, "sync_errors": 0, "fallbacks": 0}
+
+
+def _reset_after_fork():
+  global _lock
+  _local.clear()
+  _inflight.clear()
+  _inflight_async.clear()
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count(name: str, n: int = 1) -> None:
+  with _lock:
+    _stats[name] += n
+
+
+def stats() -> dict:
+  with _lock:
+    return {**_stats, "local_fids": len(_local), "window": CAST_STORE_WINDOW}
+
+
+def _key(fid: int) -> str:
+  return f"cast_store:{fid}"
+
+
+def _local_get(fid: int) -> Union[Window, None]:
+  with _lock:
+    window = _local.get(fid)
+    if window is not None:
+      _local.move_to_end(fid)
+    return window
+
+
+def _local_set(fid: int, window: Window) -> None:
+  with _lock:
+    _local[fid] = window
+    _local.move_to_end(fid)
+    while len(_local) > CAST_STORE_LOCAL_FIDS:
+      _local.popitem(last=False)
+
+
+def _answer(window: Window, cast_text: str, count: int) -> Union[bool, None]:
+  """The answer `window` gives, or None when it is too old or too short."""
+  if window is None or not window.covers(count):
+    return None
+  found = window.contains(cast_text, count)
+  if window.age() < (CAST_STORE_MAX_AGE if found else CAST_STORE_FRESHNESS):
+    return found
+  return None
+
+
+def _delta(fid: int, window: Union[Window, None]):
+  """
+  Brings `window` up to date. A generator: it yields the params of each
+  casts page it needs, is sent the page's JSON, and returns the new Window.
+  """
+  known = set(window.hashes) if window is not None else set()
+  new = []
+  params = {"fid": fid, "viewerFid": fid,
+            "limit": CAST_STORE_DELTA_PAGE if known else CAST_STORE_WINDOW}
+  synced_at = time.time()
+  while True:
+    data = yield dict(params)
+    result = data["result"]
+    for cast in result["casts"]:
+      if cast["hash"] in known:
+        # Caught up with what was stored.
+        casts = new + list(zip(window.hashes, window.texts))
+        _count("new_casts", len(new))
+        return Window(casts[:CAST_STORE_WINDOW], synced_at,
+                      window.complete and len(casts) <= CAST_STORE_WINDOW)
+      new.append((cast["hash"], cast["text"]))
+      if len(new) >= CAST_STORE_WINDOW:
+        _count("full_syncs")
+        return Window(new, synced_at, False)
+    cursor = (result.get("next") or {}).get("cursor")
+    if not cursor:
+      # Nothing stored was seen again: these are all the casts there are.
+      _count("full_syncs")
+      return Window(new, synced_at, True)
+    params["cursor"] = cursor
+    # Past the first delta page the user has casted a lot: get the rest at once.
+    params["limit"] = CAST_STORE_WINDOW - len(new)
+
+
+def _casts_page(params: dict) -> dict:
+  _count("pages")
+  response = neynar.get(f"{NEYNAR_API_URL}/v1/farcaster/casts", params=params,
+                        headers=neynar_headers({"accept": "application/json"}))
+  response.raise_for_status()
+  return response.json()
+
+
+async def _casts_page_async(params: dict) -> dict:
+  _count("pages")
+  response = await neynar.get_async(f"{NEYNAR_API_URL}/v1/farcaster/casts", params=params,
+                                    headers=neynar_headers({"accept": "application/json"}))
+  response.raise_for_status()
+  return response.json()
+
+
+def _newer(a: Union[Window, None], b: Union[Window, None]) -> Union[Window, None]:
+  if a is None or b is None:
+    return a or b
+  return a if a.synced_at >= b.synced_at else b
+
+
+def _sync(fid: int) -> Window:
+  """Returns the fid's window, synced with Neynar unless Redis had a fresh one."""
+  encoded = r.get(_key(fid))
+  window = _newer(_local_get(fid), Window.decode(encoded) if encoded else None)
+  if window is not None and window.age() < CAST_STORE_FRESHNESS:
+    _count("shared_windows")
+    _local_set(fid, window)
+    return window
+  _count("syncs")
+  steps = _delta(fid, window)
+  try:
+    params = next(steps)
+    while True:
+      params = steps.send(_casts_page(params))
+  except StopIteration as done:
+    window = done.value
+  r.set(_key(fid), window.encode(), ex=CAST_STORE_TTL)
+  _local_set(fid, window)
+  return window
+
+
+async def _sync_async(fid: int) -> Window:
+  encoded = await get_async_redis().get(_key(fid))
+  window = _newer(_local_get(fid), Window.decode(encoded) if encoded else None)
+  if window is not None and window.age() < CAST_STORE_FRESHNESS:
+    _count("shared_windows")
+    _local_set(fid, window)
+    return window
+  _count("syncs")
+  steps = _delta(fid, window)
+  try:
+    params = next(steps)
+    while True:
+      params = steps.send(await _casts_page_async(params))
+  except StopIteration as done:
+    window = done.value
+  await get_async_redis().set(_key(fid), window.encode(), ex=CAST_STORE_TTL)
+  _local_set(fid, window)
+  return window
+
+
+def _synced(fid: int) -> Window:
+  """_sync, once at a time per fid in this worker."""
+  with _lock:
+    future = _inflight.get(fid)
+    owner = future is None
+    if owner:
+      future = _inflight[fid] = Future()
+  if not owner:
+    return future.result()
+  try:
+    window = _sync(fid)
+    future.set_result(window)
+    return window
+  except BaseException as e:
+    future.set_exception(e)
+    raise
+  finally:
+    with _lock:
+      _inflight.pop(fid, None)
+
+
+async def _synced_async(fid: int) -> Window:
+  import asyncio
+  inflight_key = (id(asyncio.get_running_loop()), fid)
+  task = _inflight_async.get(inflight_key)
+  if task is None:
+    task = asyncio.ensure_future(_sync_async(fid))
+    _inflight_async[inflight_key] = task
+    task.add_done_callback(lambda _: _inflight_async.pop(inflight_key, None))
+  return await asyncio.shield(task)
+
+
+def _stale_answer(fid: int, cast_text: str, count: int, error: Exception) -> bool:
+  """What the window we have says, when it could not be synced."""
+  _count("sync_errors")
+  logger.info("Could not sync the casts of %s: %s", fid, error)
+  window = _local_get(fid)
+  return window is not None and window.covers(count) and window.contains(cast_text, count)
+
+
+def has_casted(fid: int, cast_text: str, count: int = 10) -> Union[bool, None]:
+  """
+  Whether one of the last `count` casts of `fid` contains `cast_text`. None
+  when `count` is more than the window holds, for the caller to check itself.
+  """
+  _count("checks")
+  if count > CAST_STORE_WINDOW:
+    _count("fallbacks")
+    return None
+  found = _answer(_local_get(fid), cast_text, count)
+  if found is not None:
+    _count("local_answers")
+    return found
+  try:
+    window = _synced(fid)
+  except Exception as e:
+    return _stale_answer(fid, cast_text, count, e)
+  return window.contains(cast_text, count)
+
+
+async def has_casted_async(fid: int, cast_text: str, count: int = 10) -> Union[bool, None]:
+  _count("checks")
+  if count > CAST_STORE_WINDOW:
+    _count("fallbacks")
+    return None
+  found = _answer(_local_get(fid), cast_text, count)
+  if found is not None:
+    _count("local_answers")
+    return found
+  try:
+    window = await _synced_async(fid)
+  except Exception as e:
+    return _stale_answer(fid, cast_text, count, e)
+  return window.contains(cast_text, count)
@@ -0,0 +1,172 @@
+"""
+Incremental sync of the Meroku catalog into Redis.
+
+The new catalog is diffed against the current version by per-app content
+digest. Only added and changed apps are written: the current version's hashes
+are COPY'd server side, patched and published as a new version in one MULTI.
+
+Cached logos are dropped for apps whose logo changed. Everything else
+rendered from an app (prerendered frames in the shared asset store, carousel
+pages, CDN URLs) is keyed by its render digest, so an app whose name,
+description or logo changed simply misses them. The asset store's catalog
+snapshot is republished after every sync, unchanged catalogs included, so it
+does not expire while Redis holds a fresh catalog.
+
+  python -m pycaster.lib.catalog_sync
+"""
+import json
+import time
+from typing import Dict
+
+from redis.exceptions import ResponseError
+
+from . import codec
+from .io import r, r_cache
+from .meroku import (CATALOG_FRESH_KEY, CATALOG_TTL, CATALOG_VERSION_KEY, app_digests,
+                     catalog_digests_key, catalog_index_key, catalog_key, catalog_keys,
+                     catalog_version, fetch_catalog, get_current_version, publish_version,
+                     store_catalog)
+from .shared_store import get_asset_store, publish_catalog
+from .utils import LazyJSON, log_fields, setup_logger
+
+
+logger = setup_logger(__name__)
+
+def _split_digests(value) -> tuple:
+  content, _, render = value.decode().partition(":")
+  return content, render
+
+
+def diff_catalog(apps, version: str) -> dict:
+  """
+  Compares `apps` with the stored `version` by digest and returns the ids
+  that were added, removed, changed at all, and changed visually.
+  """
+  stored = {k.decode(): _split_digests(v) for k, v in r.hgetall(catalog_digests_key(version)).items()}
+  new = {x['dappId']: app_digests(x).split(":") for x in apps}
+
+  added = [i for i in new if i not in stored]
+  removed = [i for i in stored if i not in new]
+  changed = [i for i in new if i in stored and new[i][0] != stored[i][0]]
+  render_changed = [i for i in changed if new[i][1] != stored[i][1]]
+  return {
+    "added": added,
+    "removed": removed,
+    "changed": changed,
+    "render_changed": render_changed + removed,
+  }
+
+
+def _write_delta(apps, previous: str, diff: dict) -> str:
+  version = catalog_version(apps)
+  by_id = {x['dappId']: x for x in apps}
+  upserts = diff["added"] + diff["changed"]
+
+  pipe = r.pipeline(transaction=True)
+  pipe.delete(*catalog_keys(version))
+  pipe.copy(catalog_key(previous), catalog_key(version))
+  pipe.copy(catalog_digests_key(previous), catalog_digests_key(version))
+  if upserts:
+    pipe.hset(catalog_key(version), mapping={i: codec.dumps(by_id[i]) for i in upserts})
+    pipe.hset(catalog_digests_key(version), mapping={i: app_digests(by_id[i]) for i in upserts})
+  if diff["removed"]:
+    pipe.hdel(catalog_key(version), *diff["removed"])
+    pipe.hdel(catalog_digests_key(version), *diff["removed"])
+  pipe.set(catalog_index_key(version), codec.dumps(list(by_id)))
+  publish_version(pipe, version, previous)
+  pipe.execute()
+  r_cache.invalidate([CATALOG_VERSION_KEY, CATALOG_FRESH_KEY])
+  return version
+
+
+def invalidate_renders(old_apps: Dict[str, dict], new_apps: Dict[str, dict]) -> None:
+  """
+  Drops the cached logos of apps whose logo changed, given the old and new
+  records of the apps whose rendered output changed.
+  """
+  stale_logos = []
+  for app_id, old in old_apps.items():
+    old_logo = (old.get('images') or {}).get('logo')
+    new_logo = (new_apps.get(app_id, {}).get('images') or {}).get('logo')
+    if old_logo and old_logo != new_logo:
+      stale_logos.append(f"pfp:test1:{old_logo}")
+  if stale_logos:
+    r_cache.delete(*stale_logos)
+
+
+def sync_catalog(apps=None) -> dict:
+  """
+  Syncs the catalog from Meroku (or `apps`) and returns a change summary
+  with timings in milliseconds.
+  """
+  timings = {}
+  started = time.perf_counter()
+
+  if apps is None:
+    apps = fetch_catalog()
+  timings["fetch"] = (time.perf_counter() - started) * 1000
+  if not apps:
+    logger.warning("Catalog sync got no apps, keeping the current version")
+    return {"status": "empty", "timings": timings}
+
+  previous = get_current_version()
+  summary = {"from_version": previous, "apps": len(apps)}
+
+  step = time.perf_counter()
+  diff = diff_catalog(apps, previous) if previous is not None else None
+  timings["diff"] = (time.perf_counter() - step) * 1000
+
+  # Read the old records of visually changed apps before the old version
+  # starts expiring.
+  old_apps = {}
+  if diff is not None and diff["render_changed"]:
+    changed = diff["render_changed"]
+    old_apps = {i: codec.loads(v) for i, v in zip(changed, r.hmget(catalog_key(previous), changed))
+                if v is not None}
+
+  step = time.perf_counter()
+  if diff is None:
+    summary["status"] = "full"
+    version = store_catalog(apps)
+  elif not (diff["added"] or diff["removed"] or diff["changed"]):
+    summary["status"] = "unchanged"
+    version = previous
+    r_cache.set(CATALOG_FRESH_KEY, 1, ex=CATALOG_TTL)
+  else:
+    summary["status"] = "delta"
+    try:
+      version = _write_delta(apps, previous, diff)
+    except ResponseError as e:
+      # COPY needs Redis >= 6.2.
+      logger.warning("Delta write failed (%s), storing the full catalog", e)
+      summary["status"] = "full"
+      version = store_catalog(apps)
+  timings["write"] = (time.perf_counter() - step) * 1000
+
+  step = time.perf_counter()
+  if get_asset_store() is not None:
+    # Prerendered frames whose render digest is unchanged are carried over.
+    # An unchanged catalog is republished when its snapshot nears expiry.
+    publish_catalog(apps)
+  timings["publish"] = (time.perf_counter() - step) * 1000
+
+  step = time.perf_counter()
+  if old_apps:
+    new_by_id = {x['dappId']: x for x in apps}
+    new_apps = {i: new_by_id[i] for i in old_apps if i in new_by_id}
+    invalidate_renders(old_apps, new_apps)
+  timings["invalidate"] = (time.perf_counter() - step) * 1000
+  timings["total"] = (time.perf_counter() - started) * 1000
+
+  summary["to_version"] = version
+  if diff is not None:
+    summary.update(diff)
+  summary["timings"] = {k: round(v, 2) for k, v in timings.items()}
+
+  logger.info("Catalog sync %s", summary["status"],
+              extra=log_fields("catalog_sync", summary=LazyJSON(summary)))
+  return summary
+
+
+if __name__ == "__main__":
+  print(json.dumps(sync_catalog(), indent=2))
@@ -0,0 +1,146 @@
+"""
+Frame images published to the CDN.
+
+With CDN_PUBLISH=1 every view is rendered once per render digest and uploaded
+under the hash of its PNG, with an immutable Cache-Control. The URL is
+recorded in Redis under the view and digest:
+
+  farcaster:cdn:<render key>:<digest16>  ->  <S3_PUBLIC_URL>/frames/<sha256>.png
+
+Frames then point at the CDN instead of a worker. A view that is not
+published yet is published in the background, and published_url() returns
+None so that the frame falls back to the dynamic image route. A render
+missing an external image that could not be fetched is not published; the
+view is tried again once its publish lock expires.
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set, Tuple, Union
+
+from . import carousel, uploads
+from .frames import VIEW_SCREENSHOTS, render_digest, render_view_complete
+from .io import r, r_cache
+from .shared_store import get_asset_store, render_key
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+CDN_PUBLISH = os.getenv("CDN_PUBLISH", "0") == "1"
+CDN_URL_TTL = get_numeric_env_var("CDN_URL_TTL", 7*24*60*60)
+CDN_PUBLISH_WORKERS = get_numeric_env_var("CDN_PUBLISH_WORKERS", 1)
+# How long other workers leave a view to the worker publishing it.
+CDN_PUBLISH_LOCK_TTL = 120
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_executor = None
+_pending: Set[str] = set()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "published": 0, "incomplete": 0, "failed": 0}
+
+
+def _reset_after_fork():
+  global _executor, _lock
+  _executor = None
+  _pending.clear()
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count(name: str) -> None:
+  with _lock:
+    _stats[name] += 1
+
+
+def stats() -> dict:
+  with _lock:
+    return {**_stats, "enabled": CDN_PUBLISH, "pending": len(_pending)}
+
+
+def url_key(view_type: str, _app, page: Union[int, None] = None) -> str:
+  return f"farcaster:cdn:{render_key(view_type, _app['dappId'], page)}:{render_digest(_app)[:16]}"
+
+
+def _render_png(view_type: str, _app, page: Union[int, None]) -> Tuple[bytes, bool]:
+  """The view's PNG, and whether it has all its external images."""
+  # Reuse a prerendered render when there is one; those are complete.
+  store = get_asset_store()
+  mapped = store.current() if store is not None else None
+  if mapped is not None:
+    key = render_key(view_type, _app['dappId'], page)
+    if (mapped.meta(key) or {}).get('digest') == render_digest(_app):
+      png = mapped.get(key)
+      if png is not None:
+        return bytes(png), True
+  if view_type == VIEW_SCREENSHOTS:
+    return carousel.get_page_complete(_app, page)
+  return render_view_complete(view_type, _app, page)
+
+
+def _publish(key: str, view_type: str, _app, page: Union[int, None]) -> None:
+  lock_key = f"{key}:lock"
+  try:
+    if not r.set(lock_key, 1, nx=True, ex=CDN_PUBLISH_LOCK_TTL):
+      # Another worker is publishing it.
+      with _lock:
+        _pending.discard(key)
+      return
+    png, complete = _render_png(view_type, _app, page)
+    if not complete:
+      # Not worth an immutable URL. The lock is left to expire, which spaces
+      # out retries.
+      with _lock:
+        _pending.discard(key)
+      _count("incomplete")
+      logger.info("Not publishing %s: an external image could not be fetched", key)
+      return
+    future = uploads.submit(png, f"frames/{hashlib.sha256(png).hexdigest()}.png",
+                            "image/png", CACHE_CONTROL)
+  except Exception as e:
+    _published(key, None, e)
+    return
+  future.add_done_callback(lambda f: _published(key, f.result() if f.exception() is None else None,
+                                                f.exception()))
+
+
+def _published(key: str, url: Union[str, None], error: Union[Exception, None]) -> None:
+  with _lock:
+    _pending.discard(key)
+  if error is not None:
+    # The lock is left to expire, which spaces out retries.
+    _count("failed")
+    logger.warning("Failed to publish %s: %s", key, error)
+    return
+  _count("published")
+  r_cache.set(key, url, ex=CDN_URL_TTL)
+  r.delete(f"{key}:lock")
+
+
+def published_url(view_type: str, _app, page: Union[int, None] = None) -> Union[str, None]:
+  """
+  CDN URL of the view, or None if it is not published yet, in which case it
+  is published in the background.
+  """
+  if not CDN_PUBLISH:
+    return None
+  key = url_key(view_type, _app, page)
+  url = r_cache.get(key)
+  if url is not None:
+    _count("hits")
+    return url.decode() if isinstance(url, bytes) else url
+  _count("misses")
+
+  global _executor
+  with _lock:
+    if key in _pending:
+      return None
+    _pending.add(key)
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=CDN_PUBLISH_WORKERS,
+                                     thread_name_prefix="cdn-publish")
+    _executor.submit(_publish, key, view_type, _app, page)
+  return None
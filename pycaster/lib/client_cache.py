@@ -0,0 +1,289 @@
+"""
+Server-assisted client-side cache for hot Redis keys.
+
+A dedicated RESP3 connection enables `CLIENT TRACKING ON BCAST` for a set of
+key prefixes. Redis then pushes an invalidation message on that connection
+whenever any client (another worker, a cron, redis-cli) modifies or expires a
+matching key, and a background thread drops the local copy.
+
+Values are only served locally while that connection is healthy. If it
+drops, the local cache is flushed and reads go straight to Redis until
+tracking is re-established.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+from .utils import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+class _Fetch:
+  """Marks a read in flight, so an invalidation that races it wins."""
+  __slots__ = ("stale",)
+
+  def __init__(self) -> None:
+    self.stale = False
+
+
+class ClientSideCache:
+  def __init__(self,
+               client,
+               prefixes: Iterable[str],
+               max_bytes: int = 32*1024*1024,
+               max_age: float = 300,
+               reconnect_delay: float = 1.0) -> None:
+    self._client = client
+    self.prefixes = tuple(prefixes)
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.reconnect_delay = reconnect_delay
+
+    self._entries = OrderedDict()  # (key, field) -> (value, size, stored_at)
+    self._fields = {}              # key -> set of fields cached for it
+    self._inflight = {}            # key -> set of _Fetch
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self._tracking = False
+    self._stopped = threading.Event()
+
+    self.hits = 0
+    self.misses = 0
+    self.bypasses = 0
+    self.invalidations = 0
+    self.evictions = 0
+    self.flushes = 0
+
+    self._thread = None
+    if max_bytes > 0 and self.prefixes:
+      self._thread = threading.Thread(target=self._run, name="redis-tracking", daemon=True)
+      self._thread.start()
+
+  # Reads
+
+  def get(self, key: str):
+    return self._read(key, None, lambda: self._client.get(key))
+
+  def hget(self, key: str, field: str):
+    return self._read(key, field, lambda: self._client.hget(key, field))
+
+  def _cacheable(self, key: str) -> bool:
+    return self._tracking and key.startswith(self.prefixes)
+
+  # Reads from an event loop, where `fetch` returns an awaitable (ex: a
+  # call on redis.asyncio). Hits are served the same way.
+
+  async def get_async(self, key: str, fetch):
+    return await self._read_async(key, None, fetch)
+
+  async def hget_async(self, key: str, field: str, fetch):
+    return await self._read_async(key, field, fetch)
+
+  def _lookup(self, key: str, field):
+    """
+    Returns (True, value) on a hit. On a miss returns (False, token) and
+    registers the fetch, which must be ended with _fetched or _abandon.
+    """
+    entry_key = (key, field)
+    with self._lock:
+      entry = self._entries.get(entry_key)
+      if entry is not None and time.monotonic() - entry[2] < self.max_age:
+        self._entries.move_to_end(entry_key)
+        self.hits += 1
+        return True, entry[0]
+      self.misses += 1
+      token = _Fetch()
+      self._inflight.setdefault(key, set()).add(token)
+      return False, token
+
+  def _fetched(self, key: str, field, token, value) -> None:
+    with self._lock:
+      self._discard_inflight(key, token)
+      if not token.stale and self._tracking:
+        self._store((key, field), value)
+
+  def _abandon(self, key: str, token) -> None:
+    with self._lock:
+      self._discard_inflight(key, token)
+
+  def _read(self, key: str, field, fetch):
+    if not self._cacheable(key):
+      self.bypasses += 1
+      return fetch()
+    hit, result = self._lookup(key, field)
+    if hit:
+      return result
+    try:
+      value = fetch()
+    except BaseException:
+      self._abandon(key, result)
+      raise
+    self._fetched(key, field, result, value)
+    return value
+
+  async def _read_async(self, key: str, field, fetch):
+    if not self._cacheable(key):
+      self.bypasses += 1
+      return await fetch()
+    hit, result = self._lookup(key, field)
+    if hit:
+      return result
+    try:
+      value = await fetch()
+    except BaseException:
+      self._abandon(key, result)
+      raise
+    self._fetched(key, field, result, value)
+    return value
+
+  def _discard_inflight(self, key, token) -> None:
+    tokens = self._inflight.get(key)
+    if tokens is not None:
+      tokens.discard(token)
+      if not tokens:
+        del self._inflight[key]
+
+  def _store(self, entry_key, value) -> None:
+    size = len(value) if value is not None else 0
+    size += len(entry_key[0]) + 64
+    if size > self.max_bytes:
+      return
+    self._remove(entry_key)
+    self._entries[entry_key] = (value, size, time.monotonic())
+    self._fields.setdefault(entry_key[0], set()).add(entry_key[1])
+    self._bytes += size
+    while self._bytes > self.max_bytes:
+      oldest = next(iter(self._entries))
+      self._remove(oldest)
+      self.evictions += 1
+
+  def _remove(self, entry_key) -> None:
+    entry = self._entries.pop(entry_key, None)
+    if entry is None:
+      return
+    self._bytes -= entry[1]
+    fields = self._fields.get(entry_key[0])
+    if fields is not None:
+      fields.discard(entry_key[1])
+      if not fields:
+        del self._fields[entry_key[0]]
+
+  # Writes go straight to Redis. The local copy is dropped right away so
+  # this worker reads its own write even before the push arrives.
+
+  def set(self, key: str, value, **kwargs):
+    result = self._client.set(key, value, **kwargs)
+    self.invalidate([key])
+    return result
+
+  def setex(self, key: str, time_seconds, value):
+    result = self._client.setex(key, time_seconds, value)
+    self.invalidate([key])
+    return result
+
+  def delete(self, *keys):
+    result = self._client.delete(*keys)
+    self.invalidate(keys)
+    return result
+
+  # Invalidation
+
+  def invalidate(self, keys) -> None:
+    with self._lock:
+      for key in keys:
+        if isinstance(key, bytes):
+          key = key.decode()
+        for token in self._inflight.pop(key, ()):
+          token.stale = True
+        for field in list(self._fields.get(key, ())):
+          self._remove((key, field))
+        self.invalidations += 1
+
+  def flush(self) -> None:
+    with self._lock:
+      for tokens in self._inflight.values():
+        for token in tokens:
+          token.stale = True
+      self._inflight.clear()
+      self._entries.clear()
+      self._fields.clear()
+      self._bytes = 0
+      self.flushes += 1
+
+  def _handle_push(self, message) -> None:
+    if not message or message[0] not in (b"invalidate", "invalidate"):
+      return
+    keys = message[1] if len(message) > 1 else None
+    if keys is None:
+      # Sent on FLUSHALL / FLUSHDB.
+      self.flush()
+    else:
+      self.invalidate(keys)
+
+  def _connect(self):
+    import redis
+    from redis._parsers import _RESP3Parser
+
+    kwargs = dict(self._client.connection_pool.connection_kwargs)
+    kwargs.update(protocol=3, parser_class=_RESP3Parser)
+    conn = redis.Connection(**kwargs)
+    conn.connect()
+    args = ["CLIENT", "TRACKING", "ON", "BCAST"]
+    for prefix in self.prefixes:
+      args += ["PREFIX", prefix]
+    conn.send_command(*args)
+    response = conn.read_response()
+    if response not in (b"OK", "OK"):
+      raise redis.ResponseError(f"CLIENT TRACKING failed: {response}")
+    return conn
+
+  def _run(self) -> None:
+    delay = self.reconnect_delay
+    while not self._stopped.is_set():
+      conn = None
+      try:
+        conn = self._connect()
+        self._tracking = True
+        delay = self.reconnect_delay
+        logger.info("Client side caching enabled for %s", ", ".join(self.prefixes))
+        while not self._stopped.is_set():
+          if conn.can_read(timeout=1.0):
+            # Connection.read_response() drops push_request when hiredis is
+            # installed, so read pushes from the RESP3 parser directly.
+            self._handle_push(conn._parser.read_response(push_request=True))
+      except Exception as e:
+        logger.warning("Redis tracking connection lost: %s", e)
+      finally:
+        self._tracking = False
+        self.flush()
+        if conn is not None:
+          conn.disconnect()
+      self._stopped.wait(delay)
+      delay = min(delay * 2, 30)
+
+  def close(self) -> None:
+    self._stopped.set()
+
+  def stats(self) -> dict:
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        "tracking": self._tracking,
+        "hit_ratio": self.hits / lookups if lookups else None,
+        "hits": self.hits,
+        "misses": self.misses,
+        "bypasses": self.bypasses,
+        "invalidations": self.invalidations,
+        "evictions": self.evictions,
+        "flushes": self.flushes,
+        "entries": len(self._entries),
+        "bytes": self._bytes,
+        "max_bytes": self.max_bytes,
+      }
+
+  def __getattr__(self, name):
+    # Everything that is not cached is passed through to the Redis client.
+    return getattr(self._client, name)
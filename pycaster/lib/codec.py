@@ -0,0 +1,70 @@
+"""
+JSON codec for everything stored in Redis and for frame request bodies.
+
+JSON_CODEC picks the implementation: `orjson` (the default, when it is
+installed) or `json`. Both write plain JSON, so values written with either,
+including keys written before this module existed, read back with the
+other. orjson refuses a few things the stdlib accepts: NaN and Infinity
+when reading, integers beyond 64 bits when writing. Those values go through
+the stdlib instead, and are counted in stats().
+
+dumps() returns bytes, which Redis takes as is. loads() takes bytes or str.
+"""
+import json
+import os
+import threading
+from typing import Any, Union
+
+from .utils import setup_logger
+
+
+logger = setup_logger(__name__)
+
+JSON_CODEC = os.getenv("JSON_CODEC", "orjson")
+
+
+def _load_orjson():
+  if JSON_CODEC != "orjson":
+    return None
+  try:
+    import orjson
+  except ImportError:
+    logger.info("orjson is not installed, using the json module")
+    return None
+  return orjson
+
+_orjson = _load_orjson()
+_lock = threading.Lock()
+_stats = {"fallback_dumps": 0, "fallback_loads": 0}
+
+
+def _count(name: str) -> None:
+  with _lock:
+    _stats[name] += 1
+
+
+def stats() -> dict:
+  with _lock:
+    return {"codec": "orjson" if _orjson is not None else "json", **_stats}
+
+
+def dumps(obj: Any) -> bytes:
+  if _orjson is not None:
+    try:
+      # Non-str keys are written as strings, as json.dumps does.
+      return _orjson.dumps(obj, option=_orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+      _count("fallback_dumps")
+  return json.dumps(obj).encode()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+  if _orjson is not None:
+    try:
+      return _orjson.loads(data)
+    except _orjson.JSONDecodeError:
+      # Raises again if this is not JSON the stdlib reads either.
+      value = json.loads(data)
+      _count("fallback_loads")
+      return value
+  return json.loads(data)
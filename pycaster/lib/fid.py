@@ -3,13 +3,13 @@ import os
 import pathlib
 import random
 from typing import Any, Dict, List, Union
-import requests
-import json
 from threading import Thread
 import concurrent.futures
 import queue
+from pycaster.lib import cast_store, neynar, tiered_cache
 from pycaster.lib.utils import setup_logger
-from pycaster.lib.io import r
+from pycaster.lib.io import NEYNAR_API_URL, neynar_headers
+from pycaster.lib.tiered_cache import Uncached, cached, cached_async
 
 
 __current_file_path__ = pathlib.Path(__file__).resolve()
@@ -17,24 +17,59 @@ __current_dir__ = __current_file_path__.parent
 
 logger = setup_logger(__name__)
 
+# Seconds FCUser lookups stay cached (see tiered_cache.py). Empty answers
+# are kept for tiered_cache.NEGATIVE_TTL, casts for less since a user
+# checking a mint criterion may have just casted.
+USER_DATA_TTL = 20*60
+FID_TTL = 24*60*60
+FOLLOWERS_TTL = 10*60
+CASTS_TTL = 60
+CASTS_NEGATIVE_TTL = 15
+
+
+def _user_data_key(fid: int) -> str:
+  if not isinstance(fid, int):
+    raise ValueError("fid must be an integer")
+  return f"user_data:{fid}"
+
+
+def _fid_key(username: str) -> str:
+  return f"username:{username}"
+
+
+def _followers_key(fid: int, limit = 30) -> str:
+  return f"followers:{fid}_{max(150, limit)}"
+
+
+def _casts_key(fid: int, limit = 10) -> str:
+  return f"casts:{fid}_{limit}"
+
+
+def _not_found(response, empty):
+  """
+  `empty` for an answer that says there is nothing (cached briefly), or
+  wrapped in Uncached when Neynar failed.
+  """
+  return empty if response.status_code in (200, 404) else Uncached(empty)
+
+
+def _follower_entries(users: List[dict]):
+  """Cache entries for the users of a follower listing, by TTL."""
+  return {
+    USER_DATA_TTL: {_user_data_key(user['fid']): user for user in users},
+    FID_TTL: {_fid_key(user['username']): user['fid'] for user in users},
+  }
+
 
 class FCUser:
 
   @staticmethod
+  @cached("user_data", _user_data_key, USER_DATA_TTL)
   def get_user_data(fid: int):
     """
     Returns the user data for a given fid
     """
-    if not isinstance(fid, int):
-      raise ValueError("fid must be an integer")
-    cache_key = f"user_data:{fid}"
-    logger.info(f"Attempting to get Cache Key: {cache_key}")
-    cached_value = r.get(cache_key)
-    if cached_value:
-      logger.debug(f"Returning User Data from cache: {cached_value}")
-      return json.loads(cached_value)
-
-    url = f"https://api.neynar.com/v2/farcaster/user/bulk?fids={fid}&viewer_fid={fid}"
+    url = f"{NEYNAR_API_URL}/v2/farcaster/user/bulk?fids={fid}&viewer_fid={fid}"
 
 
     # current_app.logger.info(os.getenv("NEYNAR_API_KEY"))
@@ -43,24 +78,16 @@ class FCUser:
         "api_key": os.getenv("NEYNAR_API_KEY")
     }
 
-    response = requests.get(url, headers=headers)
+    response = neynar.get(url, headers=headers)
 
     if response.status_code == 200:
-      user_data = response.json()
-      if "users" in user_data:
-        users = user_data["users"]
-        if len(users) == 1:
-          r.setex(cache_key, 20*60, json.dumps(users[0]))
-          logger.info("Returning user data from Neynar v2")
-          return users[0]
-        else:
-          logger.info(f"Error fetching user data from Neynar v2: {response.text}")
-          logger.info(response.text, response.status_code)
-          return None
-    else:
-      logger.info(f"Error fetching user data from Neynar v2: {response.text}")
-      logger.info(response.text, response.status_code)
-      return None
+      users = response.json().get("users", [])
+      if len(users) == 1:
+        logger.debug("Returning user data from Neynar v2")
+        return users[0]
+    logger.info("Error fetching user data from Neynar v2: %s %s",
+                response.status_code, response.text)
+    return _not_found(response, None)
 
   @staticmethod
   def get_users_data(fids: List[int]) -> Dict[int, Any]:
@@ -77,7 +104,7 @@ class FCUser:
         try:
             return fid, FCUser.get_user_data(fid)
         except Exception as e:
-            logger.error(f"Error fetching data for fid {fid}: {e}")
+            logger.error("Error fetching data for fid %s: %s", fid, e)
             return fid, None  # or return an error message specific to the failure
 
     # Use ThreadPoolExecutor to run get_user_data in parallel
@@ -94,18 +121,19 @@ class FCUser:
     return results
 
   @staticmethod
+  @cached("casts", _casts_key, CASTS_TTL, CASTS_NEGATIVE_TTL)
   def get_casts(fid: int, limit = 10):
     """
     Returns the text of casts for a given fid
     """
-    url = f"https://api.neynar.com/v1/farcaster/casts?fid={fid}&viewerFid={fid}&limit={limit}"
+    url = f"{NEYNAR_API_URL}/v1/farcaster/casts?fid={fid}&viewerFid={fid}&limit={limit}"
 
     headers = {
         "accept": "application/json",
         "api_key": os.getenv("NEYNAR_API_KEY")
     }
 
-    response = requests.get(url, headers=headers)
+    response = neynar.get(url, headers=headers)
 
     if response.status_code == 200:
       casts_data = response.json()
@@ -113,32 +141,30 @@ class FCUser:
       return [x['text'] for x in casts]
     else:
       # current_app.logger.info(f"Error fetching casts from Neynar v2: {response.text}")
-      return []
+      return _not_found(response, [])
 
   @staticmethod
+  @cached("fid", _fid_key, FID_TTL)
   def get_fid(username: str):
-      cache_key = f"username:{username}"
-      cached_value = r.get(cache_key)
-      if cached_value is not None:
-          return int(cached_value)
-
-      url = f"https://api.neynar.com/v2/farcaster/user/search?q={username}&viewer_fid=1"
+      url = f"{NEYNAR_API_URL}/v2/farcaster/user/search?q={username}&viewer_fid=1"
 
       headers = {
           "accept": "application/json",
           "api_key": os.getenv("NEYNAR_API_KEY")
       }
 
-      response = requests.get(url, headers=headers)
+      response = neynar.get(url, headers=headers)
+      if response.status_code != 200:
+          return _not_found(response, None)
 
       response = response.json()
       if 'result' in response and 'users' in response['result']:
           users = response['result']['users']
           if len(users) > 0:
-              r.set(cache_key, users[0]['fid'])
               return users[0]['fid']
           else:
               return None
+      return Uncached(None)
 
   @staticmethod
   def user_follows_channel(channel_name: str,
@@ -150,7 +176,7 @@ class FCUser:
       For followers ~ 1-2K it's fine, but anything more than that
       it breaks
       """
-      base_url = "https://api.neynar.com/v2/farcaster/channel/followers"
+      base_url = f"{NEYNAR_API_URL}/v2/farcaster/channel/followers"
       params = {"id": channel_name, "limit": 1000}
       headers = {
           "accept": "application/json",
@@ -159,9 +185,9 @@ class FCUser:
 
       user_exists = False
       while True:
-          response = requests.get(base_url, headers=headers, params=params)
+          response = neynar.get(base_url, headers=headers, params=params)
           if response.status_code != 200:
-              logger.info(f"Failed to fetch channel follow data: {response.status_code}")
+              logger.info("Failed to fetch channel follow data: %s", response.status_code)
               break
           data = response.json()
           users = data.get("users", [])
@@ -188,16 +214,10 @@ class FCUser:
       return user_exists
 
   @staticmethod
+  @cached("followers", _followers_key, FOLLOWERS_TTL)
   def get_followers(fid: int, limit = 30):
     limit = max(150, limit)
-    cache_key = f"followers:{fid}_{limit}"
-    cached_data = r.get(cache_key)
-    if cached_data:
-        # If cached data exists, return it after loading from JSON string
-        logger.info("Followers Returning from cache")
-        return json.loads(cached_data)
-
-    base_url = "https://api.neynar.com/v1/farcaster/followers"
+    base_url = f"{NEYNAR_API_URL}/v1/farcaster/followers"
     params = {
       "fid": fid,
       "viewerFid": fid,
@@ -209,36 +229,30 @@ class FCUser:
         "api_key": os.getenv("NEYNAR_API_KEY")
     }
 
-    response = requests.get(base_url, headers=headers, params=params)
+    response = neynar.get(base_url, headers=headers, params=params)
     if response.status_code == 200:
       data = response.json()
       users = data["result"].get("users", [])
-      r.setex(cache_key, 600, json.dumps(users))
       # Also set the cache for the user's followers username, userid relation
-      for user in users:
-          r.set(f"username:{user['username']}", user['fid'])
-          cache_key = f"user_data:{user['fid']}"
-          cache_val = json.dumps(user)
-          logger.info(f"Setting cache::{ cache_key } with value: {cache_val}")
-          r.setex(cache_key, 60*20, cache_val)
-      logger.info("Followers returning from API")
+      tiered_cache.prime(_follower_entries(users))
+      logger.debug("Followers returning from API")
       return users
     else:
-      return []
+      return _not_found(response, [])
 
   @staticmethod
   def get_random_follower(fid: int):
     followers = FCUser.get_followers(fid)
     if len(followers) > 0:
       random_idx = random.randint(0, len(followers) - 1)
-      logger.debug(f"Random index: {random_idx}")
+      logger.debug("Random index: %s", random_idx)
       return followers[random_idx]
     return None
 
   @staticmethod
   def user_follows_user(fid: int, fid2: int = None, username2: str = None) -> bool:
 
-    base_url = "https://api.neynar.com/v1/farcaster/following"
+    base_url = f"{NEYNAR_API_URL}/v1/farcaster/following"
     params = {
       "fid": fid,
       "viewerFid": fid,
@@ -251,7 +265,7 @@ class FCUser:
     }
     user_follows = False
     while True:
-        response = requests.get(base_url, headers=headers, params=params)
+        response = neynar.get(base_url, headers=headers, params=params)
         if response.status_code != 200:
             print(f"Failed to fetch data: {response.status_code}")
             break
@@ -281,6 +295,9 @@ class FCUser:
 
   @staticmethod
   def user_has_casted(fid: int, cast_text: str, count = 10) -> bool:
+    found = cast_store.has_casted(fid, cast_text, count)
+    if found is not None:
+      return found
     casts = FCUser.get_casts(fid, count)
     for cast in casts:
       if cast_text in cast:
@@ -295,6 +312,126 @@ class FCUser:
       username = username.split("/")[-1]
     return username
 
+  # Awaitable counterparts of the methods above, for the async serving mode
+  # (asgi.py). They read and write the same cache keys.
+
+  @staticmethod
+  @cached_async("user_data", _user_data_key, USER_DATA_TTL)
+  async def get_user_data_async(fid: int):
+    response = await neynar.get_async(
+      f"{NEYNAR_API_URL}/v2/farcaster/user/bulk", params={"fids": fid, "viewer_fid": fid},
+      headers=neynar_headers({"accept": "application/json"}))
+    users = response.json().get("users", []) if response.status_code == 200 else []
+    if len(users) != 1:
+      logger.info("Error fetching user data from Neynar v2: %s %s",
+                  response.status_code, response.text)
+      return _not_found(response, None)
+    return users[0]
+
+  @staticmethod
+  async def get_users_data_async(fids: List[int]) -> Dict[int, Any]:
+    async def fetch_data(fid):
+      try:
+        return await FCUser.get_user_data_async(fid)
+      except Exception as e:
+        logger.error("Error fetching data for fid %s: %s", fid, e)
+        return None
+
+    import asyncio
+    users = await asyncio.gather(*(fetch_data(fid) for fid in fids))
+    return dict(zip(fids, users))
+
+  @staticmethod
+  @cached_async("casts", _casts_key, CASTS_TTL, CASTS_NEGATIVE_TTL)
+  async def get_casts_async(fid: int, limit = 10):
+    response = await neynar.get_async(
+      f"{NEYNAR_API_URL}/v1/farcaster/casts",
+      params={"fid": fid, "viewerFid": fid, "limit": limit},
+      headers=neynar_headers({"accept": "application/json"}))
+    if response.status_code != 200:
+      return _not_found(response, [])
+    return [x['text'] for x in response.json()["result"]["casts"]]
+
+  @staticmethod
+  @cached_async("fid", _fid_key, FID_TTL)
+  async def get_fid_async(username: str):
+    response = await neynar.get_async(
+      f"{NEYNAR_API_URL}/v2/farcaster/user/search", params={"q": username, "viewer_fid": 1},
+      headers=neynar_headers({"accept": "application/json"}))
+    if response.status_code != 200:
+      return _not_found(response, None)
+    users = response.json().get('result', {}).get('users')
+    if users is None:
+      return Uncached(None)
+    return users[0]['fid'] if users else None
+
+  @staticmethod
+  async def _any_user_async(url: str, params: dict, users_of, fid: Union[int, None],
+                            username: Union[str, None]) -> bool:
+    """
+    Pages through `url` until a user with `fid` or `username` shows up.
+    `users_of` picks the users out of a page.
+    """
+    params = dict(params)
+    headers = neynar_headers({"accept": "application/json"})
+    while True:
+      response = await neynar.get_async(url, headers=headers, params=params)
+      if response.status_code != 200:
+        logger.info("Failed to fetch %s: %s", url, response.status_code)
+        return False
+      data = response.json()
+      for user in users_of(data):
+        if fid and user["fid"] == fid:
+          return True
+        if username and user["username"].lower() == username.lower():
+          return True
+      next_cursor = data.get("next", {}).get("cursor")
+      if not next_cursor:
+        return False
+      params["cursor"] = next_cursor
+
+  @staticmethod
+  async def user_follows_channel_async(channel_name: str,
+                                       fid: Union[int, None] = None,
+                                       username: Union[str, None] = None) -> bool:
+    return await FCUser._any_user_async(f"{NEYNAR_API_URL}/v2/farcaster/channel/followers",
+                                        {"id": channel_name, "limit": 1000},
+                                        lambda data: data.get("users", []), fid, username)
+
+  @staticmethod
+  @cached_async("followers", _followers_key, FOLLOWERS_TTL)
+  async def get_followers_async(fid: int, limit = 30):
+    limit = max(150, limit)
+    response = await neynar.get_async(
+      f"{NEYNAR_API_URL}/v1/farcaster/followers",
+      params={"fid": fid, "viewerFid": fid, "limit": limit},
+      headers=neynar_headers({"accept": "application/json"}))
+    if response.status_code != 200:
+      return _not_found(response, [])
+    users = response.json()["result"].get("users", [])
+    # Also set the cache for the user's followers username, userid relation
+    await tiered_cache.prime_async(_follower_entries(users))
+    return users
+
+  @staticmethod
+  async def get_random_follower_async(fid: int):
+    followers = await FCUser.get_followers_async(fid)
+    return random.choice(followers) if followers else None
+
+  @staticmethod
+  async def user_follows_user_async(fid: int, fid2: int = None, username2: str = None) -> bool:
+    return await FCUser._any_user_async(f"{NEYNAR_API_URL}/v1/farcaster/following",
+                                        {"fid": fid, "viewerFid": fid, "limit": 150},
+                                        lambda data: data.get("users", []), fid2, username2)
+
+  @staticmethod
+  async def user_has_casted_async(fid: int, cast_text: str, count = 10) -> bool:
+    found = await cast_store.has_casted_async(fid, cast_text, count)
+    if found is not None:
+      return found
+    casts = await FCUser.get_casts_async(fid, count)
+    return any(cast_text in cast for cast in casts)
+
 class MintCriterion:
 
   def __init__(self, follow_channel: str = None,
@@ -359,3 +496,19 @@ class MintCriterion:
 
       # Return whether all criteria were fulfilled and the list of failed criteria
       return all_criteria_fulfilled, failed_criteria
+
+  @staticmethod
+  async def check_mint_criteria_async(fid: int, criterion):
+    """Awaitable check_mint_criteria, with the checks run concurrently."""
+    checks = {}
+    if criterion.follow_channel is not None:
+      checks['follow_channel'] = FCUser.user_follows_channel_async(criterion.follow_channel, fid)
+    if criterion.follow_user is not None:
+      checks['follow_user'] = FCUser.user_follows_user_async(fid, criterion.follow_user)
+    if criterion.cast_text is not None:
+      checks['cast_text'] = FCUser.user_has_casted_async(fid, criterion.cast_text,
+                                                         criterion.casts_to_check)
+    import asyncio
+    results = await asyncio.gather(*checks.values())
+    failed_criteria = [name for name, result in zip(checks, results) if not result]
+    return len(failed_criteria) == 0, failed_criteria
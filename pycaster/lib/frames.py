@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Tuple, Union
+
+from .image import ImageComponent, generate_app_image_complete
+from .io import prefetch_external_images_async
+from .svg import cairo_available, rasterize_svg, render_svg, render_svg_complete
+from .utils import get_numeric_env_var
+
+
+__current_file_path__ = pathlib.Path(__file__).resolve()
+__current_dir__ = __current_file_path__.parent
+__root_dir__ = __current_dir__.parent.parent
+
+# Bump whenever a stack below or a base image changes, so anything keyed on
+# the rendered output (prerendered frames, ETags, CDN keys) is invalidated.
+TEMPLATE_VERSION = "1"
+
+VIEW_FRAME = "frame"
+VIEW_PRE_RATE = "pre_rate"
+VIEW_POST_RATE = "post_rate"
+VIEW_SCREENSHOTS = "screenshots"
+
+SCREENSHOTS_PER_PAGE = 3
+MAX_SCREENSHOT_PAGES = 10
+# Screenshots sit in boxes below the title, spread over the frame width.
+SCREENSHOT_AREA = ((48, 80), (860, 400))
+SCREENSHOT_GAP = 40
+
+# "pillow" draws PNGs directly. "svg" builds an SVG and rasterizes it with
+# cairo, cached by the SVG's hash, and falls back to Pillow without cairo.
+FRAME_RENDERER = os.getenv("FRAME_RENDERER", "pillow")
+
+# Threads that render for the async serving mode. Pillow releases the GIL
+# in most of its drawing and encoding, so more than one per core pays off.
+ASYNC_RENDER_WORKERS = get_numeric_env_var("ASYNC_RENDER_WORKERS", 2 * (os.cpu_count() or 1))
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+def _reset_after_fork():
+  global _render_executor, _render_executor_lock
+  _render_executor = None
+  _render_executor_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+BASE_IMAGES = {
+  VIEW_FRAME: __current_dir__ / "background.png",
+  # The frame background without the QR code, which screenshots would cover.
+  VIEW_SCREENSHOTS: __current_dir__ / "screenshots_background.png",
+  VIEW_PRE_RATE: __root_dir__ / "Pre_Rating.png",
+  VIEW_POST_RATE: __root_dir__ / "Ratings_Thanks.png",
+}
+
+
+def render_digest(_app) -> str:
+  """
+  Hash of the app fields that end up in a rendered image. Other catalog
+  fields (ratings, urls, ...) can change without invalidating renders.
+  """
+  fields = [
+    TEMPLATE_VERSION,
+    _app.get('name'),
+    _app.get('description'),
+    (_app.get('images') or {}).get('logo'),
+    screenshot_urls(_app),
+  ]
+  return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
+
+
+def view_etag(view_type: str, _app, page: Union[int, None] = None, fmt: str = "png") -> str:
+  """
+  Entity tag of a rendered view. It changes whenever the rendered bytes
+  can, and is computed without rendering.
+  """
+  return hashlib.sha1(
+    f"{view_type}:{page}:{fmt}:{FRAME_RENDERER}:{render_digest(_app)}".encode()
+  ).hexdigest()[:24]
+
+
+def screenshot_urls(_app) -> List[str]:
+  app_images = _app.get('images') or {}
+  return app_images.get('screenshots') or app_images.get('mobileScreenshots') or []
+
+
+def screenshot_pages(_app) -> List[List[str]]:
+  """
+  Splits the app's screenshots into carousel pages: one desktop screenshot
+  or SCREENSHOTS_PER_PAGE mobile ones per page.
+  """
+  app_images = _app.get('images') or {}
+  if app_images.get('screenshots'):
+    urls, per_page = app_images['screenshots'], 1
+  else:
+    urls, per_page = app_images.get('mobileScreenshots') or [], SCREENSHOTS_PER_PAGE
+  pages = [urls[i:i + per_page] for i in range(0, len(urls), per_page)]
+  return pages[:MAX_SCREENSHOT_PAGES]
+
+
+def frame_image_components(_app) -> List[ImageComponent]:
+  image_stack = []
+
+  app_logo = ImageComponent(
+    ImageComponent.EXTERNAL_IMAGE,
+    position=(100, 100),
+    external_img_url=_app['images']['logo'],
+    display_type=ImageComponent.DISPLAY_TYPE_CIRCLE,
+    circle_radius=60
+  )
+  image_stack.append(app_logo)
+
+  # Screenshots are shown in their own carousel, see screenshot_components.
+
+  app_name = ImageComponent(
+    ImageComponent.TEXT,
+    position=(120, 80),
+    text=_app['name'],
+    font_size=42,
+    font_color=(140, 82, 255)
+  )
+  image_stack.append(app_name)
+
+  _text = f"{_app['description']}"
+  description = ImageComponent(
+    ImageComponent.TEXT,
+    position=(0, 150),
+    text=_text,
+    font_size=30,
+    font_color=(0, 0, 0)
+  )
+  image_stack.append(description)
+
+  return image_stack
+
+
+def rate_image_components(view_type: str, _app) -> List[ImageComponent]:
+  image_stack = []
+
+  if view_type == VIEW_PRE_RATE:
+    app_logo = ImageComponent(
+      ImageComponent.EXTERNAL_IMAGE,
+      position=(140, 120),
+      external_img_url=_app['images']['logo'],
+      display_type=ImageComponent.DISPLAY_TYPE_CIRCLE,
+      circle_radius=60
+    )
+    image_stack.append(app_logo)
+    app_name = ImageComponent(
+      ImageComponent.TEXT,
+      position=(80, 80),
+      text=f"Rate {_app['name']}",
+      font_size=54,
+      font_color=(0, 0, 0)
+    )
+    image_stack.append(app_name)
+  else:
+    app_name = ImageComponent(
+      ImageComponent.TEXT,
+      position=(100, 80),
+      text=f"Thanks for rating {_app['name']}",
+      font_size=50,
+      font_color=(0, 0, 0)
+    )
+    image_stack.append(app_name)
+
+  return image_stack
+
+
+def screenshot_components(_app, page: int) -> List[ImageComponent]:
+  pages = screenshot_pages(_app)
+  urls = pages[page]
+  per_page = 1 if (_app.get('images') or {}).get('screenshots') else SCREENSHOTS_PER_PAGE
+  image_stack = []
+
+  title = ImageComponent(
+    ImageComponent.TEXT,
+    position=(0, 20),
+    text=f"{_app['name']} ({page + 1}/{len(pages)})",
+    font_size=34,
+    font_color=(140, 82, 255)
+  )
+  image_stack.append(title)
+
+  # Boxes keep their size on a last page that is not full, and are centered.
+  (left, top), (width, height) = SCREENSHOT_AREA
+  box_width = (width - SCREENSHOT_GAP * (per_page - 1)) // per_page
+  left += (width - len(urls) * box_width - (len(urls) - 1) * SCREENSHOT_GAP) // 2
+  for i, url in enumerate(urls):
+    screenshot = ImageComponent(
+      ImageComponent.EXTERNAL_IMAGE,
+      position=(left + i * (box_width + SCREENSHOT_GAP), top),
+      external_img_url=url,
+      display_type=ImageComponent.DISPLAY_TYPE_RECTANGLE,
+      rect_size=(box_width, height)
+    )
+    image_stack.append(screenshot)
+
+  return image_stack
+
+
+def view_components(view_type: str, _app,
+                    page: Union[int, None] = None) -> Tuple[List[ImageComponent], pathlib.Path]:
+  if view_type == VIEW_FRAME:
+    return frame_image_components(_app), BASE_IMAGES[VIEW_FRAME]
+  if view_type == VIEW_SCREENSHOTS:
+    return screenshot_components(_app, page or 0), BASE_IMAGES[VIEW_SCREENSHOTS]
+  return rate_image_components(view_type, _app), BASE_IMAGES[view_type]
+
+
+def render_view_svg(view_type: str, _app, page: Union[int, None] = None) -> str:
+  components, base_image_path = view_components(view_type, _app, page)
+  return render_svg(components, base_image_path)
+
+
+def _render(view_type: str, _app, page: Union[int, None]) -> Tuple[BytesIO, bool]:
+  components, base_image_path = view_components(view_type, _app, page)
+  if FRAME_RENDERER == "svg" and cairo_available():
+    svg, complete = render_svg_complete(components, base_image_path)
+    return BytesIO(rasterize_svg(svg)), complete
+  return generate_app_image_complete(components, base_image_path)
+
+
+def render_view(view_type: str, _app, page: Union[int, None] = None) -> BytesIO:
+  return _render(view_type, _app, page)[0]
+
+
+def render_view_complete(view_type: str, _app,
+                         page: Union[int, None] = None) -> Tuple[bytes, bool]:
+  """
+  PNG of a view, and whether it is complete: False when an external image
+  could not be fetched and was left out, in which case the PNG must not be
+  kept anywhere that outlives the request.
+  """
+  png, complete = _render(view_type, _app, page)
+  return png.getvalue(), complete
+
+
+def _get_render_executor() -> ThreadPoolExecutor:
+  global _render_executor
+  with _render_executor_lock:
+    if _render_executor is None:
+      _render_executor = ThreadPoolExecutor(max_workers=ASYNC_RENDER_WORKERS,
+                                            thread_name_prefix="render")
+    return _render_executor
+
+
+async def render_view_async(view_type: str, _app, page: Union[int, None] = None) -> bytes:
+  """
+  PNG of a view, for the event loop. External images are downloaded on the
+  loop first; the render itself, which then finds them in Redis, runs on
+  the render executor.
+  """
+  return (await render_view_complete_async(view_type, _app, page))[0]
+
+
+async def render_view_complete_async(view_type: str, _app,
+                                     page: Union[int, None] = None) -> Tuple[bytes, bool]:
+  """Awaitable render_view_complete, as render_view_async."""
+  components, _ = view_components(view_type, _app, page)
+  await prefetch_external_images_async([c.external_img_url for c in components
+                                        if c.component_type == ImageComponent.EXTERNAL_IMAGE])
+  import asyncio
+  return await asyncio.get_running_loop().run_in_executor(
+    _get_render_executor(), render_view_complete, view_type, _app, page)
+
+
+def app_views(_app) -> List[Tuple[str, Union[int, None]]]:
+  """
+  Every (view_type, page) that can be rendered for `_app`.
+  """
+  views = [(VIEW_FRAME, None), (VIEW_PRE_RATE, None), (VIEW_POST_RATE, None)]
+  views += [(VIEW_SCREENSHOTS, page) for page in range(len(screenshot_pages(_app)))]
+  return views
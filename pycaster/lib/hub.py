@@ -0,0 +1,365 @@
+"""
+Hedged, circuit broken requests to the Farcaster hubs.
+
+NEYNAR_HUB_URLS lists the hubs to use, in order of preference (default
+NEYNAR_HUB_URL). A request goes to the hub with the lowest recent latency
+(a moving average, so a hub that slows down loses its place quickly) whose
+circuit is closed; hubs without latencies yet come after those, in that
+order. If it has not answered that hub's p95 latency after it was sent
+(waits for the Neynar rate limit do not count), or has failed, the same request
+is sent to the next hub (or the same hub again when there is only one),
+and the first good answer wins. Both requests count against the
+Neynar rate limit (see neynar.py) as foreground calls.
+
+A hub that fails HUB_BREAKER_FAILURES times in a row is skipped for
+HUB_BREAKER_COOLDOWN seconds. After that, a single request probes it
+(half-open): success closes the circuit again, failure restarts the
+cooldown. Connection errors, timeouts, 429s and 5xx are failures; any other
+answer, including a 400 for a bad message, is a good one.
+
+stats() has each hub's state, counters and latency percentiles.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Union
+
+from . import neynar
+from .io import NEYNAR_HUB_URL
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+HUB_URLS = [u.strip().rstrip("/") for u in os.getenv("NEYNAR_HUB_URLS", NEYNAR_HUB_URL).split(",")
+            if u.strip()]
+# Per request, connecting and reading each.
+HUB_TIMEOUT = get_numeric_env_var("HUB_TIMEOUT", 3)
+HUB_BREAKER_FAILURES = get_numeric_env_var("HUB_BREAKER_FAILURES", 5)
+HUB_BREAKER_COOLDOWN = get_numeric_env_var("HUB_BREAKER_COOLDOWN", 10)
+# Bounds of the hedge delay, and the delay used until a hub has
+# HUB_MIN_SAMPLES latencies.
+HUB_HEDGE_MIN_MS = get_numeric_env_var("HUB_HEDGE_MIN_MS", 50)
+HUB_HEDGE_MAX_MS = get_numeric_env_var("HUB_HEDGE_MAX_MS", 2000)
+HUB_HEDGE_DEFAULT_MS = get_numeric_env_var("HUB_HEDGE_DEFAULT_MS", 500)
+HUB_MIN_SAMPLES = 20
+HUB_LATENCY_WINDOW = 500
+# Weight of the latest latency in a hub's moving average.
+HUB_LATENCY_ALPHA = 0.2
+# How often post() checks whether its first request got past the rate limit.
+HUB_SEND_POLL = 0.01
+# Threads sending the requests of post(), up to two per validation.
+HUB_WORKERS = get_numeric_env_var("HUB_WORKERS", 32)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class HubUnavailable(Exception):
+  """No hub gave an answer."""
+
+
+class Endpoint:
+  """One hub: its circuit breaker and recent latencies."""
+
+  def __init__(self, url: str) -> None:
+    self.url = url
+    self.state = CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    # None until the first latency.
+    self.average = None
+    self._probing = False
+    self._latencies = deque(maxlen=HUB_LATENCY_WINDOW)
+    self._lock = threading.Lock()
+    self.counts = {"requests": 0, "failures": 0, "hedges": 0, "wins": 0, "opened": 0}
+
+  def try_acquire(self) -> bool:
+    """
+    Whether a request may be sent now. Past the cooldown of an open circuit
+    this lets a single probe through.
+    """
+    with self._lock:
+      if self.state == CLOSED:
+        return True
+      if self.state == OPEN and time.monotonic() - self.opened_at >= HUB_BREAKER_COOLDOWN:
+        self.state = HALF_OPEN
+      if self.state == HALF_OPEN and not self._probing:
+        self._probing = True
+        return True
+      return False
+
+  def record(self, latency: Union[float, None], ok: bool) -> None:
+    with self._lock:
+      self.counts["requests"] += 1
+      self._probing = False
+      if ok:
+        self._latencies.append(latency)
+        self.average = latency if self.average is None else \
+          HUB_LATENCY_ALPHA * latency + (1 - HUB_LATENCY_ALPHA) * self.average
+        self.failures = 0
+        self.state = CLOSED
+        return
+      self.counts["failures"] += 1
+      self.failures += 1
+      if self.state == HALF_OPEN or self.failures >= HUB_BREAKER_FAILURES:
+        if self.state != OPEN:
+          self.counts["opened"] += 1
+          logger.warning("Hub %s failed %s times, opening its circuit", self.url, self.failures)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+  def abandon(self) -> None:
+    """For a request cancelled before it was answered."""
+    with self._lock:
+      self._probing = False
+
+  def count(self, name: str) -> None:
+    with self._lock:
+      self.counts[name] += 1
+
+  def percentile(self, fraction: float) -> Union[float, None]:
+    with self._lock:
+      latencies = sorted(self._latencies)
+    if not latencies:
+      return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+  def hedge_delay(self) -> float:
+    """Seconds to wait for this hub before hedging, its p95 latency."""
+    with self._lock:
+      samples = len(self._latencies)
+    if samples < HUB_MIN_SAMPLES:
+      return HUB_HEDGE_DEFAULT_MS / 1000
+    p95 = self.percentile(0.95) * 1000
+    return min(HUB_HEDGE_MAX_MS, max(HUB_HEDGE_MIN_MS, p95)) / 1000
+
+  def stats(self) -> dict:
+    p50, p95, p99 = (self.percentile(f) for f in (0.5, 0.95, 0.99))
+    with self._lock:
+      return {
+        "state": self.state,
+        **self.counts,
+        "p50_ms": p50 * 1000 if p50 is not None else None,
+        "p95_ms": p95 * 1000 if p95 is not None else None,
+        "p99_ms": p99 * 1000 if p99 is not None else None,
+      }
+
+
+_endpoints: List[Endpoint] = [Endpoint(url) for url in HUB_URLS]
+_executor = None
+_lock = threading.Lock()
+_stats = {"requests": 0, "hedged": 0, "hedges_won": 0, "short_circuited": 0, "unavailable": 0}
+
+
+def _reset_after_fork():
+  global _endpoints, _executor, _lock
+  _endpoints = [Endpoint(url) for url in HUB_URLS]
+  _executor = None
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count(name: str) -> None:
+  with _lock:
+    _stats[name] += 1
+
+
+def stats() -> dict:
+  with _lock:
+    totals = dict(_stats)
+  return {**totals, "hubs": {e.url: e.stats() for e in _endpoints}}
+
+
+def _choose(after: Endpoint = None) -> Union[Endpoint, None]:
+  """
+  The fastest hub that takes a request, or the next one after `after`
+  (which comes last) for a hedge.
+  """
+  # Stable, so hubs without an average keep their configured order.
+  endpoints = sorted(_endpoints, key=lambda e: (e.average is None, e.average or 0.0))
+  if after is not None:
+    start = endpoints.index(after) + 1
+    endpoints = endpoints[start:] + endpoints[:start]
+  for endpoint in endpoints:
+    if endpoint.try_acquire():
+      return endpoint
+  return None
+
+
+def _good(status: int) -> bool:
+  return status != 429 and status < 500
+
+
+class _Sent:
+  """Called when a request gets past the rate limit; remembers when."""
+  __slots__ = ("at",)
+
+  def __init__(self) -> None:
+    self.at = None
+
+  def __call__(self) -> None:
+    self.at = time.monotonic()
+
+
+def _until_hedge(sent: _Sent, delay: float) -> float:
+  """Seconds left before hedging a request sent at `sent.at`."""
+  if sent.at is None:
+    # Still waiting for the rate limit: the hedge timer has not started.
+    return HUB_SEND_POLL
+  return max(0.0, sent.at + delay - time.monotonic())
+
+
+def _attempt(endpoint: Endpoint, path: str, kwargs: dict, sent: _Sent = None):
+  """Returns (response or None, ok)."""
+  import requests
+  try:
+    response = neynar.request("POST", f"{endpoint.url}{path}", priority=neynar.FOREGROUND,
+                              on_send=sent, timeout=HUB_TIMEOUT, **kwargs)
+  except Exception as e:
+    endpoint.record(None, False)
+    if not isinstance(e, (requests.RequestException, neynar.NeynarThrottled)):
+      raise
+    logger.info("Hub %s failed: %s", endpoint.url, e)
+    return None, False
+  ok = _good(response.status_code)
+  # Time on the wire, without any wait for the rate limit.
+  endpoint.record(response.elapsed.total_seconds(), ok)
+  return response, ok
+
+
+def _get_executor() -> ThreadPoolExecutor:
+  global _executor
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=HUB_WORKERS, thread_name_prefix="hub")
+    return _executor
+
+
+def post(path: str, **kwargs):
+  """
+  POSTs to the hubs, hedged. Returns the first good response, or the last
+  bad one when no hub answered well. Raises HubUnavailable when no hub
+  answered at all.
+  """
+  _count("requests")
+  primary = _choose()
+  if primary is None:
+    _count("short_circuited")
+    raise HubUnavailable("The circuit of every hub is open")
+
+  executor = _get_executor()
+  sent = _Sent()
+  first = executor.submit(_attempt, primary, path, kwargs, sent)
+  pending = {first: primary}
+  delay = primary.hedge_delay()
+  hedged = False
+  last = None
+  while pending:
+    timeout = None if hedged else _until_hedge(sent, delay)
+    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in done:
+      endpoint = pending.pop(future)
+      response, ok = future.result()
+      if ok:
+        _won(endpoint, future is not first)
+        # The other request is left to finish, which still feeds its hub's
+        # latencies and circuit.
+        return response
+      last = response if response is not None else last
+    # Past the hedge delay, or the first request failed.
+    if not hedged and (first not in pending or _until_hedge(sent, delay) == 0):
+      hedged = True
+      hedge = _hedge(primary)
+      if hedge is not None:
+        pending[executor.submit(_attempt, hedge, path, kwargs)] = hedge
+  return _no_good_answer(last)
+
+
+def _won(endpoint: Endpoint, hedge: bool) -> None:
+  endpoint.count("wins")
+  if hedge:
+    _count("hedges_won")
+
+
+def _hedge(primary: Endpoint) -> Union[Endpoint, None]:
+  hedge = _choose(after=primary)
+  if hedge is not None:
+    _count("hedged")
+    hedge.count("hedges")
+  return hedge
+
+
+def _no_good_answer(last):
+  if last is not None:
+    return last
+  _count("unavailable")
+  raise HubUnavailable("No hub answered")
+
+
+# Requests of post_async that lost the race, held until they finish.
+_background_tasks = set()
+
+
+async def _attempt_async(endpoint: Endpoint, path: str, kwargs: dict, sent: _Sent = None):
+  import httpx
+  try:
+    response = await neynar.request_async("POST", f"{endpoint.url}{path}",
+                                          priority=neynar.FOREGROUND, on_send=sent,
+                                          timeout=HUB_TIMEOUT, **kwargs)
+  except Exception as e:
+    endpoint.record(None, False)
+    if not isinstance(e, (httpx.HTTPError, neynar.NeynarThrottled)):
+      raise
+    logger.info("Hub %s failed: %s", endpoint.url, e)
+    return None, False
+  except BaseException:
+    # Cancelled: the answer is unknown.
+    endpoint.abandon()
+    raise
+  ok = _good(response.status_code)
+  endpoint.record(response.elapsed.total_seconds(), ok)
+  return response, ok
+
+
+async def post_async(path: str, **kwargs):
+  """Awaitable post(), with the loop's httpx client."""
+  import asyncio
+  _count("requests")
+  primary = _choose()
+  if primary is None:
+    _count("short_circuited")
+    raise HubUnavailable("The circuit of every hub is open")
+
+  sent = _Sent()
+  first = asyncio.ensure_future(_attempt_async(primary, path, kwargs, sent))
+  pending = {first: primary}
+  delay = primary.hedge_delay()
+  hedged = False
+  last = None
+  try:
+    while pending:
+      timeout = None if hedged else _until_hedge(sent, delay)
+      done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        endpoint = pending.pop(task)
+        response, ok = task.result()
+        if ok:
+          _won(endpoint, task is not first)
+          return response
+        last = response if response is not None else last
+      if not hedged and (first not in pending or _until_hedge(sent, delay) == 0):
+        hedged = True
+        hedge = _hedge(primary)
+        if hedge is not None:
+          pending[asyncio.ensure_future(_attempt_async(hedge, path, kwargs))] = hedge
+    return _no_good_answer(last)
+  finally:
+    for task in pending:
+      _background_tasks.add(task)
+      task.add_done_callback(_background_tasks.discard)
@@ -1,12 +1,14 @@
+import os
 import pathlib
 from typing import List, Tuple, Union
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
-from pycaster.lib.io import get_external_images
+from pycaster.lib.io import fit_size, get_external_images
+from pycaster.lib.shared_store import get_asset_store, template_key
 
+from .text_layers import composite_layer, layout_text, load_font, text_layer_cache, textsize
 from .utils import setup_logger
 from xml.etree.ElementTree import Element, tostring
-from xml.dom.minidom import parseString
 
 
 __current_file_path__ = pathlib.Path(__file__).resolve()
@@ -52,17 +54,13 @@ def paste_external_image_with_border(
     border_color: tuple,
     border_radius: int
 ) -> Image.Image:
-    # Calculate the aspect ratio of the external image.
-    aspect_ratio = external_image.width / external_image.height
-    target_width, target_height = rectangle_dims
     # Resize the external image to fit within the rectangle while maintaining aspect ratio.
-    if target_width / target_height > aspect_ratio:
-        new_height = target_height
-        new_width = int(aspect_ratio * new_height)
+    # Images from get_fitted_image already have the right size.
+    new_width, new_height = fit_size(external_image.size, rectangle_dims)
+    if external_image.size == (new_width, new_height):
+        resized_external_image = external_image
     else:
-        new_width = target_width
-        new_height = int(new_width / aspect_ratio)
-    resized_external_image = external_image.resize((new_width, new_height))
+        resized_external_image = external_image.resize((new_width, new_height))
 
     # Create a mask for rounded corners if needed.
     if border_radius > 0:
@@ -134,47 +132,20 @@ def write_multiline_text_to_image(base: Image,
                                   font_path,
                                   font_size,
                                   font_color = (0, 0, 0)) -> Image:
-    draw = ImageDraw.Draw(base)
-    font = ImageFont.truetype(font_path, font_size)
-
-    # New text width should not fill more than 80% of the image's width
-    max_text_width = int(base.size[0] * 0.8)
-
-    # Split the text into words
-    words = text.split()
-    lines = []
-    line = ''
-
-    # Iterate through the words and build lines of text
-    for word in words:
-        # Check the width of the line with the new word added
-        test_line = line + ' ' + word if line else word
-        test_line_width, _ = textsize(test_line, font=font)
-
-        # If the test line is too wide, start a new line
-        if test_line_width > max_text_width:
-            lines.append(line)  # Add the current line to the lines list
-            line = word  # Start a new line with the current word
-        else:
-            line = test_line  # If not too wide, keep adding words to the current line
+    # Lines are wrapped at 80% of the image's width and centered on it, so
+    # only position[1] is used.
+    if base.mode == 'RGBA':
+        # Drawn from the text layer cache with a single alpha_composite.
+        layer = text_layer_cache.get(text, font_path, font_size, base.size[0], font_color)
+        composite_layer(base, layer, position[1])
+        return base, position[1] + layer.height
 
-    # Make sure to add the last line if it exists
-    if line:
-        lines.append(line)
-
-    # Determine starting position
+    draw = ImageDraw.Draw(base)
+    font = load_font(str(font_path), font_size)
     y = position[1]
-
-    # Draw the lines on the image
-    for line in lines:
-        # Recalculate text width for centering each line
-        line_width, line_height = textsize(line, font=font)
-        # Center the line in the specified position
-        line_position = (base.size[0] / 2 - line_width / 2, y)
-        # Draw the text
-        draw.text(line_position, line, font=font, fill=font_color)
-        # Update the y position for the next line
-        y += line_height
+    for line, x, line_y in layout_text(text, font, base.size[0]):
+        draw.text((x, position[1] + line_y), line, font=font, fill=font_color)
+        y = position[1] + line_y + textsize(line, font=font)[1]
 
     # Return the image and the final y-coordinate after the last line of text
     return base, y
@@ -191,12 +162,6 @@ def create_circle_mask(size):
     draw.ellipse((0, 0) + size, fill=255)
     return mask
 
-def textsize(text, font):
-    im = Image.new(mode="P", size=(0, 0))
-    draw = ImageDraw.Draw(im)
-    _, _, width, height = draw.textbbox((0, 0), text=text, font=font)
-    return width, height
-
 def write_text_to_image_right_of_profile(base: Image, text, profile_pos, circle_radius,
                                          font_path, font_size) -> Image:
     draw = ImageDraw.Draw(base)
@@ -231,52 +196,134 @@ def insert_profile_picture(base: Image.Image, profile_img: Image.Image,
 
     return base
 
+def load_base_image(base_image_path: pathlib.Path) -> Image.Image:
+  """
+  Returns the base image, backed by the pre-decoded RGBA pixels in the
+  shared asset store when available. Pillow copies the pixels on the first
+  write, so the shared mapping is never modified.
+  """
+  store = get_asset_store()
+  mapped = store.current() if store is not None else None
+  if mapped is not None:
+    key = template_key(base_image_path.name)
+    buffer = mapped.get(key)
+    if buffer is not None:
+      meta = mapped.meta(key)
+      return Image.frombuffer(meta["mode"], tuple(meta["size"]), buffer,
+                              "raw", meta["mode"], 0, 1)
+  return Image.open(base_image_path.absolute())
+
+class PillowCompositor:
+  """
+  Draws components with per-call Pillow paste / putalpha / alpha_composite.
+  """
+
+  def __init__(self, base_image: Image.Image) -> None:
+    self.image = base_image
+
+  def circle(self, img: Image.Image, position, radius: int) -> None:
+    self.image = insert_picture_circle(self.image, img, position, radius)
+
+  def rectangle(self, img: Image.Image, position, box) -> None:
+    self.image = paste_external_image_with_border(self.image, img, position, box,
+                                                  (255, 255, 255), 0)
+
+  def text(self, text: str, top: int, font_path, font_size: int, font_color) -> None:
+    self.image, _ = write_multiline_text_to_image(self.image, text, (0, top),
+                                                  font_path=font_path,
+                                                  font_size=font_size,
+                                                  font_color=font_color)
+
+  def result(self) -> Image.Image:
+    return self.image
+
+
+# "pillow" or "numpy". The NumPy compositor keeps the canvas as one array
+# and needs numpy installed; without it renders fall back to Pillow.
+IMAGE_COMPOSITOR = os.getenv("IMAGE_COMPOSITOR", "pillow")
+_compositor_fallback_logged = False
+
+def new_compositor(base_image: Image.Image, backend: str = None, template_key: str = None):
+  """
+  `template_key` identifies an unmodified template, so a backend may keep
+  its own decoded copy.
+  """
+  global _compositor_fallback_logged
+  if (backend or IMAGE_COMPOSITOR) == "numpy":
+    try:
+      from .numpy_compositor import NumpyCompositor
+    except ImportError as e:
+      if not _compositor_fallback_logged:
+        logger.warning("NumPy compositor unavailable (%s), using Pillow", e)
+        _compositor_fallback_logged = True
+    else:
+      return NumpyCompositor(base_image, template_key)
+  return PillowCompositor(base_image)
+
+def compose_app_image(base_image: Image.Image,
+                      components: List[ImageComponent],
+                      external_images: List[Union[Image.Image, None]],
+                      backend: str = None,
+                      template_key: str = None) -> Image.Image:
+  """
+  Draws `components` onto `base_image`. `external_images` holds the fetched
+  image of each component, None for text or a failed fetch.
+  """
+  compositor = new_compositor(base_image, backend, template_key)
+  for component, external_image in zip(components, external_images):
+    if component.component_type == ImageComponent.EXTERNAL_IMAGE and \
+      external_image is not None:
+      if component.display_type == ImageComponent.DISPLAY_TYPE_CIRCLE:
+        compositor.circle(external_image, component.position, component.circle_radius)
+      elif component.display_type == ImageComponent.DISPLAY_TYPE_RECTANGLE:
+        # Center the image in its box
+        width, height = fit_size(external_image.size, component.rect_size)
+        position = (component.position[0] + (component.rect_size[0] - width) // 2,
+                    component.position[1] + (component.rect_size[1] - height) // 2)
+        compositor.rectangle(external_image, position, component.rect_size)
+    elif component.component_type == ImageComponent.TEXT and component.text is not None:
+      font_path = __current_dir__ / "Inter-Medium.ttf"
+      compositor.text(component.text, component.position[1], font_path,
+                      component.font_size, component.font_color)
+  return compositor.result()
+
 def generate_app_image(components: List[ImageComponent],
-                       base_image_path: pathlib.Path = None) -> Image.Image:
+                       base_image_path: pathlib.Path = None) -> BytesIO:
+  return generate_app_image_complete(components, base_image_path)[0]
+
+def generate_app_image_complete(components: List[ImageComponent],
+                                base_image_path: pathlib.Path = None) -> Tuple[BytesIO, bool]:
+  """
+  generate_app_image, and whether the image is complete: False when an
+  external image could not be fetched and was left out.
+  """
   if base_image_path is None:
     base_image_path = __current_dir__ / "background.png"
 
-  base_image = Image.open(base_image_path.absolute())
+  base_image = load_base_image(base_image_path)
   base_width, base_height = base_image.size
-  logger.info(f"Base image size: {base_width}x{base_height}")
-
-  # First fetch any external images in parallel
-  external_images = get_external_images(
-    [c.external_img_url for c in components if c.component_type == ImageComponent.EXTERNAL_IMAGE]
+  logger.debug("Base image size: %sx%s", base_width, base_height)
+
+  # First fetch any external images in parallel. Rectangles come back
+  # already resized to their box.
+  external = [c for c in components if c.component_type == ImageComponent.EXTERNAL_IMAGE]
+  fetched = get_external_images(
+    [c.external_img_url for c in external],
+    [c.rect_size if c.display_type == ImageComponent.DISPLAY_TYPE_RECTANGLE else None
+     for c in external]
     )
+  external_images = dict(zip(map(id, external), fetched))
 
-  for idx, component in enumerate(components):
-    if component.component_type == ImageComponent.EXTERNAL_IMAGE and \
-      external_images[idx] is not None:
-      if component.display_type == ImageComponent.DISPLAY_TYPE_CIRCLE:
-        base_image = insert_picture_circle(base_image,
-                                          external_images[idx],
-                                          component.position,
-                                          component.circle_radius)
-      elif component.display_type == ImageComponent.DISPLAY_TYPE_RECTANGLE:
-        base_image = paste_external_image_with_border(
-          base_image,
-          external_images[idx],
-          component.position,
-          component.rect_size,
-          (255, 255, 255),
-          0
-        )
-    elif component.component_type == ImageComponent.TEXT and component.text is not None:
-      font_path = __current_dir__ / "Inter-Medium.ttf"
-      base_image, _ = write_multiline_text_to_image(base_image,
-                                      component.text,
-                                      component.position,
-                                      font_path=font_path,
-                                      font_size=component.font_size,
-                                      font_color=component.font_color)
+  base_image = compose_app_image(base_image, components,
+                                 [external_images.get(id(c)) for c in components],
+                                 template_key=template_key(base_image_path.name))
 
   # Return the bytes of base_image
   img_byte_arr = BytesIO()
   base_image.save(img_byte_arr, format='PNG')
   img_byte_arr.seek(0)
   # current_app.logger.debug("Returning image")
-  return img_byte_arr
+  return img_byte_arr, all(img is not None for img in fetched)
 
 
 def create_text_svg(text="Hello World\nSecond Line\nThird Line", font_size="16"):
@@ -321,4 +368,4 @@ def create_text_svg(text="Hello World\nSecond Line\nThird Line", font_size="16")
             text_element.text = line_text
             svg.append(text_element)
 
-    return parseString(tostring(svg)).toprettyxml(indent="  ")
+    return tostring(svg, encoding="unicode")
@@ -1,17 +1,15 @@
 import base64
+import functools
 import os
 import pathlib
+import threading
 import requests
 import json
-from openai import OpenAI
-import boto3
-import redis
 from io import BytesIO
-from botocore.exceptions import NoCredentialsError
 from PIL import Image
 from concurrent.futures import ThreadPoolExecutor
 
-from .utils import get_numeric_env_var, setup_logger
+from .utils import LazyJSON, get_numeric_env_var, log_fields, setup_logger
 
 
 __current_file_path__ = pathlib.Path(__file__).resolve()
@@ -19,23 +17,197 @@ __current_dir__ = __current_file_path__.parent
 
 logger = setup_logger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Point at a stand-in (see fake_services) to run without Neynar. Validation
+# goes to NEYNAR_HUB_URLS when it is set, see hub.py.
+NEYNAR_API_URL = os.getenv("NEYNAR_API_URL", "https://api.neynar.com").rstrip("/")
+NEYNAR_HUB_URL = os.getenv("NEYNAR_HUB_URL", "https://api.neynar.com:2281").rstrip("/")
 
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "dappstoreapp")
+# Set to a local S3 (MinIO, moto) to test uploads without AWS.
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+# Where uploaded objects are served from, the CDN in front of the bucket.
+S3_PUBLIC_URL = os.getenv("S3_PUBLIC_URL", "https://d7aseyv2y654x.cloudfront.net").rstrip("/")
+# Objects larger than this are uploaded in concurrent parts.
+S3_MULTIPART_THRESHOLD = get_numeric_env_var("S3_MULTIPART_THRESHOLD_MB", 8)*1024*1024
+
+# Clients for heavy SDKs (openai, boto3, redis) are built on first use and
+# kept per process. Frame routes never touch OpenAI or S3, so workers should
+# not pay for importing them.
+_clients = {}
+_clients_lock = threading.RLock()
+
+def _get_client(name, factory):
+  client = _clients.get(name)
+  if client is None:
+    with _clients_lock:
+      client = _clients.get(name)
+      if client is None:
+        client = _clients[name] = factory()
+  return client
+
+def _reset_clients_after_fork():
+  # Sockets and locks must not be shared with the parent, which matters
+  # when gunicorn preloads the app in the master.
+  global _clients_lock
+  _clients.clear()
+  _clients_lock = threading.RLock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+def _create_openai_client():
+  if os.getenv("OPENAI_CLIENT") == "stub":
+    from .openai_cache import StubOpenAI
+    return StubOpenAI(latency=get_numeric_env_var("OPENAI_STUB_LATENCY_MS", 0) / 1000)
+  from openai import OpenAI
+  return OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=get_numeric_env_var("OPENAI_TIMEOUT", 30),
+                max_retries=get_numeric_env_var("OPENAI_MAX_RETRIES", 2))
+
+def get_openai_client():
+  return _get_client("openai", _create_openai_client)
+
+def _redis_options():
+  return dict(host=os.getenv('REDIS_HOST', 'localhost'),
+              port=get_numeric_env_var('REDIS_PORT',6379),
+              username=os.getenv('REDIS_USERNAME', None),
+              password=os.getenv('REDIS_PASSWORD', None),
+              db=0,
+              protocol=3)
+
+def _create_redis_client():
+  import redis
+  return redis.Redis(**_redis_options())
+
+def get_redis():
+  return _get_client("redis", _create_redis_client)
+
+# Hot keys read on every frame. Reads of these go through a local cache that
+# Redis keeps coherent with invalidation pushes (see client_cache.py).
+CLIENT_CACHE_PREFIXES = os.getenv(
+  "REDIS_CLIENT_CACHE_PREFIXES", "farcaster:,user_data:,pfp:"
+).split(",")
+
+def _create_client_cache():
+  from .client_cache import ClientSideCache
+  return ClientSideCache(get_redis(),
+                         prefixes=[p for p in CLIENT_CACHE_PREFIXES if p],
+                         max_bytes=get_numeric_env_var("REDIS_CLIENT_CACHE_MB", 32)*1024*1024,
+                         max_age=get_numeric_env_var("REDIS_CLIENT_CACHE_MAX_AGE", 300))
+
+def get_client_cache():
+  return _get_client("client_cache", _create_client_cache)
+
+class _LazyClient:
+  """
+  Stand-in for a module level client that is built on first attribute
+  access, so `from pycaster.lib.io import r` stays cheap.
+  """
 
-def get_s3_client():
-  aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-  aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-
-  # Create an S3 client
-  s3_client = boto3.client(
+  def __init__(self, factory) -> None:
+    self._factory = factory
+
+  def __getattr__(self, name):
+    return getattr(self._factory(), name)
+
+r = _LazyClient(get_redis)
+# Same interface as `r`; get/hget of CLIENT_CACHE_PREFIXES keys are served
+# locally when possible.
+r_cache = _LazyClient(get_client_cache)
+
+# Clients for the async serving mode (asgi.py). They belong to the event
+# loop they were made on, so they are kept per loop. asyncio is imported on
+# use, so sync workers do not pay for it.
+ASYNC_HTTP_TIMEOUT = get_numeric_env_var("ASYNC_HTTP_TIMEOUT", 10)
+ASYNC_HTTP_MAX_CONNECTIONS = get_numeric_env_var("ASYNC_HTTP_MAX_CONNECTIONS", 100)
+
+def _get_loop_client(name, factory):
+  import asyncio
+  return _get_client((name, id(asyncio.get_running_loop())), factory)
+
+def _create_async_redis_client():
+  import redis.asyncio
+  return redis.asyncio.Redis(**_redis_options())
+
+def get_async_redis():
+  return _get_loop_client("async_redis", _create_async_redis_client)
+
+def _create_async_http_client():
+  import httpx
+  return httpx.AsyncClient(timeout=ASYNC_HTTP_TIMEOUT, follow_redirects=True,
+                           limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS))
+
+def get_async_http():
+  """Shared httpx.AsyncClient of the running loop."""
+  return _get_loop_client("async_http", _create_async_http_client)
+
+async def close_async_clients():
+  """Closes the async clients of the running loop, on shutdown."""
+  import asyncio
+  loop_id = id(asyncio.get_running_loop())
+  with _clients_lock:
+    clients = [_clients.pop(name) for name in list(_clients)
+               if isinstance(name, tuple) and name[1] == loop_id]
+  for client in clients:
+    await client.aclose()
+
+async def run_sync(fn, *args, **kwargs):
+  """
+  Runs blocking `fn` on the loop's default executor, for the I/O that has
+  no async client (S3, the catalog sync) and for locally cached lookups.
+  """
+  import asyncio
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+async def cache_get_async(key: str):
+  """r_cache.get from the event loop: local hits never leave the process."""
+  return await get_client_cache().get_async(key, lambda: get_async_redis().get(key))
+
+async def cache_hget_async(key: str, field: str):
+  return await get_client_cache().hget_async(key, field,
+                                             lambda: get_async_redis().hget(key, field))
+
+def _create_s3_client():
+  import boto3
+  from botocore.config import Config
+  return boto3.client(
     's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key
+    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+    endpoint_url=S3_ENDPOINT_URL,
+    config=Config(max_pool_connections=get_numeric_env_var("S3_MAX_POOL_CONNECTIONS", 16),
+                  retries={"mode": "standard",
+                           "max_attempts": get_numeric_env_var("S3_MAX_ATTEMPTS", 5)})
   )
 
-  return s3_client
+def get_s3_client():
+  return _get_client("s3", _create_s3_client)
 
+def s3_public_url(key: str) -> str:
+  return f"{S3_PUBLIC_URL}/{key}"
+
+def upload_bytes_to_s3(body: bytes, key: str, content_type: str, cache_control: str = None) -> str:
+  """
+  Uploads `body` under `key` and returns its CDN URL. Raises if the upload
+  still fails after the client's retries.
+  """
+  from boto3.s3.transfer import TransferConfig
+  extra_args = {"ContentType": content_type}
+  if cache_control:
+    extra_args["CacheControl"] = cache_control
+  get_s3_client().upload_fileobj(BytesIO(body), S3_BUCKET_NAME, key, ExtraArgs=extra_args,
+                                 Config=TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD))
+  logger.debug("Uploaded to S3", extra=log_fields("s3", key=key, size=len(body)))
+  return s3_public_url(key)
+
+def _upload_or_log(body: bytes, key: str, content_type: str):
+  from botocore.exceptions import BotoCoreError, ClientError
+  try:
+    return upload_bytes_to_s3(body, key, content_type)
+  except (BotoCoreError, ClientError) as e:
+    logger.warning("Failed to upload %s to S3: %s", key, e)
+    return None
 
 def upload_png_to_s3(png_buffer, hash_key):
     """
@@ -43,69 +215,213 @@ def upload_png_to_s3(png_buffer, hash_key):
 
     Parameters:
     - png_buffer: BytesIO object containing PNG data.
-    - bucket_name: Name of the S3 bucket to upload to.
-    - file_name: S3 key name under which the PNG file will be saved.
+    - hash_key: Name the PNG file is saved under, without extension.
+
+    Returns:
+    - The CDN URL of the file, or None if the upload failed.
     """
-    s3_client = get_s3_client()
-    try:
-        # Rewind the buffer to the beginning before uploading
-        png_buffer.seek(0)
-        file_name = f"roastme/{hash_key}.png"
-        # Upload the PNG data to S3
-        s3_client.upload_fileobj(png_buffer, S3_BUCKET_NAME, file_name)
-        # current_app.logger.info(f"File {file_name} uploaded to {S3_BUCKET_NAME} successfully.")
-
-        # The base S3 URL
-        f"https://dappstoreapp.s3.us-west-2.amazonaws.com/{file_name}.png"
-
-        # The CDN Url
-        return f"https://d7aseyv2y654x.cloudfront.net/{file_name}.png"
-    except NoCredentialsError:
-        # current_app.logger.info("Credentials not available")
-       print("sd")
-    except Exception:
-        # current_app.logger.info(f"Failed to upload file to S3: {e}")
-        print("sdd")
+    return _upload_or_log(png_buffer.getvalue(), f"roastme/{hash_key}.png", "image/png")
+
+# Limits for logos and screenshots fetched from arbitrary URLs. Images are
+# thumbnailed to EXTERNAL_IMAGE_MAX_SIZE, the largest box any ImageComponent
+# draws an external image into, before they are cached.
+EXTERNAL_IMAGE_MAX_BYTES = get_numeric_env_var("EXTERNAL_IMAGE_MAX_BYTES", 8*1024*1024)
+EXTERNAL_IMAGE_MAX_PIXELS = get_numeric_env_var("EXTERNAL_IMAGE_MAX_PIXELS", 25_000_000)
+EXTERNAL_IMAGE_MAX_SIZE = (get_numeric_env_var("EXTERNAL_IMAGE_MAX_WIDTH", 800),
+                           get_numeric_env_var("EXTERNAL_IMAGE_MAX_HEIGHT", 800))
+EXTERNAL_IMAGE_TIMEOUT = get_numeric_env_var("EXTERNAL_IMAGE_TIMEOUT", 10)
+EXTERNAL_IMAGE_TTL = 20*60
+
+class ExternalImageError(Exception):
+  pass
+
+def download_image_bytes(url: str, max_bytes: int = None) -> bytes:
+  """
+  Streams `url` into memory, giving up as soon as it is larger than
+  `max_bytes` instead of buffering the whole body first.
+  """
+  max_bytes = max_bytes or EXTERNAL_IMAGE_MAX_BYTES
+  with requests.get(url, stream=True, timeout=EXTERNAL_IMAGE_TIMEOUT) as response:
+    if response.status_code != 200:
+      raise ExternalImageError(f"{url} returned {response.status_code}")
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+      raise ExternalImageError(f"{url} is {content_length} bytes")
+    data = bytearray()
+    for chunk in response.iter_content(chunk_size=64*1024):
+      data += chunk
+      if len(data) > max_bytes:
+        raise ExternalImageError(f"{url} is larger than {max_bytes} bytes")
+  return bytes(data)
+
+def decode_bounded_image(data: bytes, max_size=None) -> Image.Image:
+  """
+  Decodes `data` into an image no larger than `max_size`. The header is
+  checked before any pixels are decoded, and JPEGs are scaled down by the
+  decoder itself (draft mode), so a huge photo never exists at full size.
+  """
+  max_size = max_size or EXTERNAL_IMAGE_MAX_SIZE
+  img = Image.open(BytesIO(data))
+  if img.format == 'JPEG':
+    img.draft('RGB', max_size)
+  # Other formats are decoded at full size before they can be thumbnailed.
+  width, height = img.size
+  if width * height > EXTERNAL_IMAGE_MAX_PIXELS:
+    raise ExternalImageError(f"Image decodes to {width}x{height} pixels")
+  img.thumbnail(max_size)
+  return img
+
+def load_external_image(url: str) -> Image.Image:
+  img = decode_bounded_image(download_image_bytes(url))
+  logger.debug("Image from url. format: %s size: %s", img.format, img.size)
+  return img
 
 def get_external_image(url):
     # Use the URL as the key to check in Redis
     cache_key = f"pfp:test1:{url}"
-    cached_image = r.get(cache_key)
-    # logger.debug(f"Cache key: {cache_key}, Cached image: {cached_image}")
+    cached_image = r_cache.get(cache_key)
 
     if cached_image:
-        # current_app.logger.debug("Returning from cache")
         # If found in cache, decode and load the image
-        img_data = base64.b64decode(cached_image)
-        img = Image.open(BytesIO(img_data))
-        logger.debug(f"Image from cache. format: {img.format}")
-    else:
-        # If not found in cache, fetch the image, cache it, and return
-        response = requests.get(url)
-        img = Image.open(BytesIO(response.content))
-        logger.debug(f"Image from url. format: {img.format}")
-        if img.format == 'JPEG':
-          img_png = img.convert("RGBA")
-          buffered_png = BytesIO()
-          img_png.save(buffered_png, format="PNG")
-          img = Image.open(BytesIO(buffered_png.getvalue()))
-
-        logger.debug(f"Converted Image format: {img.format}")
-
-        # Serialize and store the image in Redis
-        buffered = BytesIO()
-        img_format = img.format if img.format else 'PNG'
-        img.save(buffered, format=img_format)
-        img_base64 = base64.b64encode(buffered.getvalue())
-        r.setex(cache_key, 20*60, img_base64)
+        img = decode_bounded_image(base64.b64decode(cached_image))
+        logger.debug("Image from cache. format: %s", img.format)
+        return img
+
+    # If not found in cache, fetch the image, cache it, and return
+    try:
+        img = load_external_image(url)
+    except (requests.RequestException, ExternalImageError, OSError, Image.DecompressionBombError) as e:
+        logger.warning("Could not load external image %s: %s", url, e)
+        return None
+
+    # Serialize the thumbnail and store it in Redis
+    img, img_base64 = _encode_thumbnail(img)
+    r_cache.setex(cache_key, EXTERNAL_IMAGE_TTL, img_base64)
 
     return img
 
-def get_external_images(input):
+def _encode_thumbnail(img):
+  """Returns the image as cached, and its PNG as base64."""
+  buffered = BytesIO()
+  if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+    img = img.convert('RGBA')
+  img.save(buffered, format='PNG')
+  return img, base64.b64encode(buffered.getvalue())
+
+async def download_image_bytes_async(url: str, max_bytes: int = None) -> bytes:
+  """Awaitable download_image_bytes."""
+  max_bytes = max_bytes or EXTERNAL_IMAGE_MAX_BYTES
+  async with get_async_http().stream("GET", url, timeout=EXTERNAL_IMAGE_TIMEOUT) as response:
+    if response.status_code != 200:
+      raise ExternalImageError(f"{url} returned {response.status_code}")
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+      raise ExternalImageError(f"{url} is {content_length} bytes")
+    data = bytearray()
+    async for chunk in response.aiter_bytes(64*1024):
+      data += chunk
+      if len(data) > max_bytes:
+        raise ExternalImageError(f"{url} is larger than {max_bytes} bytes")
+  return bytes(data)
+
+async def _fetch_external_image_async(url: str, cache_key: str):
+  import httpx
+  try:
+    data = await download_image_bytes_async(url)
+    # Decoding and thumbnailing are CPU bound.
+    img, img_base64 = await run_sync(lambda: _encode_thumbnail(decode_bounded_image(data)))
+  except (httpx.HTTPError, ExternalImageError, OSError, Image.DecompressionBombError) as e:
+    logger.warning("Could not load external image %s: %s", url, e)
+    return None
+  await get_async_redis().setex(cache_key, EXTERNAL_IMAGE_TTL, img_base64)
+  return img
+
+async def get_external_image_async(url):
+  """Awaitable get_external_image."""
+  cache_key = f"pfp:test1:{url}"
+  cached_image = await cache_get_async(cache_key)
+  if cached_image:
+    return await run_sync(decode_bounded_image, base64.b64decode(cached_image))
+  return await _fetch_external_image_async(url, cache_key)
+
+async def prefetch_external_images_async(urls) -> None:
+  """
+  Downloads and caches the images in `urls` that are not cached yet, so a
+  render on an executor thread finds them all in Redis. Cached images are
+  not decoded.
+  """
+  keys = [f"pfp:test1:{url}" for url in urls]
+  if not keys:
+    return
+  async with get_async_redis().pipeline(transaction=False) as pipe:
+    for key in keys:
+      pipe.exists(key)
+    cached = await pipe.execute()
+  import asyncio
+  await asyncio.gather(*(_fetch_external_image_async(url, key)
+                         for url, key, hit in zip(urls, keys, cached) if not hit))
+
+# Resized copies of external images live much longer than the originals:
+# they are small and keyed by URL and size, so they never go stale.
+FITTED_IMAGE_TTL = get_numeric_env_var("FITTED_IMAGE_TTL", 6*60*60)
+
+def fit_size(size, box):
+  """
+  Largest size with the aspect ratio of `size` that fits in `box`.
+  """
+  target_width, target_height = box
+  if tuple(size) == (target_width, min(size[1], target_height)) or \
+     tuple(size) == (min(size[0], target_width), target_height):
+    # Already fitted, don't let float rounding shave off a pixel.
+    return tuple(size)
+  aspect_ratio = size[0] / size[1]
+  if target_width / target_height > aspect_ratio:
+    return int(aspect_ratio * target_height), target_height
+  return target_width, int(target_width / aspect_ratio)
+
+def get_fitted_image(url, box):
+  """
+  Returns the image at `url` already resized to fit in `box`. The resized
+  copy is cached, so pasting it is a plain copy instead of a resample.
+  """
+  cache_key = f"pfp:fit:{box[0]}x{box[1]}:{url}"
+  cached_image = r_cache.get(cache_key)
+  if cached_image:
+    return Image.open(BytesIO(base64.b64decode(cached_image)))
+
+  img = get_external_image(url)
+  if img is None:
+    return None
+  img = img.convert('RGBA').resize(fit_size(img.size, box), Image.LANCZOS)
+
+  buffered = BytesIO()
+  img.save(buffered, format='PNG')
+  r_cache.setex(cache_key, FITTED_IMAGE_TTL, base64.b64encode(buffered.getvalue()))
+  return img
+
+def get_fitted_image_base64(url, box):
+  """
+  Like get_fitted_image, but returns the cached PNG as base64 without
+  decoding it, for embedding.
+  """
+  cache_key = f"pfp:fit:{box[0]}x{box[1]}:{url}"
+  cached_image = r_cache.get(cache_key)
+  if cached_image:
+    return cached_image
+  if get_fitted_image(url, box) is None:
+    return None
+  return r_cache.get(cache_key)
+
+def _get_image(url, box=None):
+  return get_external_image(url) if box is None else get_fitted_image(url, box)
+
+def get_external_images(input, boxes=None):
     """Fetches profile images from a URL or a list of URLs.
 
     Args:
         input (str or list): A single URL string or a list of URL strings.
+        boxes (list, optional): Per URL (width, height) to fit the image in,
+            or None to fetch it as is.
 
     Returns:
         Image.Image or list of Image.Image: The fetched profile image(s).
@@ -115,8 +431,9 @@ def get_external_images(input):
         return get_external_image(input)
     elif isinstance(input, list):
         # List of URLs, fetch in parallel.
+        boxes = boxes or [None] * len(input)
         with ThreadPoolExecutor() as executor:
-            images = list(executor.map(get_external_image, input))
+            images = list(executor.map(_get_image, input, boxes))
         return images
     else:
         raise ValueError("Input must be a string URL or a list of string URLs.")
@@ -127,82 +444,84 @@ def upload_svg_to_s3(file_text, object_name):
 
   Parameters:
   - file_text: A string containing the SVG file content.
-  - bucket_name: The name of the S3 bucket.
   - object_name: The S3 object name under which the file should be stored.
 
   Returns:
-  - True if file was uploaded, else False.
+  - The CDN URL of the file, or False if the upload failed.
   """
-  s3_client = get_s3_client()
-
-  object_name = f"roastme/{object_name}.svg"
-
-  try:
-    # Upload the SVG content to S3
-    s3_client.put_object(Body=file_text, Bucket=S3_BUCKET_NAME,
-                         Key=object_name, ContentType='image/svg+xml')
-    # current_app.logger.info(f"File {object_name} uploaded to {S3_BUCKET_NAME}.")
-    # return f"https://dappstoreapp.s3.us-west-2.amazonaws.com/{object_name}.svg"
-    return f"https://d7aseyv2y654x.cloudfront.net/{object_name}.svg"
-  except NoCredentialsError:
-    # current_app.logger.info("Credentials not available.")
-    return False
+  return _upload_or_log(file_text.encode(), f"roastme/{object_name}.svg", "image/svg+xml") or False
 
 def upload_json_to_s3(json_obj, object_name):
-  s3_client = get_s3_client()
+  return _upload_or_log(json.dumps(json_obj).encode(), f"roastme/{object_name}.json",
+                        "application/json") or False
 
-  object_name = f"roastme/{object_name}.json"
+def get_openai_response_json(prompt: str):
+  """
+  The JSON object OpenAI answers `prompt` with. Cached, see openai_cache.py.
+  """
+  from .openai_cache import get_response_json
+  return get_response_json(prompt)
 
-  try:
-    # Upload the SVG content to S3
-    s3_client.put_object(Body=json.dumps(json_obj), Bucket=S3_BUCKET_NAME,
-                         Key=object_name, ContentType='application/json')
-    # current_app.logger.info(f"File {object_name} uploaded to {S3_BUCKET_NAME}.")
-    # return f"https://dappstoreapp.s3.us-west-2.amazonaws.com/{object_name}.json"
-    return f"https://d7aseyv2y654x.cloudfront.net/{object_name}.json"
-  except NoCredentialsError:
-    # current_app.logger.info("Credentials not available.")
-    return False
+def get_openai_responses_json(prompts):
+  """
+  Answers a list of prompts concurrently, None for any that failed.
+  """
+  from .openai_cache import get_responses_json
+  return get_responses_json(prompts)
 
-def get_openai_response_json(prompt: str):
-  response = client.chat.completions.create(
-      messages=[{
-        "role": "user",
-        "content": prompt
-        }],
-      response_format={ "type": "json_object" },
-      model="gpt-3.5-turbo-0125"
-    )
-
-  response = response.choices[0].message.content
-  response = json.loads(response)
-  return response
-
-r = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'),
-                port=get_numeric_env_var('REDIS_PORT',6379),
-                username=os.getenv('REDIS_USERNAME', None),
-                password=os.getenv('REDIS_PASSWORD', None),
-                db=0,
-                protocol=3)
+def neynar_headers(headers: dict) -> dict:
+  """
+  `headers` with the Neynar API key. httpx rejects None values, which
+  requests silently drops, so the key is left out when it is not set.
+  """
+  api_key = os.getenv("NEYNAR_API_KEY")
+  return {**headers, "api_key": api_key} if api_key else dict(headers)
 
 def validate_message_hub(message_bytes: str):
-  logger.debug(f"Validating message: {message_bytes}")
-  url = "https://api.neynar.com:2281/v1/validateMessage"
+  logger.debug("Validating message", extra=log_fields("validation", size=len(message_bytes)))
   headers = {
     "Content-Type": "application/octet-stream",
     "api_key": os.getenv("NEYNAR_API_KEY")
   }
-  response = requests.post(url, headers=headers, data=message_bytes)
-  logger.debug(f"Got message from hub: {response.text}")
+  from .hub import HubUnavailable, post
+  try:
+    response = post("/v1/validateMessage", headers=headers, data=message_bytes)
+  except HubUnavailable as e:
+    logger.warning("Could not validate message: %s", e)
+    return {"status": False, "server_code": 503, "error": str(e)}
+  logger.debug("Got message from hub", extra=log_fields("validation", status=response.status_code))
 
   if response.status_code == 200:
     response = response.json()
-    logger.debug(f"Validated message: {response}")
+    logger.debug("Validated message", extra=log_fields("validation", response=LazyJSON(response)))
     return response
   else:
-    logger.info(f"Error validating message: {response.text}")
+    logger.info("Error validating message: %s", response.text)
     return {
       "status": False,
       "server_code": response.status_code,
       "error": response.text
     }
+
+async def validate_message_hub_async(message_bytes: bytes):
+  """Awaitable validate_message_hub."""
+  logger.debug("Validating message", extra=log_fields("validation", size=len(message_bytes)))
+  headers = neynar_headers({"Content-Type": "application/octet-stream"})
+  from .hub import HubUnavailable, post_async
+  try:
+    response = await post_async("/v1/validateMessage", headers=headers, content=message_bytes)
+  except HubUnavailable as e:
+    logger.warning("Could not validate message: %s", e)
+    return {"status": False, "server_code": 503, "error": str(e)}
+  logger.debug("Got message from hub", extra=log_fields("validation", status=response.status_code))
+
+  if response.status_code == 200:
+    response = response.json()
+    logger.debug("Validated message", extra=log_fields("validation", response=LazyJSON(response)))
+    return response
+  logger.info("Error validating message: %s", response.text)
+  return {
+    "status": False,
+    "server_code": response.status_code,
+    "error": response.text
+  }
@@ -1,39 +1,289 @@
+import hashlib
 import http.client
 import json
 import os
+import time
+from threading import Thread
+from typing import List, Union
+from urllib.parse import urlsplit
 
+from pycaster.lib import codec
+from pycaster.lib.frames import render_digest
 from pycaster.lib.utils import setup_logger
-from pycaster.lib.io import r
+from pycaster.lib.io import (cache_get_async, cache_hget_async, get_async_http, r, r_cache,
+                             run_sync)
+from pycaster.lib.shared_store import get_asset_store
 
 logger = setup_logger(__name__)
 
-def get_apps():
-  cache_key = "farcaster:apps"
-  cached_val = r.get(cache_key)
-  if cached_val:
-    return json.loads(cached_val)
+# The catalog is stored per app so a render only transfers the app it needs:
+#
+#   farcaster:apps:version              current catalog version
+#   farcaster:apps:v:<version>          hash of dappId -> app JSON
+#   farcaster:apps:index:v:<version>    JSON list of dappIds, in Meroku order
+#   farcaster:apps:digests:v:<version>  hash of dappId -> "<content>:<render>"
+#   farcaster:apps:fresh                set while the catalog is fresh
+#
+# A new version is written next to the old one and the version key is
+# flipped in the same MULTI, so readers see either catalog in full. The old
+# version is kept for CATALOG_GRACE seconds for readers that already hold it.
+# When the fresh key expires the current version keeps being served while
+# one process syncs the changes from Meroku (see catalog_sync.py).
+CATALOG_VERSION_KEY = "farcaster:apps:version"
+CATALOG_FRESH_KEY = "farcaster:apps:fresh"
+CATALOG_LOCK_KEY = "farcaster:apps:lock"
+CATALOG_TTL = 60*60*12
+CATALOG_GRACE = 60
 
-  conn = http.client.HTTPSConnection("api.meroku.store")
+# Point at a stand-in (see fake_services) to run without Meroku.
+MEROKU_API_URL = os.getenv("MEROKU_API_URL", "https://api.meroku.store").rstrip("/")
+
+def meroku_connection():
+  """
+  Returns a connection to MEROKU_API_URL and the path prefix of its routes.
+  """
+  url = urlsplit(MEROKU_API_URL)
+  if url.scheme == "http":
+    return http.client.HTTPConnection(url.netloc), url.path
+  return http.client.HTTPSConnection(url.netloc), url.path
+
+def catalog_key(version: str) -> str:
+  return f"farcaster:apps:v:{version}"
+
+def catalog_index_key(version: str) -> str:
+  return f"farcaster:apps:index:v:{version}"
+
+def catalog_digests_key(version: str) -> str:
+  return f"farcaster:apps:digests:v:{version}"
+
+def catalog_keys(version: str) -> List[str]:
+  return [catalog_key(version), catalog_index_key(version), catalog_digests_key(version)]
+
+def catalog_version(apps) -> str:
+  return hashlib.sha1(json.dumps(apps, sort_keys=True).encode()).hexdigest()[:16]
+
+def app_digests(_app) -> str:
+  """
+  Returns "<content digest>:<render digest>". The first changes with any
+  field, the second only with fields that end up in a rendered image.
+  """
+  content = hashlib.sha1(json.dumps(_app, sort_keys=True).encode()).hexdigest()
+  return f"{content}:{render_digest(_app)}"
+
+def _check_freshness():
+  """
+  For reads served by the asset store, which skip get_catalog_version():
+  starts the sync of a stale catalog all the same, so the store is
+  republished with Meroku's changes.
+  """
+  try:
+    if r_cache.get(CATALOG_FRESH_KEY) is None:
+      refresh_catalog_in_background()
+  except Exception as e:
+    # The store keeps serving while Redis is down.
+    logger.debug("Could not check catalog freshness: %s", e)
+
+async def _check_freshness_async():
+  try:
+    if await cache_get_async(CATALOG_FRESH_KEY) is None:
+      await run_sync(refresh_catalog_in_background)
+  except Exception as e:
+    logger.debug("Could not check catalog freshness: %s", e)
+
+def get_app(app_id: str):
+  """
+  Returns a single app, with one HGET against the current catalog version.
+  """
+  store = get_asset_store()
+  if store is not None:
+    apps = store.catalog_by_id()
+    if apps is not None:
+      _check_freshness()
+      return apps.get(app_id)
+
+  version = get_catalog_version()
+  if version is None:
+    return None
+  value = r_cache.hget(catalog_key(version), app_id)
+  return codec.loads(value) if value is not None else None
+
+def get_app_ids() -> List[str]:
+  store = get_asset_store()
+  if store is not None:
+    apps = store.catalog()
+    if apps is not None:
+      _check_freshness()
+      return [x['dappId'] for x in apps]
+
+  version = get_catalog_version()
+  if version is None:
+    return []
+  value = r_cache.get(catalog_index_key(version))
+  return codec.loads(value) if value is not None else []
+
+async def get_app_async(app_id: str):
+  """Awaitable get_app."""
+  store = get_asset_store()
+  if store is not None:
+    apps = store.catalog_by_id()
+    if apps is not None:
+      await _check_freshness_async()
+      return apps.get(app_id)
+
+  version = await get_catalog_version_async()
+  if version is None:
+    return None
+  value = await cache_hget_async(catalog_key(version), app_id)
+  return codec.loads(value) if value is not None else None
+
+async def get_app_ids_async() -> List[str]:
+  """Awaitable get_app_ids."""
+  store = get_asset_store()
+  if store is not None:
+    apps = store.catalog()
+    if apps is not None:
+      await _check_freshness_async()
+      return [x['dappId'] for x in apps]
+
+  version = await get_catalog_version_async()
+  if version is None:
+    return []
+  value = await cache_get_async(catalog_index_key(version))
+  return codec.loads(value) if value is not None else []
+
+def fetch_apps():
+  """
+  Returns the whole catalog from Redis, refreshing it from Meroku if needed.
+  """
+  version = get_catalog_version()
+  if version is None:
+    return []
+  app_ids = codec.loads(r_cache.get(catalog_index_key(version)) or b"[]")
+  if not app_ids:
+    return []
+  values = r.hmget(catalog_key(version), app_ids)
+  return [codec.loads(v) for v in values if v is not None]
+
+def get_current_version() -> Union[str, None]:
+  version = r_cache.get(CATALOG_VERSION_KEY)
+  return version.decode() if isinstance(version, bytes) else version
+
+def get_catalog_version() -> Union[str, None]:
+  """
+  Returns the current catalog version. A stale catalog is served as is and
+  synced in the background; when there is no catalog at all it is loaded
+  from Meroku, with other processes waiting briefly for that load.
+  """
+  version = get_current_version()
+  if version is not None:
+    if r_cache.get(CATALOG_FRESH_KEY) is None:
+      refresh_catalog_in_background()
+    return version
+
+  locked = r.set(CATALOG_LOCK_KEY, os.getpid(), nx=True, ex=30)
+  if not locked:
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+      time.sleep(0.1)
+      version = r.get(CATALOG_VERSION_KEY)
+      if version is not None:
+        return version.decode()
+
+  try:
+    apps = fetch_catalog()
+    if not apps:
+      return None
+    return store_catalog(apps)
+  finally:
+    if locked:
+      r.delete(CATALOG_LOCK_KEY)
+
+async def get_catalog_version_async() -> Union[str, None]:
+  """
+  Awaitable get_catalog_version. The first load of the catalog, which
+  waits on Meroku and on other processes, runs on an executor.
+  """
+  version = await cache_get_async(CATALOG_VERSION_KEY)
+  if version is None:
+    return await run_sync(get_catalog_version)
+  if await cache_get_async(CATALOG_FRESH_KEY) is None:
+    await run_sync(refresh_catalog_in_background)
+  return version.decode() if isinstance(version, bytes) else version
+
+def refresh_catalog_in_background() -> bool:
+  """
+  Starts a catalog sync in a background thread unless another process is
+  already running one.
+  """
+  if not r.set(CATALOG_LOCK_KEY, os.getpid(), nx=True, ex=120):
+    return False
+
+  def _sync():
+    from pycaster.lib.catalog_sync import sync_catalog
+    try:
+      sync_catalog()
+    except Exception as e:
+      logger.error("Catalog sync failed: %s", e)
+    finally:
+      r.delete(CATALOG_LOCK_KEY)
+
+  Thread(target=_sync, daemon=True).start()
+  return True
+
+def publish_version(pipe, version: str, previous: Union[str, None]) -> None:
+  """
+  Queues the commands that make `version` current on a MULTI pipeline.
+  """
+  pipe.persist(catalog_key(version))
+  pipe.persist(catalog_index_key(version))
+  pipe.persist(catalog_digests_key(version))
+  pipe.set(CATALOG_VERSION_KEY, version)
+  pipe.set(CATALOG_FRESH_KEY, 1, ex=CATALOG_TTL)
+  if previous is not None and previous != version:
+    for key in catalog_keys(previous):
+      pipe.expire(key, CATALOG_GRACE)
+
+def store_catalog(apps) -> str:
+  """
+  Writes `apps` as a new catalog version and makes it current atomically.
+  """
+  version = catalog_version(apps)
+  previous = r.get(CATALOG_VERSION_KEY)
+  previous = previous.decode() if previous is not None else None
+
+  pipe = r.pipeline(transaction=True)
+  pipe.delete(*catalog_keys(version))
+  pipe.hset(catalog_key(version), mapping={x['dappId']: codec.dumps(x) for x in apps})
+  pipe.hset(catalog_digests_key(version), mapping={x['dappId']: app_digests(x) for x in apps})
+  pipe.set(catalog_index_key(version), codec.dumps([x['dappId'] for x in apps]))
+  publish_version(pipe, version, previous)
+  pipe.execute()
+  r_cache.invalidate([CATALOG_VERSION_KEY, CATALOG_FRESH_KEY])
+  logger.info("Stored catalog version %s with %s apps", version, len(apps))
+  return version
+
+def fetch_catalog():
+  """Fetches the full catalog from the Meroku API."""
+  conn, prefix = meroku_connection()
 
   headers = {
       'Accept': "application/json",
       'apikey': os.getenv("MEROKU_API_KEY")
   }
 
-  conn.request("GET", "/api/v1/dapp/search?storeKey=farcaster", headers=headers)
+  conn.request("GET", f"{prefix}/api/v1/dapp/search?storeKey=farcaster", headers=headers)
 
   res = conn.getresponse()
-  logger.info(f"Meroku API response: {res.status}")
+  logger.info("Meroku API response: %s", res.status)
   if res.status != 200:
     return []
 
   data = res.read()
   data = json.loads(data)["data"]
-  r.set(cache_key, json.dumps(data), ex=60*60*12)
   return data
 
 def rate_app(appId: str, rating: int, fid: int):
-  conn = http.client.HTTPSConnection("api.meroku.store")
+  conn, prefix = meroku_connection()
   payload = {
     "dappId": appId,
     "rating": rating,
@@ -49,7 +299,7 @@ def rate_app(appId: str, rating: int, fid: int):
       'apikey': os.getenv("MEROKU_API_KEY")
   }
 
-  conn.request("POST", "/api/v1/dapp/rate", json.dumps(payload), headers)
+  conn.request("POST", f"{prefix}/api/v1/dapp/rate", json.dumps(payload), headers)
 
   res = conn.getresponse()
   if res.status != 200:
@@ -58,3 +308,24 @@ def rate_app(appId: str, rating: int, fid: int):
   data = res.read()
   data = json.loads(data)
   return data
+
+
+def _meroku_headers(**headers) -> dict:
+  api_key = os.getenv("MEROKU_API_KEY")
+  return {**headers, 'apikey': api_key} if api_key else headers
+
+async def rate_app_async(appId: str, rating: int, fid: int):
+  """Awaitable rate_app."""
+  payload = {
+    "dappId": appId,
+    "rating": rating,
+    "comment": "",
+    "userId": f"fid:{ fid }",
+    "userAddress": "",
+    "version": ""
+  }
+  response = await get_async_http().post(f"{MEROKU_API_URL}/api/v1/dapp/rate", json=payload,
+                                         headers=_meroku_headers(Accept="application/json"))
+  if response.status_code != 200:
+    return []
+  return response.json()
@@ -1,49 +1,135 @@
-from flask import request
-from pycaster.lib.utils import setup_logger
-from pycaster.lib.io import validate_message_hub
+from flask import g, request
+from pycaster.lib.utils import LazyJSON, log_fields, setup_logger
+from pycaster.lib.io import validate_message_hub, validate_message_hub_async
+from pycaster.lib import codec, neynar
 from pycaster.lib.fid import FCUser
 from threading import Thread
 
 logger = setup_logger(__name__)
 
+class FrameContext:
+    """
+    A frame POST, parsed once before the route runs: the payload, the fid
+    and button it carries, and the message data the hub validated. Once the
+    message is set, the fid and button are the validated ones.
+    """
+    __slots__ = ("payload", "fid", "button_index", "message")
+
+    def __init__(self, payload: dict) -> None:
+        self.payload = payload
+        untrusted_data = payload.get('untrustedData') or {}
+        self.fid = untrusted_data.get('fid')
+        self.button_index = untrusted_data.get('buttonIndex')
+        self.message = None
+
+    def trust(self, message) -> None:
+        """Sets the validated message data, and takes the fid and button from it."""
+        self.message = message
+        if message is not None:
+            self.fid = message.get('fid')
+            self.button_index = (message.get('frameActionBody') or {}).get('buttonIndex')
+
+    @classmethod
+    def parse(cls, body: bytes, is_json: bool):
+        """Like request.get_json(silent=True): anything unreadable is an empty payload."""
+        payload = None
+        if is_json and body:
+            try:
+                payload = codec.loads(body)
+            except ValueError:
+                pass
+        return cls(payload if isinstance(payload, dict) else {})
+
 def fetch_followers_in_background(fid):
     # This function will run in a separate thread
     try:
-        FCUser.get_followers(fid)
+        with neynar.priority(neynar.BACKGROUND):
+            FCUser.get_followers(fid)
     except Exception as e:
-        logger.error(f"Error fetching followers: {e}")
+        logger.error("Error fetching followers: %s", e)
 
 def get_users_details_in_background(user_id: int):
     # This function will run in a separate thread
     try:
-        FCUser.get_user_data(user_id)
+        with neynar.priority(neynar.BACKGROUND):
+            FCUser.get_user_data(user_id)
     except Exception as e:
-        logger.error(f"Error fetching user data: {e}")
+        logger.error("Error fetching user data: %s", e)
 
-def validate_request(data):
+def _validated_message(validate_response):
+    if 'valid' in validate_response and validate_response['valid']:
+        _msg_data = validate_response['message']['data']
+        logger.debug("Validated message", extra=log_fields("validation", data=LazyJSON(_msg_data)))
+        return _msg_data
+    return None
+
+def validated_message(data):
+    """The message data of a valid frame payload, or None."""
     if 'trustedData' in data and 'messageBytes' in data['trustedData']:
-        validate_response = validate_message_hub(bytes.fromhex(data['trustedData']['messageBytes']))
-        if 'valid' in validate_response and validate_response['valid']:
-            _msg_data = validate_response['message']['data']
-            logger.debug(f"Validated message: {_msg_data}")
-            if _msg_data['fid'] == data['untrustedData']['fid']:
-                return True
-            return True
-    return False
+        return _validated_message(
+            validate_message_hub(bytes.fromhex(data['trustedData']['messageBytes'])))
+    return None
+
+def validate_request(data):
+    return validated_message(data) is not None
 
 def check_trusted_data():
     # Only apply the check to POST requests
     if request.method == 'POST':
-        json_data = request.get_json(silent=True) or {}
-        logger.info(json_data)
-        fid = json_data.get('untrustedData', {}).get('fid')
-        if fid:
+        frame = g.frame = FrameContext.parse(request.get_data(), request.is_json)
+        logger.debug("Frame request", extra=log_fields("request", payload=LazyJSON(frame.payload)))
+        if frame.fid:
             Thread(target=fetch_followers_in_background,
-                   args=(fid,),
+                   args=(frame.fid,),
                    daemon=True).start()
             Thread(target=get_users_details_in_background,
-                    args=(fid,),
+                    args=(frame.fid,),
                     daemon=True).start()
-        return validate_request(json_data)
+        frame.trust(validated_message(frame.payload))
+        return frame.message is not None
+
+    return True
+
+
+# Background fetches of the async mode. The loop only keeps weak references
+# to tasks, so they are held here until they finish.
+_background_tasks = set()
+
+async def _in_background(coro, what: str):
+    try:
+        # The task has its own context, so this only applies to `coro`.
+        with neynar.priority(neynar.BACKGROUND):
+            await coro
+    except Exception as e:
+        logger.error("Error fetching %s: %s", what, e)
+
+def _spawn(coro, what: str):
+    import asyncio
+    task = asyncio.ensure_future(_in_background(coro, what))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def validated_message_async(data):
+    """Awaitable validated_message."""
+    if 'trustedData' in data and 'messageBytes' in data['trustedData']:
+        return _validated_message(await validate_message_hub_async(
+            bytes.fromhex(data['trustedData']['messageBytes'])))
+    return None
+
+async def validate_request_async(data):
+    return await validated_message_async(data) is not None
+
+async def check_trusted_data_async(method: str, frame: FrameContext):
+    """
+    check_trusted_data for a request of the async mode, whose FrameContext
+    (None for other methods) the caller parsed.
+    """
+    if method == 'POST':
+        logger.debug("Frame request", extra=log_fields("request", payload=LazyJSON(frame.payload)))
+        if frame.fid:
+            _spawn(FCUser.get_followers_async(frame.fid), "followers")
+            _spawn(FCUser.get_user_data_async(frame.fid), "user data")
+        frame.trust(await validated_message_async(frame.payload))
+        return frame.message is not None
 
     return True
@@ -0,0 +1,373 @@
+"""
+Rate limited Neynar requests.
+
+Every call to the Neynar API and hub goes through request() (or
+request_async()), which takes a token from a bucket shared by all workers
+in Redis and a slot from this worker's concurrency limit before sending it.
+
+The bucket refills at NEYNAR_RATE_LIMIT requests a second, up to
+NEYNAR_BURST. Calls have a priority class, and lower classes leave part of
+the bucket untouched, so frame validation still gets through when
+background prefetches have drained it:
+
+  foreground  validate_message_hub, what a frame response waits on
+  normal      lookups made while serving (mint checks, user data)
+  background  prefetches of followers and user data
+
+The concurrency limit adapts (AIMD): it grows by one per limit's worth of
+successful calls and halves on a 429, at most once a second. A 429 also
+pauses every worker for its Retry-After. A foreground or normal call that
+waits longer than its class allows is sent anyway; a background one gives
+up with NeynarThrottled.
+
+Without Redis the bucket is skipped, and only the concurrency limit holds.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+import requests
+
+from .io import get_async_http, get_async_redis, r
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+FOREGROUND = "foreground"
+NORMAL = "normal"
+BACKGROUND = "background"
+
+# Requests a second for all workers together. 0 disables the bucket.
+NEYNAR_RATE_LIMIT = get_numeric_env_var("NEYNAR_RATE_LIMIT", 10)
+NEYNAR_BURST = get_numeric_env_var("NEYNAR_BURST", 20)
+NEYNAR_MAX_CONCURRENCY = get_numeric_env_var("NEYNAR_MAX_CONCURRENCY", 16)
+NEYNAR_TIMEOUT = get_numeric_env_var("NEYNAR_TIMEOUT", 10)
+# Pause after a 429 without a Retry-After.
+NEYNAR_BACKOFF_MS = get_numeric_env_var("NEYNAR_BACKOFF_MS", 1000)
+
+BUCKET_KEY = "neynar:ratelimit:bucket"
+BACKOFF_KEY = "neynar:ratelimit:backoff"
+DECREASE_INTERVAL = 1.0
+
+# Per class: share of the bucket it must leave for higher classes, share of
+# the concurrency limit it may use, and how long it waits for both.
+PRIORITIES = {
+  FOREGROUND: {"reserve": 0.0, "share": 1.0, "max_wait": 1.0},
+  NORMAL: {"reserve": 0.25, "share": 1.0, "max_wait": 5.0},
+  BACKGROUND: {"reserve": 0.5, "share": 0.5, "max_wait": 10.0},
+}
+
+# Returns 0 when a token was taken, else the milliseconds to wait before
+# one is available with `reserve` tokens left over.
+TAKE_TOKEN = """
+local backoff = redis.call('PTTL', KEYS[2])
+if backoff > 0 then return backoff end
+local rate, burst, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 + reserve then
+  tokens = tokens - 1
+else
+  wait = math.ceil((1 + reserve - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+_priority = ContextVar("neynar_priority", default=NORMAL)
+
+
+class NeynarThrottled(Exception):
+  """A background call gave up waiting for the rate limit."""
+
+
+class AdaptiveConcurrency:
+  """In-flight limit of one worker, grown additively and cut in half on 429s."""
+
+  def __init__(self, maximum: int, minimum: int = 1) -> None:
+    self.maximum = maximum
+    self.minimum = minimum
+    self.limit = float(maximum)
+    self.in_flight = 0
+    self._decreased_at = 0.0
+    self._cond = threading.Condition()
+
+  def _allowed(self, share: float) -> int:
+    return max(self.minimum, int(self.limit * share))
+
+  def try_acquire(self, share: float = 1.0) -> bool:
+    with self._cond:
+      if self.in_flight < self._allowed(share):
+        self.in_flight += 1
+        return True
+      return False
+
+  def acquire(self, share: float = 1.0, timeout: float = None) -> bool:
+    with self._cond:
+      if not self._cond.wait_for(lambda: self.in_flight < self._allowed(share), timeout):
+        return False
+      self.in_flight += 1
+      return True
+
+  def force_acquire(self) -> None:
+    """Takes a slot over the limit, for a call sent anyway."""
+    with self._cond:
+      self.in_flight += 1
+
+  def release(self, throttled: bool = False, succeeded: bool = False) -> None:
+    with self._cond:
+      self.in_flight -= 1
+      now = time.monotonic()
+      if throttled:
+        if now - self._decreased_at >= DECREASE_INTERVAL:
+          self.limit = max(self.minimum, self.limit / 2)
+          self._decreased_at = now
+      elif succeeded:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      self._cond.notify_all()
+
+
+def _new_stats() -> dict:
+  return {name: {"requests": 0, "waited": 0, "wait_ms": 0.0, "overdrafts": 0, "gave_up": 0}
+          for name in PRIORITIES}
+
+_concurrency = AdaptiveConcurrency(NEYNAR_MAX_CONCURRENCY)
+_lock = threading.Lock()
+_stats = _new_stats()
+_responses = {"429": 0, "errors": 0}
+_script = None
+
+
+def _reset_after_fork():
+  global _concurrency, _lock, _script
+  _concurrency = AdaptiveConcurrency(NEYNAR_MAX_CONCURRENCY)
+  _lock = threading.Lock()
+  _script = None
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def stats() -> dict:
+  with _lock:
+    return {
+      "priorities": {name: dict(values) for name, values in _stats.items()},
+      **_responses,
+      "concurrency_limit": round(_concurrency.limit, 2),
+      "in_flight": _concurrency.in_flight,
+      "rate_limit": NEYNAR_RATE_LIMIT,
+      "burst": NEYNAR_BURST,
+    }
+
+
+def _record(priority: str, waited: float, outcome: str = None) -> None:
+  with _lock:
+    values = _stats[priority]
+    values["requests"] += 1
+    if waited > 0.001:
+      values["waited"] += 1
+      values["wait_ms"] += waited * 1000
+    if outcome is not None:
+      values[outcome] += 1
+
+
+@contextmanager
+def priority(name: str):
+  """Sends the Neynar calls made inside the block with priority `name`."""
+  token = _priority.set(name)
+  try:
+    yield
+  finally:
+    _priority.reset(token)
+
+
+def _token_args(priority: str):
+  return ([BUCKET_KEY, BACKOFF_KEY],
+          [NEYNAR_RATE_LIMIT, NEYNAR_BURST, PRIORITIES[priority]["reserve"] * NEYNAR_BURST])
+
+
+def _take_token(priority: str) -> float:
+  """Milliseconds to wait for a token, 0 once one is taken."""
+  global _script
+  if NEYNAR_RATE_LIMIT <= 0:
+    return 0
+  import redis
+  try:
+    if _script is None:
+      _script = r.register_script(TAKE_TOKEN)
+    keys, args = _token_args(priority)
+    return _script(keys=keys, args=args)
+  except redis.RedisError as e:
+    logger.warning("Neynar rate limit unavailable, not throttling: %s", e)
+    return 0
+
+
+async def _take_token_async(priority: str) -> float:
+  if NEYNAR_RATE_LIMIT <= 0:
+    return 0
+  import redis
+  try:
+    keys, args = _token_args(priority)
+    return await get_async_redis().register_script(TAKE_TOKEN)(keys=keys, args=args)
+  except redis.RedisError as e:
+    logger.warning("Neynar rate limit unavailable, not throttling: %s", e)
+    return 0
+
+
+def _gave_up(priority: str, started: float) -> bool:
+  """
+  Called once `priority` has waited its maximum. Background calls give up,
+  the others are sent anyway.
+  """
+  waited = time.monotonic() - started
+  if priority == BACKGROUND:
+    _record(priority, waited, "gave_up")
+    return True
+  logger.info("Neynar %s call waited %.1fs for the rate limit, sending it anyway",
+              priority, waited)
+  return False
+
+
+def _observe(priority: str, waited: float, overdraft: bool, status: int, retry_after):
+  """
+  Records a response. Returns how long every worker should back off for,
+  in milliseconds, after a 429.
+  """
+  _record(priority, waited, "overdrafts" if overdraft else None)
+  if status != 429:
+    return None
+  with _lock:
+    _responses["429"] += 1
+  try:
+    backoff_ms = int(float(retry_after) * 1000) if retry_after else NEYNAR_BACKOFF_MS
+  except ValueError:
+    backoff_ms = NEYNAR_BACKOFF_MS
+  logger.warning("Neynar returned 429, backing off %sms", backoff_ms)
+  return max(1, backoff_ms)
+
+
+def request(method: str, url: str, priority: str = None, on_send: Callable[[], None] = None,
+            **kwargs) -> requests.Response:
+  """
+  requests.request() once the rate limit allows it. Raises NeynarThrottled
+  for a background call that waited too long. `on_send` is called once the
+  call is let through, right before it is sent.
+  """
+  priority = priority or _priority.get()
+  plan = PRIORITIES[priority]
+  started = time.monotonic()
+  deadline = started + plan["max_wait"]
+  overdraft = False
+
+  if not _concurrency.acquire(plan["share"], plan["max_wait"]):
+    if _gave_up(priority, started):
+      raise NeynarThrottled(f"{priority} call to {url} waited too long")
+    overdraft = True
+    _concurrency.force_acquire()
+
+  status = None
+  try:
+    while not overdraft:
+      wait_ms = _take_token(priority)
+      if not wait_ms:
+        break
+      if time.monotonic() + wait_ms / 1000 > deadline:
+        if _gave_up(priority, started):
+          raise NeynarThrottled(f"{priority} call to {url} waited too long")
+        overdraft = True
+        break
+      time.sleep(wait_ms / 1000)
+
+    waited = time.monotonic() - started
+    kwargs.setdefault("timeout", NEYNAR_TIMEOUT)
+    if on_send is not None:
+      on_send()
+    try:
+      response = requests.request(method, url, **kwargs)
+    except requests.RequestException:
+      with _lock:
+        _responses["errors"] += 1
+      raise
+    status = response.status_code
+    backoff_ms = _observe(priority, waited, overdraft, status, response.headers.get("Retry-After"))
+    if backoff_ms:
+      try:
+        r.set(BACKOFF_KEY, 1, px=backoff_ms, nx=True)
+      except Exception as e:
+        logger.warning("Could not share the Neynar backoff: %s", e)
+    return response
+  finally:
+    _concurrency.release(throttled=status == 429, succeeded=status is not None and status < 400)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+  return request("GET", url, **kwargs)
+
+
+async def request_async(method: str, url: str, priority: str = None,
+                        on_send: Callable[[], None] = None, **kwargs):
+  """Awaitable request(), with the loop's httpx client."""
+  import asyncio
+  import httpx
+  priority = priority or _priority.get()
+  plan = PRIORITIES[priority]
+  started = time.monotonic()
+  deadline = started + plan["max_wait"]
+  overdraft = False
+
+  # The slot is polled: waiting on the condition would block the loop.
+  while not _concurrency.try_acquire(plan["share"]):
+    if time.monotonic() > deadline:
+      if _gave_up(priority, started):
+        raise NeynarThrottled(f"{priority} call to {url} waited too long")
+      overdraft = True
+      _concurrency.force_acquire()
+      break
+    await asyncio.sleep(0.01)
+
+  status = None
+  try:
+    while not overdraft:
+      wait_ms = await _take_token_async(priority)
+      if not wait_ms:
+        break
+      if time.monotonic() + wait_ms / 1000 > deadline:
+        if _gave_up(priority, started):
+          raise NeynarThrottled(f"{priority} call to {url} waited too long")
+        overdraft = True
+        break
+      await asyncio.sleep(wait_ms / 1000)
+
+    waited = time.monotonic() - started
+    if on_send is not None:
+      on_send()
+    try:
+      response = await get_async_http().request(method, url, **kwargs)
+    except httpx.HTTPError:
+      with _lock:
+        _responses["errors"] += 1
+      raise
+    status = response.status_code
+    backoff_ms = _observe(priority, waited, overdraft, status, response.headers.get("Retry-After"))
+    if backoff_ms:
+      try:
+        await get_async_redis().set(BACKOFF_KEY, 1, px=backoff_ms, nx=True)
+      except Exception as e:
+        logger.warning("Could not share the Neynar backoff: %s", e)
+    return response
+  finally:
+    _concurrency.release(throttled=status == 429, succeeded=status is not None and status < 400)
+
+
+async def get_async(url: str, **kwargs):
+  return await request_async("GET", url, **kwargs)
@@ -0,0 +1,132 @@
+"""
+NumPy compositor backend, enabled with IMAGE_COMPOSITOR=numpy.
+
+The template is copied into a single uint8 RGBA array once. Logos, text
+layers and screenshots are blended into it with vectorized integer
+arithmetic, and the array becomes an image once, for encoding. The Pillow
+path instead converts (and so copies) the whole canvas for every logo.
+
+The blends use the same fixed point formulas as Pillow's C code (masked
+paste and alpha_composite), so both backends produce the same pixels.
+"""
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from .image import create_circle_mask
+from .io import fit_size
+from .text_layers import text_layer_cache
+
+
+@lru_cache(maxsize=16)
+def _circle_mask(size: int) -> np.ndarray:
+  mask = np.asarray(create_circle_mask((size, size)), dtype=np.uint32)
+  mask.flags.writeable = False
+  return mask
+
+
+def _shift_div255(value: np.ndarray) -> np.ndarray:
+  # value / 255 rounded down, Pillow's SHIFTFORDIV255.
+  return ((value >> 8) + value) >> 8
+
+
+def _div255(value: np.ndarray) -> np.ndarray:
+  # Rounded value / 255, Pillow's DIV255.
+  return _shift_div255(value + 128)
+
+
+def _rgba(img: Image.Image) -> np.ndarray:
+  return np.asarray(img if img.mode == 'RGBA' else img.convert('RGBA'))
+
+
+# Templates as read-only arrays, by base image path. Copying one is much
+# cheaper than getting the pixels out of a PIL image again.
+_templates = {}
+
+
+class NumpyCompositor:
+  def __init__(self, base_image: Image.Image, template_key: str = None) -> None:
+    template = _templates.get(template_key) if template_key is not None else None
+    if template is None:
+      template = np.array(_rgba(base_image))
+      template.flags.writeable = False
+      if template_key is not None:
+        _templates[template_key] = template
+    self.canvas = template.copy()
+
+  def _clip(self, x: int, y: int, width: int, height: int):
+    """Canvas and source slices of a `width` x `height` box at (x, y)."""
+    canvas_height, canvas_width = self.canvas.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, canvas_width), min(y + height, canvas_height)
+    if left >= right or top >= bottom:
+      return None
+    return ((slice(top, bottom), slice(left, right)),
+            (slice(top - y, bottom - y), slice(left - x, right - x)))
+
+  def circle(self, img: Image.Image, position, radius: int) -> None:
+    size = radius * 2
+    # With no alpha to carry, resizing before the conversion gives the same
+    # pixels and skips converting the full size logo.
+    if img.mode == 'RGB':
+      img = img.resize((size, size)).convert('RGBA')
+    else:
+      img = img.convert('RGBA').resize((size, size))
+    src = np.array(img, dtype=np.uint32)
+    mask = _circle_mask(size)
+    # Like insert_picture_circle: the mask is both the logo's alpha and the
+    # paste mask, for every band.
+    src[..., 3] = mask
+    clipped = self._clip(position[0] - radius, position[1] - radius, size, size)
+    if clipped is None:
+      return
+    dst_box, src_box = clipped
+    dst = self.canvas[dst_box].astype(np.uint32)
+    m = mask[src_box][..., None]
+    self.canvas[dst_box] = _div255(dst * (255 - m) + src[src_box] * m)
+
+  def rectangle(self, img: Image.Image, position, box) -> None:
+    width, height = fit_size(img.size, box)
+    if img.size != (width, height):
+      img = img.resize((width, height))
+    clipped = self._clip(position[0], position[1], width, height)
+    if clipped is None:
+      return
+    dst_box, src_box = clipped
+    self.canvas[dst_box] = _rgba(img)[src_box]
+
+  def text(self, text: str, top: int, font_path, font_size: int, font_color) -> None:
+    layer = text_layer_cache.get(text, font_path, font_size, self.canvas.shape[1], font_color)
+    if layer.image is None:
+      return
+    clipped = self._clip(layer.offset[0], layer.offset[1] + top,
+                         layer.image.width, layer.image.height)
+    if clipped is None:
+      return
+    dst_box, src_box = clipped
+    self._alpha_composite(dst_box, np.asarray(layer.image)[src_box])
+
+  def _alpha_composite(self, dst_box, src: np.ndarray) -> None:
+    # Pillow's ImagingAlphaComposite, 7 bits of fixed point precision. Where
+    # the source is transparent the formulas give back the destination, so
+    # no masking is needed. Every term fits in 32 bits.
+    region = self.canvas[dst_box]
+    if region[..., 3].min() == 255:
+      # Opaque destination (the templates are): the output stays opaque and
+      # coef1 reduces to src_a << 7, so there is no division.
+      src_a = src[..., 3:].astype(np.uint32)
+      blended = (src[..., :3] * src_a + region[..., :3] * (255 - src_a)) << 7
+      region[..., :3] = _shift_div255(blended + (0x80 << 7)) >> 7
+      return
+    dst = region.astype(np.uint32)
+    src = src.astype(np.uint32)
+    src_a, dst_a = src[..., 3:], dst[..., 3:]
+    out_a255 = src_a * 255 + dst_a * (255 - src_a)
+    coef1 = src_a * (255 * 255 * 128) // np.maximum(out_a255, 1)
+    coef2 = 255 * 128 - coef1
+    region[..., :3] = _shift_div255(src[..., :3] * coef1 + dst[..., :3] * coef2 + (0x80 << 7)) >> 7
+    region[..., 3:] = _div255(out_a255)
+
+  def result(self) -> Image.Image:
+    return Image.fromarray(self.canvas)
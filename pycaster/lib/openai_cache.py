@@ -0,0 +1,203 @@
+"""
+Cached OpenAI completions.
+
+Responses are cached in Redis by a hash of the model and prompt, so a prompt
+is sent to OpenAI once per OPENAI_CACHE_TTL however many workers ask for it.
+Identical prompts already in flight wait for the first call instead of making
+their own: in this process through a Future, across workers through a short
+lived Redis lock. OPENAI_MAX_CONCURRENCY bounds the calls a worker makes at
+once.
+
+OPENAI_CLIENT=stub replaces the SDK client with StubOpenAI, which answers
+locally, for running without a key or network.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List
+
+from . import codec
+from .io import get_openai_client, r
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo-0125")
+OPENAI_CACHE_TTL = get_numeric_env_var("OPENAI_CACHE_TTL", 24*60*60)
+OPENAI_MAX_CONCURRENCY = get_numeric_env_var("OPENAI_MAX_CONCURRENCY", 4)
+# Longest a call is expected to take. Other workers wait this long for it
+# before making their own.
+OPENAI_LOCK_TTL = get_numeric_env_var("OPENAI_LOCK_TTL", 60)
+LOCK_POLL_INTERVAL = 0.05
+
+_gate = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+_inflight: Dict[str, Future] = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "coalesced": 0, "calls": 0, "errors": 0}
+
+
+def _reset_after_fork():
+  global _gate, _lock
+  _gate = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+  _inflight.clear()
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count(name: str) -> None:
+  with _lock:
+    _stats[name] += 1
+
+
+def stats() -> dict:
+  with _lock:
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+      "hit_ratio": _stats["hits"] / lookups if lookups else None,
+      **_stats,
+      "inflight": len(_inflight),
+      "max_concurrency": OPENAI_MAX_CONCURRENCY,
+    }
+
+
+def cache_key(prompt: str, model: str) -> str:
+  return f"openai:{model}:{hashlib.sha256(prompt.encode()).hexdigest()}"
+
+
+def _complete(prompt: str, model: str) -> str:
+  with _gate:
+    _count("calls")
+    response = get_openai_client().chat.completions.create(
+      messages=[{
+        "role": "user",
+        "content": prompt
+      }],
+      response_format={"type": "json_object"},
+      model=model
+    )
+  return response.choices[0].message.content
+
+
+def _fetch(key: str, prompt: str, model: str):
+  """
+  Calls OpenAI for `prompt` and caches the answer, unless another worker
+  holding the lock answers it first.
+  """
+  lock_key = f"{key}:lock"
+  token = uuid.uuid4().hex
+  deadline = time.monotonic() + OPENAI_LOCK_TTL
+  while not r.set(lock_key, token, nx=True, ex=OPENAI_LOCK_TTL):
+    cached = r.get(key)
+    if cached is not None:
+      _count("coalesced")
+      return cached
+    if time.monotonic() > deadline:
+      logger.warning("Gave up waiting for another worker's OpenAI call")
+      break
+    time.sleep(LOCK_POLL_INTERVAL)
+  try:
+    # Answered between our cache miss and taking the lock.
+    cached = r.get(key)
+    if cached is not None:
+      return cached
+    content = _complete(prompt, model)
+    # Raises on a malformed answer, which is then not cached.
+    codec.loads(content)
+    r.set(key, content, ex=OPENAI_CACHE_TTL)
+    return content
+  finally:
+    if r.get(lock_key) == token.encode():
+      r.delete(lock_key)
+
+
+def get_response_json(prompt: str, model: str = None):
+  """
+  The JSON object OpenAI answers `prompt` with, from the cache when possible.
+  """
+  model = model or OPENAI_MODEL
+  key = cache_key(prompt, model)
+  cached = r.get(key)
+  if cached is not None:
+    _count("hits")
+    return codec.loads(cached)
+  _count("misses")
+
+  with _lock:
+    future = _inflight.get(key)
+    owner = future is None
+    if owner:
+      future = _inflight[key] = Future()
+  if not owner:
+    _count("coalesced")
+    return codec.loads(future.result())
+
+  try:
+    content = _fetch(key, prompt, model)
+    future.set_result(content)
+  except Exception as e:
+    _count("errors")
+    future.set_exception(e)
+    raise
+  finally:
+    with _lock:
+      _inflight.pop(key, None)
+  # Parsed per caller, so nobody shares a mutable answer.
+  return codec.loads(content)
+
+
+def _get_response_json_or_none(prompt: str, model: str):
+  try:
+    return get_response_json(prompt, model)
+  except Exception as e:
+    logger.warning("OpenAI request failed: %s", e)
+    return None
+
+
+def get_responses_json(prompts: List[str], model: str = None) -> list:
+  """
+  Answers `prompts` concurrently, in order. A failed prompt gives None.
+  Duplicates and cached prompts cost no extra calls.
+  """
+  if not prompts:
+    return []
+  with ThreadPoolExecutor(max_workers=min(len(prompts), OPENAI_MAX_CONCURRENCY)) as executor:
+    return list(executor.map(_get_response_json_or_none, prompts, [model] * len(prompts)))
+
+
+class _StubCompletions:
+  def __init__(self, client) -> None:
+    self._client = client
+
+  def create(self, messages, model, **kwargs):
+    if self._client.latency:
+      time.sleep(self._client.latency)
+    with self._client.lock:
+      self._client.calls += 1
+    prompt = messages[-1]["content"]
+    content = json.dumps({
+      "model": model,
+      "prompt_sha256": hashlib.sha256(prompt.encode()).hexdigest(),
+      "prompt": prompt[:200],
+    })
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class StubOpenAI:
+  """
+  Offline stand-in for openai.OpenAI. Chat completions answer with a JSON
+  object derived from the prompt, after `latency` seconds.
+  """
+
+  def __init__(self, latency: float = 0) -> None:
+    self.latency = latency
+    self.calls = 0
+    self.lock = threading.Lock()
+    self.chat = SimpleNamespace(completions=_StubCompletions(self))
@@ -0,0 +1,286 @@
+"""
+The frame routes, written once for both serving modes.
+
+Each handler is a coroutine taking the `services` of its serving mode, the
+werkzeug request, the request's FrameContext (None unless it is a POST) and
+the URL values. It awaits everything that does I/O through `services`:
+
+- app.py passes SyncServices, whose coroutines call the blocking functions
+  and never suspend. call_sync() runs a handler to completion without an
+  event loop.
+- asgi.py passes AsyncServices, which await the async clients.
+
+`url_map` holds the rules; app.py registers them with Flask and asgi.py
+matches requests against it.
+"""
+import hmac
+import os
+import pathlib
+import random
+from typing import Callable, Dict
+from urllib.parse import quote
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from werkzeug.routing import Map, Rule
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
+
+from . import carousel, cast_store, cdn, codec, hub, neynar, openai_cache, tiered_cache, uploads
+from .frames import VIEW_FRAME, VIEW_POST_RATE, VIEW_PRE_RATE, VIEW_SCREENSHOTS, view_etag
+from .io import get_client_cache
+from .text_layers import text_layer_cache
+from .utils import LazyJSON, app_url, log_fields, setup_logger
+
+
+__current_file_path__ = pathlib.Path(__file__).resolve()
+__current_dir__ = __current_file_path__.parent
+
+logger = setup_logger(__name__)
+
+url_map = Map()
+handlers: Dict[str, Callable] = {}
+# Only builds paths, so it needs no server name.
+_urls = url_map.bind("")
+_templates = Environment(loader=FileSystemLoader(str(__current_dir__.parent / "templates")),
+                         autoescape=select_autoescape())
+
+# Cache-Control of each image route, overridden with CACHE_CONTROL_<ENDPOINT>
+# (ex: CACHE_CONTROL_FRAME_IMAGE). Clients revalidate with the ETag when it
+# runs out, which costs a 304.
+IMAGE_CACHE_CONTROL = {
+  endpoint: os.getenv(f"CACHE_CONTROL_{endpoint.upper()}", default)
+  for endpoint, default in (
+    ('frame_image', "public, max-age=300"),
+    ('image', "public, max-age=300"),
+    ('screenshot_image', "public, max-age=3600"),
+  )
+}
+
+# Bearer token for /internal/stats. Without one the route does not exist.
+INTERNAL_STATS_TOKEN = os.getenv("INTERNAL_STATS_TOKEN")
+
+
+def route(rule: str, methods=("GET",)):
+  def decorator(fn):
+    url_map.add(Rule(rule, endpoint=fn.__name__, methods=list(methods)))
+    handlers[fn.__name__] = fn
+    return fn
+  return decorator
+
+
+def call_sync(handler, *args, **kwargs):
+  """
+  Runs a handler on SyncServices. Nothing it awaits suspends, so the first
+  step of the coroutine runs it to the end.
+  """
+  coro = handler(*args, **kwargs)
+  try:
+    coro.send(None)
+  except StopIteration as done:
+    return done.value
+  coro.close()
+  raise RuntimeError(f"{handler.__name__} suspended outside an event loop")
+
+
+def external_url(endpoint: str, **values) -> str:
+  return f"https://{ app_url }{ _urls.build(endpoint, values) }"
+
+
+def render_template(name: str, **context) -> Response:
+  return Response(_templates.get_template(name).render(**context), mimetype='text/html')
+
+
+async def view_image_url(services, view: str, _app, endpoint: str, **values) -> str:
+  """
+  The view's immutable CDN URL when it is published, else the URL of the
+  route that renders it.
+  """
+  if _app is not None and cdn.CDN_PUBLISH:
+    published = await services.published_url(view, _app, values.get('page'))
+    if published is not None:
+      return published
+  return external_url(endpoint, **values)
+
+
+async def render_app_frame(services, app_id: str) -> Response:
+  _app = await services.get_app(app_id)
+  has_screenshots = _app is not None and carousel.page_count(_app) > 0
+  image_url = await view_image_url(services, VIEW_FRAME, _app, 'frame_image', app_id=app_id)
+  return render_template('index.html', image_url=image_url,
+                         post_url=external_url('action', app_id=app_id),
+                         has_screenshots=has_screenshots)
+
+
+async def render_carousel(services, _app, page: int) -> Response:
+  # Neighbours are rendered while the user looks at this page.
+  carousel.prefetch(_app, [page, page + 1, page - 1])
+  image_url = await view_image_url(services, VIEW_SCREENSHOTS, _app, 'screenshot_image',
+                                   app_id=_app['dappId'], page=page)
+  return render_template('carousel.html', image_url=image_url,
+                         post_url=external_url('screenshots', app_id=_app['dappId'], page=page))
+
+
+async def random_app_frame(services) -> Response:
+  return await render_app_frame(services, random.choice(await services.get_app_ids()))
+
+
+@route('/')
+async def index(services, request, frame):
+  app_ids = await services.get_app_ids()
+  return await render_app_frame(services, app_ids[0])
+
+
+@route('/action/<app_id>', methods=['POST'])
+async def action(services, request, frame, app_id: str):
+  buttonIndex = frame.button_index
+  if buttonIndex == 1:
+    return await random_app_frame(services)
+  elif buttonIndex == 2:
+    user_id = f"fc_user:{ frame.fid }"
+    return redirect(f"https://api.meroku.store/api/v1/o/view/{ app_id }?userId={ user_id }", 302)
+  elif buttonIndex == 3:
+    image_url = await view_image_url(services, VIEW_PRE_RATE, await services.get_app(app_id),
+                                     'image', view_type=VIEW_PRE_RATE, app_id=app_id)
+    return render_template('rate.html', image_url=image_url,
+                           post_url=external_url('rate', app_id=app_id))
+  elif buttonIndex == 4:
+    # Apps with screenshots show a Screenshots button here instead of Cast.
+    _app = await services.get_app(app_id)
+    if _app is not None and carousel.page_count(_app) > 0:
+      return await render_carousel(services, _app, 0)
+    return redirect(external_url('redirect_url', app_id=app_id), 302)
+  return Response("Invalid button", 400)
+
+
+@route('/screenshots/<app_id>/<int:page>', methods=['POST'])
+async def screenshots(services, request, frame, app_id: str, page: int):
+  buttonIndex = frame.button_index
+  _app = await services.get_app(app_id)
+  if _app is None or carousel.page_count(_app) == 0:
+    return await random_app_frame(services)
+
+  if buttonIndex == 1:
+    return await render_carousel(services, _app, (page - 1) % carousel.page_count(_app))
+  elif buttonIndex == 2:
+    return await render_carousel(services, _app, (page + 1) % carousel.page_count(_app))
+  elif buttonIndex == 3:
+    return await render_app_frame(services, app_id)
+  return redirect(external_url('redirect_url', app_id=app_id), 302)
+
+
+@route('/rate/<app_id>', methods=['POST'])
+async def rate(services, request, frame, app_id: str):
+  rating = {1: 1, 2: 3, 3: 5}.get(frame.button_index, 3)
+  await services.rate_app(app_id, rating, frame.fid)
+  image_url = await view_image_url(services, VIEW_POST_RATE, await services.get_app(app_id),
+                                   'image', view_type=VIEW_POST_RATE, app_id=app_id)
+  return render_template('thanks.html', image_url=image_url,
+                         post_url=external_url('thanks', app_id=app_id))
+
+
+@route('/thanks/<app_id>', methods=['POST'])
+async def thanks(services, request, frame, app_id: str):
+  buttonIndex = frame.button_index
+  logger.debug("Thanks action", extra=log_fields("action", button_index=buttonIndex))
+  try:
+    if buttonIndex == 1:
+      return await random_app_frame(services)
+    return redirect("https://dappstore.app", 302)
+  except Exception as e:
+    logger.error(e)
+    return redirect("https://dappstore.app", 302)
+
+
+async def send_view(services, request, endpoint: str, view_type: str, _app,
+                    page: int = None) -> Response:
+  """
+  Serves a view as PNG, or as SVG with `?format=svg`, which is never
+  rasterized. A request whose If-None-Match has the view's ETag gets a 304
+  before anything is rendered.
+  """
+  svg = request.args.get('format') == 'svg'
+  etag = view_etag(view_type, _app, page, 'svg' if svg else 'png')
+  if request.if_none_match.contains_weak(etag):
+    rv = Response(status=304)
+  elif svg:
+    rv = Response(await services.render_svg(view_type, _app, page), mimetype='image/svg+xml')
+  else:
+    rv = services.prerendered(request, view_type, _app, page)
+    if rv is None:
+      if view_type == VIEW_SCREENSHOTS:
+        png = await services.carousel_page(_app, page)
+      else:
+        png = await services.render_png(view_type, _app)
+      rv = Response(png, mimetype='image/png')
+
+  rv.set_etag(etag)
+  cache_control = IMAGE_CACHE_CONTROL.get(endpoint)
+  if cache_control:
+    rv.headers['Cache-Control'] = cache_control
+  return rv
+
+
+@route('/frame/image/<app_id>')
+async def frame_image(services, request, frame, app_id: str):
+  _app = await services.get_app(app_id)
+  if _app is None:
+    return Response("App not found", 404)
+  logger.debug("App images", extra=log_fields("images", app_id=app_id,
+                                              images=LazyJSON(_app['images'])))
+  return await send_view(services, request, 'frame_image', VIEW_FRAME, _app)
+
+
+@route('/image/<view_type>/<app_id>')
+async def image(services, request, frame, view_type: str, app_id: str):
+  if view_type not in [VIEW_PRE_RATE, VIEW_POST_RATE]:
+    return Response("Invalid view type", 400)
+  _app = await services.get_app(app_id)
+  if _app is None:
+    return Response("App not found", 404)
+  logger.debug("App images", extra=log_fields("images", app_id=app_id,
+                                              images=LazyJSON(_app['images'])))
+  return await send_view(services, request, 'image', view_type, _app)
+
+
+@route('/screenshots/image/<app_id>/<int:page>')
+async def screenshot_image(services, request, frame, app_id: str, page: int):
+  _app = await services.get_app(app_id)
+  if _app is None:
+    return Response("App not found", 404)
+  if page >= carousel.page_count(_app):
+    return Response("Page not found", 404)
+  return await send_view(services, request, 'screenshot_image', VIEW_SCREENSHOTS, _app, page)
+
+
+@route('/redirect/<app_id>')
+async def redirect_url(services, request, frame, app_id: str):
+  _app = await services.get_app(app_id)
+  if _app is None:
+    return Response("App not found", 404)
+  link_url = f"https://explorer.meroku.org/dapp?id={ app_id }"
+  cast_text = quote(f"Check out {_app['name']} on Meroku!")
+  return redirect(f"https://warpcast.com/~/compose?text={cast_text}&embeds[]={link_url}", 302)
+
+
+def stats_authorized(authorization: str) -> bool:
+  if not INTERNAL_STATS_TOKEN or authorization is None:
+    return False
+  return hmac.compare_digest(authorization.encode(), f"Bearer {INTERNAL_STATS_TOKEN}".encode())
+
+
+@route('/internal/stats')
+async def internal_stats(services, request, frame):
+  if not stats_authorized(request.headers.get('Authorization')):
+    return Response("Not Found", 404)
+  return Response(codec.dumps({
+    "redis_client_cache": get_client_cache().stats(),
+    "text_layer_cache": text_layer_cache.stats(),
+    "openai": openai_cache.stats(),
+    "s3_uploads": uploads.stats(),
+    "cdn": cdn.stats(),
+    "neynar": neynar.stats(),
+    "hub": hub.stats(),
+    "fcuser_cache": tiered_cache.stats(),
+    "cast_store": cast_store.stats(),
+    "json_codec": codec.stats(),
+  }), mimetype='application/json')
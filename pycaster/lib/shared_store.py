@@ -0,0 +1,439 @@
+"""
+Read-only asset store shared by all gunicorn workers through mmap.
+
+The store is a single file laid out as
+
+  MAGIC | index length | JSON index | padding | blob, blob, ...
+
+and a `CURRENT` pointer file naming the active store. Publishing writes a
+new store file and swaps the pointer with os.replace, so readers either see
+the old store or the new one, never a partial write. Workers map the file
+read-only, so pages are shared through the page cache (use a tmpfs such as
+/dev/shm for ASSET_STORE_DIR).
+
+Keys in use:
+  template/<file name>     decoded RGBA pixels of a base image
+  catalog                  JSON snapshot of the Meroku catalog
+  render/<view>/<app id>   rendered PNG of a frame view
+
+Populate it once in the gunicorn master (the on_starting hook of
+gunicorn.conf.py does this), or from a loader process:
+
+  python -m pycaster.lib.shared_store --prerender
+"""
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Union
+
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+MAGIC = b"PCASSET1"
+HEADER = struct.Struct("<8sQ")
+ALIGN = 64
+POINTER_FILE = "CURRENT"
+LOCK_FILE = ".lock"
+
+CATALOG_KEY = "catalog"
+CATALOG_TTL = 60*60*12
+
+
+def template_key(file_name: str) -> str:
+  return f"template/{file_name}"
+
+
+def render_key(view_type: str, app_id: str, page: Union[int, None] = None) -> str:
+  if page is not None:
+    return f"render/{view_type}/{app_id}/{page}"
+  return f"render/{view_type}/{app_id}"
+
+
+class AssetSlice(io.RawIOBase):
+  """
+  File-like view of one blob with its own file descriptor. gunicorn's file
+  wrapper sends it with sendfile(), straight from the page cache.
+  """
+
+  def __init__(self, path: str, offset: int, length: int) -> None:
+    super().__init__()
+    self.length = length
+    self._remaining = length
+    self._fd = os.open(path, os.O_RDONLY)
+    os.lseek(self._fd, offset, os.SEEK_SET)
+
+  def fileno(self) -> int:
+    return self._fd
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer) -> int:
+    size = min(len(buffer), self._remaining)
+    if size <= 0:
+      return 0
+    data = os.read(self._fd, size)
+    buffer[:len(data)] = data
+    self._remaining -= len(data)
+    return len(data)
+
+  def close(self) -> None:
+    if not self.closed:
+      os.close(self._fd)
+    super().close()
+
+
+class _MappedStore:
+  """A single published store file, mapped read-only."""
+
+  def __init__(self, path: str) -> None:
+    self.path = path
+    with open(path, "rb") as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, index_len = HEADER.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError(f"Not an asset store: {path}")
+    index = json.loads(self._mm[HEADER.size:HEADER.size + index_len])
+    self.version = index["version"]
+    self.entries: Dict[str, dict] = index["entries"]
+    self._data_start = _align(HEADER.size + index_len)
+    self._view = memoryview(self._mm)
+    self._catalog = None
+    self._catalog_by_id = None
+    # The mapping is never closed explicitly: memoryviews handed out by get()
+    # keep it alive and it is unmapped once the last of them is released.
+
+  def get(self, key: str) -> Union[memoryview, None]:
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    start = self._data_start + entry["offset"]
+    return self._view[start:start + entry["length"]]
+
+  def open(self, key: str) -> Union[AssetSlice, None]:
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    try:
+      return AssetSlice(self.path, self._data_start + entry["offset"], entry["length"])
+    except FileNotFoundError:
+      # Pruned by a newer publish; the caller renders instead.
+      return None
+
+  def meta(self, key: str) -> Union[dict, None]:
+    entry = self.entries.get(key)
+    return entry["meta"] if entry is not None else None
+
+  def catalog(self):
+    meta = self.meta(CATALOG_KEY)
+    if meta is None or meta.get("expires_at", 0) < time.time():
+      return None
+    if self._catalog is None:
+      self._catalog = json.loads(bytes(self.get(CATALOG_KEY)))
+    return self._catalog
+
+  def catalog_by_id(self):
+    apps = self.catalog()
+    if apps is None:
+      return None
+    if self._catalog_by_id is None:
+      self._catalog_by_id = {x['dappId']: x for x in apps}
+    return self._catalog_by_id
+
+
+def _align(offset: int) -> int:
+  return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+class AssetStoreBuilder:
+  """Collects blobs for a new store version before it is published."""
+
+  def __init__(self) -> None:
+    self._entries = {}
+
+  def add(self, key: str, data, **meta) -> None:
+    self._entries[key] = (data, meta)
+
+  def copy(self, store: _MappedStore, key: str) -> None:
+    self.add(key, store.get(key), **store.meta(key))
+
+  def write(self, path: str, version: str) -> None:
+    entries = {}
+    offset = 0
+    for key, (data, meta) in self._entries.items():
+      length = memoryview(data).nbytes
+      entries[key] = {"offset": offset, "length": length, "meta": meta}
+      offset = _align(offset + length)
+    index = json.dumps({"version": version, "entries": entries}).encode()
+
+    with open(path, "wb") as f:
+      f.write(HEADER.pack(MAGIC, len(index)))
+      f.write(index)
+      f.write(b"\0" * (_align(f.tell()) - f.tell()))
+      data_start = f.tell()
+      for key, (data, _) in self._entries.items():
+        f.seek(data_start + entries[key]["offset"])
+        f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+
+
+class SharedAssetStore:
+  def __init__(self, directory: str, check_interval: float = 1.0) -> None:
+    self.directory = directory
+    self.check_interval = check_interval
+    self._mapped = None
+    self._checked_at = 0.0
+    self._pointer = None
+    self._lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+
+  def current(self, refresh: bool = False) -> Union[_MappedStore, None]:
+    """
+    Returns the active store, re-reading the pointer at most once every
+    `check_interval` seconds.
+    """
+    now = time.monotonic()
+    if not refresh and now - self._checked_at < self.check_interval:
+      return self._mapped
+    with self._lock:
+      self._checked_at = now
+      try:
+        with open(os.path.join(self.directory, POINTER_FILE)) as f:
+          pointer = f.read().strip()
+      except FileNotFoundError:
+        return self._mapped
+      if pointer != self._pointer:
+        try:
+          self._mapped = _MappedStore(os.path.join(self.directory, pointer))
+          self._pointer = pointer
+          logger.debug("Mapped asset store %s", pointer)
+        except (OSError, ValueError) as e:
+          logger.error("Failed to map asset store %s: %s", pointer, e)
+    return self._mapped
+
+  def get(self, key: str) -> Union[memoryview, None]:
+    store = self.current()
+    return store.get(key) if store is not None else None
+
+  def open(self, key: str) -> Union[AssetSlice, None]:
+    store = self.current()
+    return store.open(key) if store is not None else None
+
+  def meta(self, key: str) -> Union[dict, None]:
+    store = self.current()
+    return store.meta(key) if store is not None else None
+
+  def catalog(self):
+    store = self.current()
+    return store.catalog() if store is not None else None
+
+  def catalog_by_id(self):
+    store = self.current()
+    return store.catalog_by_id() if store is not None else None
+
+  @contextmanager
+  def lock(self):
+    """Cross-process lock held while building and publishing a version."""
+    with open(os.path.join(self.directory, LOCK_FILE), "a") as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+  def publish(self, builder: AssetStoreBuilder, version: str) -> str:
+    """
+    Writes `builder` as a new store file and atomically points readers at
+    it. Callers should hold lock().
+    """
+    file_name = f"store-{version}-{os.getpid()}-{time.time_ns()}.bin"
+    path = os.path.join(self.directory, file_name)
+    builder.write(path + ".tmp", version)
+    os.replace(path + ".tmp", path)
+
+    pointer_tmp = os.path.join(self.directory, POINTER_FILE + ".tmp")
+    with open(pointer_tmp, "w") as f:
+      f.write(file_name)
+    os.replace(pointer_tmp, os.path.join(self.directory, POINTER_FILE))
+    self._prune(keep={file_name, self._pointer})
+    self.current(refresh=True)
+    logger.info("Published asset store version %s", version)
+    return file_name
+
+  def _prune(self, keep) -> None:
+    # Unlinking a file that other workers still map is safe: the pages stay
+    # valid until their last mapping goes away.
+    for name in os.listdir(self.directory):
+      if name.startswith("store-") and name not in keep:
+        try:
+          os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+          pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_asset_store() -> Union[SharedAssetStore, None]:
+  """
+  Returns the process wide store, or None when ASSET_STORE_DIR is not set.
+  """
+  global _store
+  directory = os.getenv("ASSET_STORE_DIR")
+  if not directory:
+    return None
+  if _store is None:
+    with _store_lock:
+      if _store is None:
+        _store = SharedAssetStore(
+          directory,
+          check_interval=get_numeric_env_var("ASSET_STORE_CHECK_INTERVAL", 1)
+        )
+  return _store
+
+
+def _catalog_version(apps) -> str:
+  return hashlib.sha1(json.dumps(apps, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _add_templates(builder: AssetStoreBuilder) -> None:
+  from PIL import Image
+  from .frames import BASE_IMAGES, TEMPLATE_VERSION
+
+  for path in BASE_IMAGES.values():
+    with Image.open(path) as img:
+      img = img.convert("RGBA")
+      builder.add(template_key(path.name), img.tobytes(),
+                  mode="RGBA", size=list(img.size), template_version=TEMPLATE_VERSION)
+
+
+def _add_catalog(builder: AssetStoreBuilder, apps, ttl: int) -> str:
+  version = _catalog_version(apps)
+  builder.add(CATALOG_KEY, json.dumps(apps).encode(),
+              version=version, expires_at=time.time() + ttl)
+  return version
+
+
+def _add_renders(builder: AssetStoreBuilder, apps, previous: Union[_MappedStore, None],
+                 render: bool) -> None:
+  """
+  Carries over renders whose app did not change visually and, when `render`
+  is set, renders the rest.
+  """
+  from .frames import app_views, render_digest, render_view_complete
+
+  for _app in apps:
+    digest = render_digest(_app)
+    for view_type, page in app_views(_app):
+      key = render_key(view_type, _app['dappId'], page)
+      if previous is not None and (previous.meta(key) or {}).get("digest") == digest:
+        builder.copy(previous, key)
+      elif render:
+        try:
+          png, complete = render_view_complete(view_type, _app, page)
+        except Exception as e:
+          logger.error("Failed to prerender %s: %s", key, e)
+          continue
+        if not complete:
+          # Missing an external image; left for the next publish to render.
+          logger.info("Not prerendering %s: an external image could not be fetched", key)
+          continue
+        builder.add(key, png, digest=digest, mimetype="image/png")
+
+
+def publish_catalog(apps, ttl: int = CATALOG_TTL, render: bool = False) -> bool:
+  """
+  Publishes a store version holding `apps`, unless the active version already
+  holds the same catalog for at least half of `ttl` more. Returns True when a
+  new version was published.
+  """
+  store = get_asset_store()
+  if store is None:
+    return False
+  with store.lock():
+    previous = store.current(refresh=True)
+    version = _catalog_version(apps)
+    templates_current = _templates_current(previous)
+    if templates_current and previous.catalog() is not None and \
+       previous.meta(CATALOG_KEY).get("version") == version and \
+       previous.meta(CATALOG_KEY)["expires_at"] - time.time() > ttl / 2:
+      return False
+
+    builder = AssetStoreBuilder()
+    if templates_current:
+      for key in _template_keys():
+        builder.copy(previous, key)
+    else:
+      _add_templates(builder)
+      # Renders made against other templates are stale too.
+      previous = None
+    _add_catalog(builder, apps, ttl)
+    _add_renders(builder, apps, previous, render)
+    store.publish(builder, version)
+  return True
+
+
+def _template_keys():
+  from .frames import BASE_IMAGES
+  return [template_key(path.name) for path in BASE_IMAGES.values()]
+
+
+def _templates_current(store: Union[_MappedStore, None]) -> bool:
+  from .frames import TEMPLATE_VERSION
+  if store is None:
+    return False
+  return all((store.meta(key) or {}).get("template_version") == TEMPLATE_VERSION
+             for key in _template_keys())
+
+
+def populate_asset_store(render: bool = None) -> None:
+  """
+  Fills the store with templates, the catalog and (optionally) prerendered
+  frames. Meant to run once in the gunicorn master before workers fork, see
+  gunicorn.conf.py.
+  """
+  from .meroku import fetch_apps
+
+  store = get_asset_store()
+  if store is None:
+    return
+  if render is None:
+    render = os.getenv("ASSET_STORE_PRERENDER") == "1"
+
+  try:
+    apps = fetch_apps()
+  except Exception as e:
+    logger.error("Could not load catalog for asset store: %s", e)
+    apps = []
+
+  if apps:
+    publish_catalog(apps, render=render)
+    return
+  with store.lock():
+    if store.current(refresh=True) is not None:
+      # A store from an earlier start beats one without a catalog.
+      logger.warning("No catalog to publish, keeping the current asset store")
+      return
+    builder = AssetStoreBuilder()
+    _add_templates(builder)
+    store.publish(builder, "templates")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Populate the shared asset store.")
+  parser.add_argument("--prerender", action="store_true",
+                      help="Render every frame view into the store (default: ASSET_STORE_PRERENDER).")
+  args = parser.parse_args()
+  populate_asset_store(render=args.prerender or None)
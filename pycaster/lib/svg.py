@@ -0,0 +1,163 @@
+"""
+SVG renderer for ImageComponent stacks.
+
+A frame is rendered by filling string templates, with no DOM. The background,
+the external images (from the cached, already resized PNGs) and the Inter
+font are embedded as data URIs, so the document is self contained and its
+hash covers everything drawn.
+
+Text is wrapped with the same font metrics as the Pillow renderer. SVG is
+served as is where a client accepts it. When PNG is needed it is rasterized
+with cairo, cached by the SVG's hash. cairo ignores @font-face and takes
+Inter from fontconfig instead, so the font is installed in the Docker image.
+"""
+import base64
+import hashlib
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from string import Template
+from typing import List, Tuple, Union
+from xml.sax.saxutils import escape
+
+from .image import ImageComponent
+from .io import get_fitted_image_base64, r_cache
+from .text_layers import layout_text, load_font
+from .utils import get_numeric_env_var, setup_logger
+
+
+__current_file_path__ = pathlib.Path(__file__).resolve()
+__current_dir__ = __current_file_path__.parent
+
+logger = setup_logger(__name__)
+
+SVG_PNG_TTL = get_numeric_env_var("SVG_PNG_TTL", 6*60*60)
+FONT_PATH = __current_dir__ / "Inter-Medium.ttf"
+
+DOCUMENT = Template(
+  '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+  'width="$width" height="$height" viewBox="0 0 $width $height">'
+  '<style>@font-face{font-family:"Inter";font-weight:500;src:url("$font") format("truetype")}'
+  '</style>'
+  '<image width="$width" height="$height" xlink:href="$background"/>'
+  '$body</svg>'
+)
+CIRCLE_IMAGE = Template(
+  '<clipPath id="$id"><circle cx="$cx" cy="$cy" r="$r"/></clipPath>'
+  '<image x="$x" y="$y" width="$size" height="$size" preserveAspectRatio="none" '
+  'clip-path="url(#$id)" xlink:href="$href"/>'
+)
+# Centered in its box by the default preserveAspectRatio (xMidYMid meet).
+RECT_IMAGE = Template(
+  '<image x="$x" y="$y" width="$width" height="$height" xlink:href="$href"/>'
+)
+TEXT_LINE = Template(
+  '<text x="$x" y="$y" font-family="Inter, sans-serif" font-weight="500" '
+  'font-size="$size" fill="$fill" text-anchor="middle">$text</text>'
+)
+
+
+@lru_cache(maxsize=8)
+def _background(base_image_path: pathlib.Path):
+  from PIL import Image
+  data = base_image_path.read_bytes()
+  with Image.open(base_image_path) as img:
+    size = img.size
+  return size, "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+@lru_cache(maxsize=1)
+def _font_uri() -> str:
+  return "data:font/ttf;base64," + base64.b64encode(FONT_PATH.read_bytes()).decode()
+
+
+def _image_box(component: ImageComponent):
+  if component.display_type == ImageComponent.DISPLAY_TYPE_CIRCLE:
+    return (component.circle_radius * 2, component.circle_radius * 2)
+  return tuple(component.rect_size)
+
+
+def _text(component: ImageComponent, canvas_width: int) -> str:
+  font = load_font(str(FONT_PATH), component.font_size)
+  ascent, _ = font.getmetrics()
+  fill = "#%02x%02x%02x" % tuple(component.font_color[:3])
+  # Pillow draws from the top of the ascender, SVG from the baseline.
+  return "".join(
+    TEXT_LINE.substitute(x=canvas_width / 2, y=component.position[1] + y + ascent,
+                         size=component.font_size, fill=fill, text=escape(line))
+    for line, _, y in layout_text(component.text, font, canvas_width)
+  )
+
+
+def build_svg(components: List[ImageComponent],
+              base_image_path: pathlib.Path,
+              image_hrefs: List[Union[str, None]]) -> str:
+  """
+  Fills the templates. `image_hrefs` holds a URI for each component's image,
+  already fitted to its box, None for text or a failed fetch.
+  """
+  (width, height), background = _background(base_image_path)
+  body = []
+  for idx, (component, href) in enumerate(zip(components, image_hrefs)):
+    if component.component_type == ImageComponent.EXTERNAL_IMAGE and href is not None:
+      href = escape(href, {'"': "&quot;"})
+      if component.display_type == ImageComponent.DISPLAY_TYPE_CIRCLE:
+        radius = component.circle_radius
+        body.append(CIRCLE_IMAGE.substitute(
+          id=f"c{idx}", cx=component.position[0], cy=component.position[1], r=radius,
+          x=component.position[0] - radius, y=component.position[1] - radius,
+          size=radius * 2, href=href))
+      elif component.display_type == ImageComponent.DISPLAY_TYPE_RECTANGLE:
+        body.append(RECT_IMAGE.substitute(
+          x=component.position[0], y=component.position[1],
+          width=component.rect_size[0], height=component.rect_size[1], href=href))
+    elif component.component_type == ImageComponent.TEXT and component.text is not None:
+      body.append(_text(component, width))
+  return DOCUMENT.substitute(width=width, height=height, font=_font_uri(),
+                             background=background, body="".join(body))
+
+
+def render_svg(components: List[ImageComponent], base_image_path: pathlib.Path) -> str:
+  return render_svg_complete(components, base_image_path)[0]
+
+
+def render_svg_complete(components: List[ImageComponent],
+                        base_image_path: pathlib.Path) -> Tuple[str, bool]:
+  """render_svg, and whether no external image was left out."""
+  external = [c for c in components if c.component_type == ImageComponent.EXTERNAL_IMAGE]
+  with ThreadPoolExecutor() as executor:
+    fetched = list(executor.map(get_fitted_image_base64,
+                                [c.external_img_url for c in external],
+                                [_image_box(c) for c in external]))
+  hrefs = {id(c): "data:image/png;base64," + data.decode()
+           for c, data in zip(external, fetched) if data is not None}
+  return (build_svg(components, base_image_path, [hrefs.get(id(c)) for c in components]),
+          len(hrefs) == len(external))
+
+
+def svg_hash(svg: str) -> str:
+  return hashlib.sha1(svg.encode()).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def cairo_available() -> bool:
+  try:
+    import cairosvg  # noqa: F401
+  except (ImportError, OSError) as e:
+    # OSError: cairosvg is installed but libcairo is not.
+    logger.warning("cairo unavailable, SVG frames will not be rasterized: %s", e)
+    return False
+  return True
+
+
+def rasterize_svg(svg: str) -> bytes:
+  """
+  PNG of `svg`, rasterized with cairo once per distinct document.
+  """
+  cache_key = f"farcaster:svgpng:{svg_hash(svg)}"
+  png = r_cache.get(cache_key)
+  if png is None:
+    import cairosvg
+    png = cairosvg.svg2png(bytestring=svg.encode())
+    r_cache.set(cache_key, png, ex=SVG_PNG_TTL)
+  return png
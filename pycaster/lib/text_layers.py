@@ -0,0 +1,182 @@
+"""
+Cache of rasterized text layers.
+
+The same app names and descriptions are drawn over and over, in the same
+font, size and colour, for every view of an app. A text layer is the whole
+wrapped and centered text block rasterized once into an RGBA image (the
+colour filled in, the glyph coverage as alpha) plus where it goes, so
+drawing it again is a single alpha_composite.
+
+Layers are per process and evicted least recently used once their pixels
+take more than TEXT_LAYER_CACHE_MB.
+"""
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Tuple, Union
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .utils import get_numeric_env_var
+
+
+# Share of the canvas width text may fill before it is wrapped.
+WRAP_RATIO = 0.8
+
+
+@lru_cache(maxsize=32)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+  return ImageFont.truetype(font_path, font_size)
+
+
+def textsize(text, font):
+  im = Image.new(mode="P", size=(0, 0))
+  draw = ImageDraw.Draw(im)
+  _, _, width, height = draw.textbbox((0, 0), text=text, font=font)
+  return width, height
+
+
+def wrap_text(text: str, font, max_width: int) -> List[str]:
+  """Greedily breaks `text` into lines no wider than `max_width`."""
+  lines = []
+  line = ''
+  for word in text.split():
+    test_line = line + ' ' + word if line else word
+    test_line_width, _ = textsize(test_line, font=font)
+    if test_line_width > max_width:
+      lines.append(line)
+      line = word
+    else:
+      line = test_line
+  if line:
+    lines.append(line)
+  return lines
+
+
+def layout_text(text: str, font, canvas_width: int) -> List[Tuple[str, float, int]]:
+  """
+  Returns (line, x, y) for every line of `text` wrapped and centered on a
+  canvas `canvas_width` wide, with y relative to the top of the block.
+  """
+  placements = []
+  y = 0
+  for line in wrap_text(text, font, int(canvas_width * WRAP_RATIO)):
+    line_width, line_height = textsize(line, font=font)
+    placements.append((line, canvas_width / 2 - line_width / 2, y))
+    y += line_height
+  return placements
+
+
+class TextLayer:
+  __slots__ = ("image", "offset", "height")
+
+  def __init__(self, image: Union[Image.Image, None], offset: Tuple[int, int], height: int) -> None:
+    self.image = image    # RGBA, None for blank text
+    self.offset = offset  # top left of image relative to (0, top of the block)
+    self.height = height  # how far the block advances y
+
+  @property
+  def nbytes(self) -> int:
+    return self.image.width * self.image.height * 4 if self.image is not None else 0
+
+
+def render_text_layer(text: str, font_path, font_size: int, canvas_width: int,
+                      font_color) -> TextLayer:
+  font = load_font(str(font_path), font_size)
+  placements = layout_text(text, font, canvas_width)
+  if not placements:
+    return TextLayer(None, (0, 0), 0)
+  last_line, _, last_y = placements[-1]
+  height = last_y + textsize(last_line, font=font)[1]
+
+  # Lines are drawn at the same sub-pixel x as on the canvas, so the layer
+  # is rasterized exactly like drawing straight onto it. The padding catches
+  # glyphs that overhang their advance box.
+  pad = font_size
+  left = math.floor(min(x for _, x, _ in placements)) - pad
+  right = math.ceil(max(x + textsize(line, font=font)[0] for line, x, _ in placements)) + pad
+  mask = Image.new('L', (right - left, height + 2 * pad), 0)
+  draw = ImageDraw.Draw(mask)
+  for line, x, y in placements:
+    draw.text((x - left, y + pad), line, font=font, fill=255)
+
+  bbox = mask.getbbox()
+  if bbox is None:
+    return TextLayer(None, (0, 0), height)
+  mask = mask.crop(bbox)
+  layer = Image.new('RGBA', mask.size, tuple(font_color[:3]) + (255,))
+  layer.putalpha(mask)
+  return TextLayer(layer, (left + bbox[0], bbox[1] - pad), height)
+
+
+class TextLayerCache:
+  def __init__(self, max_bytes: int) -> None:
+    self.max_bytes = max_bytes
+    self._layers = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, text: str, font_path, font_size: int, canvas_width: int, font_color) -> TextLayer:
+    # The canvas width fixes both the wrap width and the centering.
+    key = (text, str(font_path), font_size, canvas_width, tuple(font_color))
+    with self._lock:
+      layer = self._layers.get(key)
+      if layer is not None:
+        self._layers.move_to_end(key)
+        self.hits += 1
+        return layer
+      self.misses += 1
+
+    layer = render_text_layer(text, font_path, font_size, canvas_width, font_color)
+    if layer.nbytes > self.max_bytes:
+      return layer
+
+    with self._lock:
+      previous = self._layers.pop(key, None)
+      if previous is not None:
+        self._bytes -= previous.nbytes
+      self._layers[key] = layer
+      self._bytes += layer.nbytes
+      while self._bytes > self.max_bytes:
+        _, oldest = self._layers.popitem(last=False)
+        self._bytes -= oldest.nbytes
+        self.evictions += 1
+    return layer
+
+  def clear(self) -> None:
+    with self._lock:
+      self._layers.clear()
+      self._bytes = 0
+
+  def stats(self) -> dict:
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        "hit_ratio": self.hits / lookups if lookups else None,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "entries": len(self._layers),
+        "bytes": self._bytes,
+        "max_bytes": self.max_bytes,
+      }
+
+
+text_layer_cache = TextLayerCache(get_numeric_env_var("TEXT_LAYER_CACHE_MB", 16) * 1024 * 1024)
+
+
+def composite_layer(base: Image.Image, layer: TextLayer, top: int) -> None:
+  """Draws `layer` onto `base` in place, with the block starting at `top`."""
+  if layer.image is None:
+    return
+  x, y = layer.offset[0], layer.offset[1] + top
+  # alpha_composite wants the layer inside the canvas, so clip it.
+  box = (max(0, -x), max(0, -y),
+         min(layer.image.width, base.width - x), min(layer.image.height, base.height - y))
+  if box[0] >= box[2] or box[1] >= box[3]:
+    return
+  base.alpha_composite(layer.image, dest=(x + box[0], y + box[1]), source=box)
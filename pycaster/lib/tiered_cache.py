@@ -0,0 +1,276 @@
+"""
+Two level cache for lookups against Neynar: an LRU in each worker in front
+of Redis.
+
+@cached (and @cached_async for coroutines) keys a function's result with
+`key(*args, **kwargs)` and keeps it JSON encoded (see codec.py):
+
+- in this process for at most TIERED_CACHE_LOCAL_TTL seconds, the newest
+  TIERED_CACHE_LOCAL_ENTRIES values, so hot users skip the Redis round trip,
+- in Redis for `ttl` seconds, or `negative_ttl` when the result is empty
+  (an unknown username, a fid with no casts), so misses are not refetched
+  on every frame.
+
+Expiries are jittered by TIERED_CACHE_JITTER_PERCENT either way, so keys written
+together do not all expire together. Concurrent misses of a key in a
+worker wait for the first one's fetch instead of making their own.
+
+A function returns Uncached(value) for an answer that must not be kept, ex:
+after a 5xx. Exceptions are not cached either, and reach every waiter,
+except NeynarThrottled: a background fetch that gave up on the rate limit
+says nothing about the callers that joined it, which fetch again at their
+own priority.
+Values are decoded per caller, so nobody shares a mutable result.
+"""
+import functools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+from . import codec, neynar
+from .io import cache_get_async, get_async_redis, r, r_cache
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+TIERED_CACHE_LOCAL_ENTRIES = get_numeric_env_var("TIERED_CACHE_LOCAL_ENTRIES", 4096)
+TIERED_CACHE_LOCAL_TTL = get_numeric_env_var("TIERED_CACHE_LOCAL_TTL", 30)
+TIERED_CACHE_JITTER = get_numeric_env_var("TIERED_CACHE_JITTER_PERCENT", 10) / 100
+NEGATIVE_TTL = 60
+# How empty results look encoded, see _negative.
+_NEGATIVE_ENCODINGS = (b"null", b"[]", b"{}")
+
+_local = OrderedDict()  # key -> (encoded value, expires at)
+_inflight: Dict[str, Future] = {}
+_inflight_async = {}    # (loop id, key) -> asyncio.Task
+_lock = threading.Lock()
+_stats = defaultdict(lambda: {"local_hits": 0, "redis_hits": 0, "misses": 0, "negatives": 0,
+                              "uncached": 0, "coalesced": 0, "refetched": 0, "errors": 0})
+
+
+def _reset_after_fork():
+  global _lock
+  _local.clear()
+  _inflight.clear()
+  _inflight_async.clear()
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Uncached:
+  """A result to return without caching it."""
+  __slots__ = ("value",)
+
+  def __init__(self, value) -> None:
+    self.value = value
+
+
+def _count(name: str, counter: str) -> None:
+  with _lock:
+    _stats[name][counter] += 1
+
+
+def stats() -> dict:
+  with _lock:
+    return {
+      "local_entries": len(_local),
+      "local_max_entries": TIERED_CACHE_LOCAL_ENTRIES,
+      "inflight": len(_inflight) + len(_inflight_async),
+      "functions": {name: dict(counts) for name, counts in _stats.items()},
+    }
+
+
+def _jittered(ttl: float) -> float:
+  return ttl * random.uniform(1 - TIERED_CACHE_JITTER, 1 + TIERED_CACHE_JITTER)
+
+
+def _negative(value) -> bool:
+  return value is None or value == [] or value == {}
+
+
+def _local_get(key: str):
+  with _lock:
+    entry = _local.get(key)
+    if entry is None:
+      return None
+    if entry[1] < time.monotonic():
+      del _local[key]
+      return None
+    _local.move_to_end(key)
+    return entry[0]
+
+
+def _local_set(key: str, encoded: bytes, ttl: float) -> None:
+  expires_at = time.monotonic() + _jittered(min(ttl, TIERED_CACHE_LOCAL_TTL))
+  with _lock:
+    _local[key] = (encoded, expires_at)
+    _local.move_to_end(key)
+    while len(_local) > TIERED_CACHE_LOCAL_ENTRIES:
+      _local.popitem(last=False)
+
+
+def _redis_ttl(ttl: float) -> int:
+  return max(1, int(_jittered(ttl)))
+
+
+def prime(entries: Dict[float, Dict[str, object]]) -> None:
+  """
+  Writes values fetched along with something else, ex: the users of a
+  follower listing, as {ttl: {key: value}}. Only Redis gets them; they reach
+  a worker's LRU when read.
+  """
+  with r.pipeline(transaction=False) as pipe:
+    for ttl, values in entries.items():
+      for key, value in values.items():
+        pipe.setex(key, _redis_ttl(ttl), codec.dumps(value))
+    pipe.execute()
+
+
+async def prime_async(entries: Dict[float, Dict[str, object]]) -> None:
+  async with get_async_redis().pipeline(transaction=False) as pipe:
+    for ttl, values in entries.items():
+      for key, value in values.items():
+        pipe.setex(key, _redis_ttl(ttl), codec.dumps(value))
+    await pipe.execute()
+
+
+def _encode(name: str, result, ttl: float, negative_ttl: float):
+  """
+  Returns (encoded result, Redis TTL or None when it must not be cached).
+  """
+  if isinstance(result, Uncached):
+    _count(name, "uncached")
+    return codec.dumps(result.value), None
+  if _negative(result):
+    _count(name, "negatives")
+    return codec.dumps(result), negative_ttl
+  return codec.dumps(result), ttl
+
+
+def _get(name: str, key: str, ttl: float, negative_ttl: float, fetch: Callable) -> bytes:
+  encoded = _local_get(key)
+  if encoded is not None:
+    _count(name, "local_hits")
+    return encoded
+
+  with _lock:
+    future = _inflight.get(key)
+    owner = future is None
+    if owner:
+      future = _inflight[key] = Future()
+  if not owner:
+    _count(name, "coalesced")
+    try:
+      return future.result()
+    except neynar.NeynarThrottled:
+      _count(name, "refetched")
+      return _get(name, key, ttl, negative_ttl, fetch)
+
+  try:
+    cached = r_cache.get(key)
+    if cached is not None:
+      _count(name, "redis_hits")
+      encoded = cached.encode() if isinstance(cached, str) else cached
+      _local_set(key, encoded, negative_ttl if encoded in _NEGATIVE_ENCODINGS else ttl)
+    else:
+      _count(name, "misses")
+      encoded, store_ttl = _encode(name, fetch(), ttl, negative_ttl)
+      if store_ttl is not None:
+        r_cache.setex(key, _redis_ttl(store_ttl), encoded)
+        _local_set(key, encoded, store_ttl)
+  except BaseException as e:
+    _count(name, "errors")
+    # Removed first, so a waiter that fetches again does not join this one.
+    _forget(key)
+    future.set_exception(e)
+    raise
+  _forget(key)
+  future.set_result(encoded)
+  return encoded
+
+
+def _forget(key: str) -> None:
+  with _lock:
+    _inflight.pop(key, None)
+
+
+async def _fetch_async(name: str, key: str, ttl: float, negative_ttl: float, fetch) -> bytes:
+  cached = await cache_get_async(key)
+  if cached is not None:
+    _count(name, "redis_hits")
+    encoded = cached.encode() if isinstance(cached, str) else cached
+    _local_set(key, encoded, negative_ttl if encoded in _NEGATIVE_ENCODINGS else ttl)
+    return encoded
+  _count(name, "misses")
+  encoded, store_ttl = _encode(name, await fetch(), ttl, negative_ttl)
+  if store_ttl is not None:
+    await get_async_redis().setex(key, _redis_ttl(store_ttl), encoded)
+    _local_set(key, encoded, store_ttl)
+  return encoded
+
+
+async def _get_async(name: str, key: str, ttl: float, negative_ttl: float, fetch) -> bytes:
+  import asyncio
+  encoded = _local_get(key)
+  if encoded is not None:
+    _count(name, "local_hits")
+    return encoded
+
+  inflight_key = (id(asyncio.get_running_loop()), key)
+  task = _inflight_async.get(inflight_key)
+  joined = task is not None
+  if joined:
+    _count(name, "coalesced")
+  else:
+    task = asyncio.ensure_future(_fetch_async(name, key, ttl, negative_ttl, fetch))
+    _inflight_async[inflight_key] = task
+    task.add_done_callback(lambda _: _inflight_async.pop(inflight_key, None))
+  try:
+    # Shielded, so a cancelled caller does not cancel the others' fetch.
+    return await asyncio.shield(task)
+  except neynar.NeynarThrottled:
+    if not joined:
+      _count(name, "errors")
+      raise
+    _count(name, "refetched")
+    if _inflight_async.get(inflight_key) is task:
+      del _inflight_async[inflight_key]
+    return await _get_async(name, key, ttl, negative_ttl, fetch)
+  except Exception:
+    _count(name, "errors")
+    raise
+
+
+def cached(name: str, key: Callable[..., str], ttl: float, negative_ttl: float = NEGATIVE_TTL):
+  """
+  Caches the function's results under `key(*args, **kwargs)`. `name` groups
+  them in stats().
+  """
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      encoded = _get(name, key(*args, **kwargs), ttl, negative_ttl,
+                     lambda: function(*args, **kwargs))
+      return codec.loads(encoded)
+    return wrapper
+  return decorate
+
+
+def cached_async(name: str, key: Callable[..., str], ttl: float,
+                 negative_ttl: float = NEGATIVE_TTL):
+  """@cached for coroutine functions. Shares both levels with @cached."""
+  def decorate(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+      encoded = await _get_async(name, key(*args, **kwargs), ttl, negative_ttl,
+                                 lambda: function(*args, **kwargs))
+      return codec.loads(encoded)
+    return wrapper
+  return decorate
@@ -0,0 +1,121 @@
+"""
+Background S3 uploads.
+
+submit() queues an upload and returns a Future for its CDN URL, so a request
+never waits on S3. Each worker runs S3_UPLOAD_CONCURRENCY uploads at once and
+holds at most S3_UPLOAD_QUEUE_SIZE more; past that, uploads are refused
+instead of piling up in memory. An upload that fails is retried with backoff,
+on top of the client's retries of each request.
+"""
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .io import upload_bytes_to_s3
+from .utils import get_numeric_env_var, setup_logger
+
+
+logger = setup_logger(__name__)
+
+S3_UPLOAD_CONCURRENCY = get_numeric_env_var("S3_UPLOAD_CONCURRENCY", 4)
+S3_UPLOAD_QUEUE_SIZE = get_numeric_env_var("S3_UPLOAD_QUEUE_SIZE", 256)
+S3_UPLOAD_RETRIES = get_numeric_env_var("S3_UPLOAD_RETRIES", 3)
+# Seconds before the first retry, doubled on each of the next ones.
+S3_UPLOAD_RETRY_DELAY = get_numeric_env_var("S3_UPLOAD_RETRY_DELAY_MS", 500) / 1000
+
+_executor = None
+_slots = threading.BoundedSemaphore(S3_UPLOAD_CONCURRENCY + S3_UPLOAD_QUEUE_SIZE)
+_lock = threading.Lock()
+_stats = {"queued": 0, "uploaded": 0, "failed": 0, "retries": 0, "rejected": 0, "bytes": 0}
+
+
+class UploadQueueFull(Exception):
+  pass
+
+
+def _reset_after_fork():
+  global _executor, _slots, _lock
+  _executor = None
+  _slots = threading.BoundedSemaphore(S3_UPLOAD_CONCURRENCY + S3_UPLOAD_QUEUE_SIZE)
+  _lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count(name: str, value: int = 1) -> None:
+  with _lock:
+    _stats[name] += value
+
+
+def stats() -> dict:
+  with _lock:
+    return {**_stats, "concurrency": S3_UPLOAD_CONCURRENCY, "queue_size": S3_UPLOAD_QUEUE_SIZE}
+
+
+def _retryable(e: Exception) -> bool:
+  from botocore.exceptions import ClientError, NoCredentialsError
+  if isinstance(e, NoCredentialsError):
+    return False
+  if isinstance(e, ClientError):
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return status >= 500 or status in (408, 429)
+  # Connection errors and timeouts.
+  return True
+
+
+def _upload(body: bytes, key: str, content_type: str, cache_control: str) -> str:
+  from botocore.exceptions import BotoCoreError, ClientError
+  try:
+    for attempt in range(S3_UPLOAD_RETRIES + 1):
+      try:
+        url = upload_bytes_to_s3(body, key, content_type, cache_control)
+      except (BotoCoreError, ClientError) as e:
+        if attempt == S3_UPLOAD_RETRIES or not _retryable(e):
+          raise
+        _count("retries")
+        logger.info("Retrying upload of %s: %s", key, e)
+        time.sleep(S3_UPLOAD_RETRY_DELAY * 2**attempt)
+        continue
+      _count("uploaded")
+      _count("bytes", len(body))
+      return url
+  except Exception as e:
+    _count("failed")
+    logger.warning("Failed to upload %s to S3: %s", key, e)
+    raise
+  finally:
+    _slots.release()
+
+
+def submit(body: bytes, key: str, content_type: str, cache_control: str = None) -> Future:
+  """
+  Queues `body` for upload under `key`. The returned Future resolves to the
+  object's CDN URL. Raises UploadQueueFull if the queue is full.
+  """
+  global _executor
+  if not _slots.acquire(blocking=False):
+    _count("rejected")
+    raise UploadQueueFull(f"{S3_UPLOAD_QUEUE_SIZE} uploads already queued")
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_CONCURRENCY,
+                                     thread_name_prefix="s3-upload")
+    _stats["queued"] += 1
+    executor = _executor
+  try:
+    return executor.submit(_upload, body, key, content_type, cache_control)
+  except RuntimeError:
+    # Shutting down.
+    _slots.release()
+    raise
+
+
+def _drain():
+  # Let queued uploads finish when the worker exits.
+  if _executor is not None:
+    _executor.shutdown(wait=True)
+
+atexit.register(_drain)
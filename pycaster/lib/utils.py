@@ -1,6 +1,13 @@
+import atexit
+import json
 import os
 import pathlib
 import logging
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 
 
 __current_file_path__ = pathlib.Path(__file__).resolve()
@@ -10,16 +17,189 @@ prod = os.getenv("ENV") == "prod"
 stag = os.getenv("ENV") == "staging"
 app_url = os.getenv("APP_URL", "testroast.ngrok.app")
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def _parse_log_rules(value, cast):
+  """
+  Parses rules of the form `request=0.01,images=0.1` into a dict.
+  Malformed entries are ignored.
+  """
+  rules = {}
+  for item in (value or "").split(","):
+    name, _, raw = item.partition("=")
+    try:
+      rules[name.strip()] = cast(raw)
+    except ValueError:
+      continue
+  return rules
+
+
+class LazyJSON:
+  """
+  Defers serialising `value` until the record is actually formatted, which
+  happens on the log listener thread, not the request thread.
+  """
+  __slots__ = ("value",)
+
+  def __init__(self, value) -> None:
+    self.value = value
+
+  def __str__(self) -> str:
+    try:
+      return json.dumps(self.value, default=str)
+    except (TypeError, ValueError):
+      return repr(self.value)
+
+
+def log_fields(msg_type: str = None, **fields):
+  """
+  Builds the `extra` dict for a structured log call.
+
+  `msg_type` selects the sampling / rate limit rule applied to the record,
+  `fields` are rendered as `key=value` pairs by the listener.
+
+  logger.debug("Frame request", extra=log_fields("request", fid=fid))
+  """
+  return {"msg_type": msg_type, "fields": fields}
+
+
+class StructuredFormatter(logging.Formatter):
+  def format(self, record):
+    message = super().format(record)
+    fields = getattr(record, "fields", None)
+    if fields:
+      message += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+    return message
+
+
+class SamplingFilter(logging.Filter):
+  """
+  Drops records before they are queued, based on their `msg_type`.
+
+  LOG_SAMPLE_RATES="request=0.01,images=0.1" keeps 1% of `request` and
+  10% of `images` records. LOG_RATE_LIMITS="followers=5" lets at most 5
+  `followers` records per second through. Warnings and errors always pass.
+  """
+
+  def __init__(self, sample_rates=None, rate_limits=None) -> None:
+    super().__init__()
+    self.sample_rates = sample_rates if sample_rates is not None else \
+      _parse_log_rules(os.getenv("LOG_SAMPLE_RATES"), float)
+    self.rate_limits = rate_limits if rate_limits is not None else \
+      _parse_log_rules(os.getenv("LOG_RATE_LIMITS"), float)
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def _take_token(self, msg_type, per_second) -> bool:
+    if per_second <= 0:
+      return False
+    # Holds at least one token, so rates below 1/s let a record through
+    # every 1/rate seconds.
+    capacity = max(1, per_second)
+    now = time.monotonic()
+    with self._lock:
+      tokens, last = self._buckets.get(msg_type, (capacity, now))
+      tokens = min(capacity, tokens + (now - last) * per_second)
+      if tokens < 1:
+        self._buckets[msg_type] = (tokens, now)
+        return False
+      self._buckets[msg_type] = (tokens - 1, now)
+      return True
+
+  def filter(self, record) -> bool:
+    msg_type = getattr(record, "msg_type", None)
+    if msg_type is None or record.levelno >= logging.WARNING:
+      return True
+    rate = self.sample_rates.get(msg_type)
+    if rate is not None and random.random() >= rate:
+      return False
+    per_second = self.rate_limits.get(msg_type)
+    if per_second is not None:
+      return self._take_token(msg_type, per_second)
+    return True
+
+
+class DeferredQueueHandler(QueueHandler):
+  """
+  QueueHandler that leaves formatting to the listener thread. The stock
+  handler formats (and so serialises every argument) in the caller.
+  """
+
+  def prepare(self, record):
+    return record
+
+
+_log_queue = queue.SimpleQueue()
+_queue_handlers = []
+_log_listener = None
+_log_lock = threading.Lock()
+_sampling_filter = None
+
+
+def _start_log_listener():
+  global _log_listener
+  handler = logging.StreamHandler()
+  handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+  _log_listener = QueueListener(_log_queue, handler, respect_handler_level=False)
+  _log_listener.start()
+
+
+def _stop_log_listener():
+  global _log_listener
+  with _log_lock:
+    if _log_listener is not None:
+      _log_listener.stop()
+      _log_listener = None
+
+
+def _ensure_log_listener():
+  with _log_lock:
+    if _log_listener is None:
+      _start_log_listener()
+
+
+def _restart_log_listener_after_fork():
+  # The listener thread does not survive fork(), and the inherited queue may
+  # be locked by it mid-get. Records still queued belong to the parent, whose
+  # own listener emits them, so give the child a fresh queue and listener.
+  global _log_listener, _log_lock, _log_queue
+  _log_lock = threading.Lock()
+  _log_queue = queue.SimpleQueue()
+  for handler in _queue_handlers:
+    handler.queue = _log_queue
+  if _log_listener is not None:
+    _log_listener = None
+    _start_log_listener()
+
+
+atexit.register(_stop_log_listener)
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
+
+
 def setup_logger(name):
+    global _sampling_filter
     logger = logging.getLogger(name)
     log_level = os.getenv("LOG_LEVEL")
     if log_level:
         logger.setLevel(log_level)
     else:
       logger.setLevel(logging.INFO if prod else logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    # Register the queue handler exactly once per logger, no matter how many
+    # times a module calls setup_logger.
+    if any(isinstance(h, DeferredQueueHandler) for h in logger.handlers):
+        return logger
+
+    if _sampling_filter is None:
+        _sampling_filter = SamplingFilter()
+    handler = DeferredQueueHandler(_log_queue)
+    handler.addFilter(_sampling_filter)
+    _queue_handlers.append(handler)
     logger.addHandler(handler)
+    logger.propagate = False
+    _ensure_log_listener()
     return logger
 
 def get_numeric_env_var(env_var_name, default_value):
@@ -29,4 +209,3 @@ def get_numeric_env_var(env_var_name, default_value):
   except ValueError:
     # If conversion fails, return the default value
     return default_value
-